@@ -1,2 +1,6 @@
-from .base import CommandSet, DependingCommandSet, ANY_SUCCEEDS, ALL_SUCCEED, try_until_succeeds
-from .ping import PingCommand, IPV4, IPV6
+from .base import CommandSet, DependingCommandSet, ANY_SUCCEEDS, ALL_SUCCEED, Retry, try_until_succeeds
+from .graph import Graph, Node
+from .ping import PingCommand, PingResult, IPV4, IPV6, SUBPROCESS, NATIVE, PERSISTENT
+from .tcp import TcpCommand, TcpResult
+from .http import HttpCommand, HttpResult
+from .retention import Retention, FULL, ON_FAILURE
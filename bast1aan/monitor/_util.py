@@ -1,13 +1,21 @@
 import asyncio
+import concurrent.futures
+import os
+import shutil
+import threading
 from dataclasses import dataclass
-from typing import TypeVar, AsyncIterator, Iterator, Awaitable, Iterable, Callable
+from typing import TypeVar, AsyncIterator, Generator, Awaitable, Iterable, Callable, Optional
 from ._typing_extensions import dataclass_transform
 
 T = TypeVar('T')
 
-_loop = None
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_thread: Optional[threading.Thread] = None
+_loop_lock = threading.Lock()
+_executables: dict[tuple[str, Optional[str]], str] = {}
 
-def sync_iterator(async_iter: AsyncIterator[T]) -> Iterator[T]:
+def sync_iterator(async_iter: AsyncIterator[T]) -> Generator[T, None, None]:
+    """ Iterate async_iter on the loop thread, resuming it for every next item that is asked for """
     try:
         while True:
             yield run_async(async_iter.__anext__())
@@ -18,11 +26,50 @@ async def async_iterator(iter: Iterable[T]) -> AsyncIterator[T]:
     for item in iter:
         yield item
 
+async def _await(awaitable: Awaitable[T]) -> T:
+    return await awaitable
+
+def in_loop_thread() -> bool:
+    """ Whether the current thread is the one running the loop of run_async """
+    return _loop_thread is threading.current_thread()
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    global _loop, _loop_thread
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(target=_loop.run_forever, name='bast1aan.monitor', daemon=True)
+            _loop_thread.start()
+        return _loop
+
+def _submit(awaitable: Awaitable[T]) -> concurrent.futures.Future[T]:
+    if in_loop_thread():
+        raise RuntimeError('run_async may not be called from its own event loop')
+    return asyncio.run_coroutine_threadsafe(_await(awaitable), _get_loop())
+
 def run_async(coro: Awaitable[T]) -> T:
-    global _loop
-    if not _loop:
-        _loop = asyncio.new_event_loop()
-    return _loop.run_until_complete(coro)
+    """ Run coro on a loop in a background thread and wait for its result. Any thread may call this, also
+    while running a loop of its own, and calls from different threads run at the same time. """
+    future = _submit(coro)
+    try:
+        return future.result()
+    except BaseException:
+        future.cancel()
+        raise
+
+def which(name: str) -> str:
+    """ Path of executable name in PATH, cached per PATH; name itself when it is a path or is not found """
+    if os.sep in name:
+        return name
+    key = (name, os.environ.get('PATH'))
+    if (path := _executables.get(key)) is None:
+        if (path := shutil.which(name)) is None:
+            return name
+        _executables[key] = path
+    return path
+
+def forget_executable(name: str) -> None:
+    _executables.pop((name, os.environ.get('PATH')), None)
 
 @dataclass_transform(frozen_default=True)
 def frozen_dataclass(*, eq: bool = False) -> Callable[[type[T]], type[T]]:
@@ -1,26 +1,57 @@
 from __future__ import annotations
 
 import asyncio
+import copy
+import os
+import random
+import signal
+import time
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from concurrent.futures import Executor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
 from typing import Tuple, Iterator, Iterable, ClassVar, Generic, TypeVar, AsyncIterable, AsyncIterator, Hashable, \
-    Optional, Callable
+    Optional, Callable, Union, Awaitable, Sequence, Coroutine, Any
 
-from bast1aan.monitor._util import async_iterator, sync_iterator, run_async, frozen_dataclass
+from bast1aan.monitor import concurrency, singleflight, ratelimit, metrics, profiling
+from bast1aan.monitor import retention as _retention
+from bast1aan.monitor._util import async_iterator, run_async, in_loop_thread, frozen_dataclass, which, forget_executable
+from bast1aan.monitor.concurrency import ConcurrencyLimit
+from bast1aan.monitor.output import CappedOutput
+from bast1aan.monitor.ratelimit import RateLimiter
+from bast1aan.monitor.retention import Retention
+from bast1aan.monitor.singleflight import SingleFlight
 
 ALL_SUCCEED = all
 ANY_SUCCEEDS = any
 
+# deadline (event loop time) inherited from the command set a command runs in
+_deadline: ContextVar[Optional[float]] = ContextVar('_deadline', default=None)
+
 
 class CommandResult(ABC):
+    # results of large command sets add up, so the results here keep no __dict__
+    __slots__ = ()
     command: Command
     @abstractmethod
     def __bool__(self) -> bool: ...
     @abstractmethod
     def __str__(self) -> str: ...
+    def retain(self, retention: Retention) -> None:
+        """ Drop what retention does not keep of the output of the result """
     @property
     def error(self) -> bool:
-        return not bool(self)
+        return not bool(self) and not self.cancelled and not self.skipped
+    @property
+    def cancelled(self) -> bool:
+        return False
+    @property
+    def timed_out(self) -> bool:
+        return False
+    @property
+    def skipped(self) -> bool:
+        return False
 
 
 ExtendsCommandResult = TypeVar('ExtendsCommandResult', bound=CommandResult)
@@ -28,6 +59,7 @@ ExtendsCommandResult = TypeVar('ExtendsCommandResult', bound=CommandResult)
 
 @dataclass
 class _CommandResult(CommandResult):
+    __slots__ = ('ok', 'msg', 'command')
     ok: bool
     msg: str
     command: Command
@@ -38,6 +70,9 @@ class _CommandResult(CommandResult):
     def __str__(self) -> str:
         return self.msg
 
+    def retain(self, retention: Retention) -> None:
+        self.msg = retention.apply(self.ok, self.msg)
+
     @classmethod
     def Ok(cls, msg: str, command: Command) -> CommandResult:
         return cls(True, msg, command)
@@ -47,6 +82,63 @@ class _CommandResult(CommandResult):
         return cls(False, msg, command)
 
 
+@dataclass
+class _CancelledResult(CommandResult):
+    """ Result of a command that was cancelled, or not started at all, because the verdict of its command set
+    was already decided. It is not successful, but it is no error either. """
+    __slots__ = ('command',)
+    command: Command
+
+    def __bool__(self) -> bool:
+        return False
+
+    def __str__(self) -> str:
+        return f'Cancelled: {self.command}'
+
+    @property
+    def cancelled(self) -> bool:
+        return True
+
+
+@dataclass
+class _SkippedResult(CommandResult):
+    """ Result of a command that was not run, because the results of the commands it depends on did not allow
+    it. It is not successful, but it is no error either. """
+    __slots__ = ('command',)
+    command: Command
+
+    def __bool__(self) -> bool:
+        return False
+
+    def __str__(self) -> str:
+        return f'Skipped: {self.command}'
+
+    @property
+    def skipped(self) -> bool:
+        return True
+
+
+@dataclass
+class _TimedOutResult(CommandResult):
+    """ Result of a command that did not finish before its deadline, with the output it gave until then """
+    __slots__ = ('msg', 'command')
+    msg: str
+    command: Command
+
+    def __bool__(self) -> bool:
+        return False
+
+    def retain(self, retention: Retention) -> None:
+        self.msg = retention.apply(False, self.msg)
+
+    def __str__(self) -> str:
+        return f'{self.msg}\nTimed out: {self.command}' if self.msg else f'Timed out: {self.command}'
+
+    @property
+    def timed_out(self) -> bool:
+        return True
+
+
 class Command(Hashable, ABC):
     @abstractmethod
     def __call__(self) -> CommandResult: ...
@@ -54,38 +146,91 @@ class Command(Hashable, ABC):
     def __str__(self) -> str: ...
 
 class AsyncCommand(Command, Generic[ExtendsCommandResult]):
-    _in_call: ClassVar[bool] = False
+    # whether run() occupies a concurrency slot; command sets only hold slots for their children
+    _limited: ClassVar[bool] = True
+    # whether run() returns a timed out result by itself when the deadline expires, instead of being cancelled
+    _keeps_deadline: ClassVar[bool] = False
+    # seconds run() may take, capped by the remaining time of the command set it runs in
+    timeout: Optional[float] = None
 
     @abstractmethod
     async def run(self) -> ExtendsCommandResult: ...
 
     def __call__(self) -> ExtendsCommandResult:
-        if self._in_call:
+        if in_loop_thread():
             raise RuntimeError('AsyncCommand may not be called recursively in a synchronous manner')
-        try:
-            AsyncCommand._in_call = True
-            return run_async(self.run())
-        finally:
-            AsyncCommand._in_call = False
+        return run_async(_run(self, _NO_SCOPE))  # type: ignore[return-value]
 
 
 class ExecutorCommand(AsyncCommand):
+    _keeps_deadline = True
+    # whether to look up argv[0] in PATH once, instead of on every spawn
+    cache_executable: ClassVar[bool] = False
+    # bytes of output kept per stream, head and tail; None keeps everything
+    output_limit: Optional[int] = None
+
     @property
     @abstractmethod
     def command(self) -> str: ...
 
+    @property
+    def argv(self) -> Optional[Sequence[str]]:
+        """ Arguments to execute directly, without a shell; when None, command is run through the shell """
+        return None
+
+    async def _spawn(self, argv: Optional[Sequence[str]]) -> asyncio.subprocess.Process:
+        if argv is None:
+            return await asyncio.subprocess.create_subprocess_shell(
+                self.command,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True,
+            )
+        executable = which(argv[0]) if self.cache_executable else argv[0]
+        try:
+            return await asyncio.subprocess.create_subprocess_exec(
+                *argv,
+                executable=executable,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True,
+            )
+        except FileNotFoundError:
+            if executable == argv[0]:
+                raise
+            # the cached executable has been removed since, look it up again
+            forget_executable(argv[0])
+            return await self._spawn(argv)
+
+    async def start(self, *, stream: bool = False) -> Execution:
+        """ Start the process. With stream, the output lines can be iterated from the execution while it runs.
+        Raises FileNotFoundError when the executable does not exist. """
+        return await self._start(self.argv, _deadline_for(self), stream)
+
+    async def _start(self, argv: Optional[Sequence[str]], deadline: Optional[float], stream: bool = False) -> Execution:
+        if (span := metrics.span()) is None:
+            return Execution(self, await self._spawn(argv), deadline, stream)
+        spawning = time.perf_counter()
+        process = await self._spawn(argv)
+        span.spawn = time.perf_counter() - spawning
+        return Execution(self, process, deadline, stream)
+
     async def run(self) -> CommandResult:
-        process = await asyncio.subprocess.create_subprocess_shell(
-            self.command,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
+        return await self._execute(self.argv, _deadline_for(self))
 
-        stdout, stderr = await process.communicate()
+    async def _execute(self, argv: Optional[Sequence[str]], deadline: Optional[float]) -> CommandResult:
+        """ Run argv instead of the argv of the command, for arguments that are only known when it runs """
+        try:
+            execution = await self._start(argv, deadline)
+        except FileNotFoundError as e:
+            return self._result(False, b'', f'{e.filename}: command not found'.encode())
+        return await execution.result()
 
+    def _result(self, ok: bool, stdout: bytes, stderr: bytes) -> CommandResult:
+        """ Result of a finished process, subclasses may return their own result type """
         msg = b'\n'.join((stdout, stderr)).decode()
 
-        if process.returncode != 0:
+        if not ok:
             return _CommandResult.Error(msg, self)
         else:
             return _CommandResult.Ok(msg, self)
@@ -94,55 +239,343 @@ class ExecutorCommand(AsyncCommand):
         return self.command
 
 
-@dataclass
+async def _kill(process: asyncio.subprocess.Process) -> None:
+    """ Kill the process group of process, so no children of a shell hold on to its pipes, and reap it """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    await process.wait()
+
+
+class Execution(AsyncIterable[bytes]):
+    """ Running process of an ExecutorCommand. Its output is captured up to the output_limit of the command
+    per stream. When started with stream, iterating it yields stdout and stderr lines as they arrive. """
+    command: ExecutorCommand
+    process: asyncio.subprocess.Process
+    stdout: CappedOutput
+    stderr: CappedOutput
+    _lines: Optional[asyncio.Queue[bytes]]
+    _done: asyncio.Future[CommandResult]
+
+    def __init__(self, command: ExecutorCommand, process: asyncio.subprocess.Process, deadline: Optional[float],
+                 stream: bool = False):
+        self.command = command
+        self.process = process
+        self.stdout = CappedOutput(command.output_limit)
+        self.stderr = CappedOutput(command.output_limit)
+        # bounded, so a slow consumer slows down reading instead of growing the queue
+        self._lines = asyncio.Queue(maxsize=1024) if stream else None
+        self._done = asyncio.ensure_future(self._communicate(deadline))
+
+    async def _read(self, reader: Optional[asyncio.StreamReader], output: CappedOutput) -> None:
+        assert reader is not None
+        partial = b''
+        while chunk := await reader.read(65536):
+            output.write(chunk)
+            if self._lines is not None:
+                *lines, partial = (partial + chunk).split(b'\n')
+                for line in lines:
+                    await self._put(line)
+        if partial:
+            await self._put(partial)
+
+    async def _put(self, line: bytes) -> None:
+        if self._lines is not None:
+            await self._lines.put(line)
+
+    async def _communicate(self, deadline: Optional[float]) -> CommandResult:
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(
+                    self._read(self.process.stdout, self.stdout),
+                    self._read(self.process.stderr, self.stderr),
+                    self.process.wait()
+                ),
+                _remaining(deadline)
+            )
+        except asyncio.TimeoutError:
+            await _kill(self.process)
+            msg = b'\n'.join((bytes(self.stdout), bytes(self.stderr))).decode(errors='replace')
+            return _TimedOutResult(msg, self.command)
+        except asyncio.CancelledError:
+            await _kill(self.process)
+            raise
+        finally:
+            if (span := metrics.span()) is not None:
+                span.process = time.perf_counter() - started
+                span.exit_code = self.process.returncode
+                span.output_bytes = len(self.stdout) + len(self.stderr)
+        return self.command._result(self.process.returncode == 0, bytes(self.stdout), bytes(self.stderr))
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        if self._lines is None:
+            raise RuntimeError('Execution was not started with stream')
+        while True:
+            get = asyncio.ensure_future(self._lines.get())
+            try:
+                await asyncio.wait((get, self._done), return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                get.cancel()
+            if get.done() and not get.cancelled():
+                yield get.result()
+                continue
+            while self._lines is not None and not self._lines.empty():
+                yield self._lines.get_nowait()
+            return
+
+    async def result(self) -> CommandResult:
+        """ Wait for the process to finish; lines that have not been iterated by then are discarded """
+        if self._lines is not None and not self._done.done():
+            lines, self._lines = self._lines, None
+            while not lines.empty():
+                lines.get_nowait()
+        try:
+            return await asyncio.shield(self._done)
+        except asyncio.CancelledError:
+            self._done.cancel()
+            await asyncio.wait((self._done,))
+            raise
+
+
+def _deadline_for(command: AsyncCommand) -> Optional[float]:
+    """ Deadline of command: its own timeout from now, capped by the deadline of the set it runs in """
+    deadline = _deadline.get()
+    if command.timeout is not None:
+        own = asyncio.get_running_loop().time() + command.timeout
+        deadline = own if deadline is None else min(deadline, own)
+    return deadline
+
+
+def _remaining(deadline: Optional[float]) -> Optional[float]:
+    return None if deadline is None else max(0.0, deadline - asyncio.get_running_loop().time())
+
+
+async def _within_deadline(command: Command, awaitable: Awaitable[CommandResult],
+                           deadline: Optional[float]) -> CommandResult:
+    if deadline is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, _remaining(deadline))
+    except asyncio.TimeoutError:
+        return _TimedOutResult('', command)
+
+
+# end of an iterator, as a result of _anext()
+_END: Any = object()
+
+
+async def _anext(iterator: AsyncIterator[CommandResult]) -> CommandResult:
+    """ The next result of iterator, or _END; the end is no exception, which a future pulled ahead would log
+    when it is never retrieved """
+    try:
+        return await iterator.__anext__()
+    except StopAsyncIteration:
+        return _END
+
+
 class CommandSetResult(CommandResult, AsyncIterable[CommandResult], Iterable[CommandResult]):
+    __slots__ = ('command', 'iterator', 'succeeds_if', '_results', 'short_circuit', '_cancellation', '_walked',
+                 '_ahead')
     command: Command
     iterator: AsyncIterator[CommandResult]
     succeeds_if: Callable[[Iterable], bool]
-    _results: tuple[CommandResult, ...] = ()
+    # walked to the end already, results are not walked again
+    _results: Optional[tuple[CommandResult, ...]]
+    short_circuit: bool
+    _cancellation: Optional[_Cancellation]
+    # results of walks so far, yielded again by a next walk before it resumes the iterator
+    _walked: list[CommandResult]
+    # next result of the iterator, pulled ahead on the loop for a synchronous walk
+    _ahead: Optional[asyncio.Future]
+
+    def __init__(self, command: Command, iterator: AsyncIterator[CommandResult], succeeds_if: Callable[[Iterable], bool],
+                 _results: Optional[tuple[CommandResult, ...]] = None, short_circuit: bool = False,
+                 _cancellation: Optional[_Cancellation] = None):
+        self.command = command
+        self.iterator = iterator
+        self.succeeds_if = succeeds_if
+        self._results = _results
+        self.short_circuit = short_circuit
+        self._cancellation = _cancellation
+        self._walked = []
+        self._ahead = None
 
     async def _walk(self) -> AsyncIterator[CommandResult]:
-        results = []
-        async for result in self.iterator:
-            results.append(result)
-            yield result
-        self._results = tuple(results)
+        i = 0
+        while i < len(self._walked) or self._results is None and await self._walk_on():
+            yield self._walked[i]
+            i += 1
+
+    def _iterate(self) -> Iterator[CommandResult]:
+        i = 0
+        while i < len(self._walked) or self._results is None and run_async(self._pull()):
+            yield self._walked[i]
+            i += 1
+
+    async def _walk_on(self) -> bool:
+        """ Walk on to the next result, into _walked; False at the end """
+        ahead, self._ahead = self._ahead, None
+        result = await (ahead if ahead is not None else _anext(self.iterator))
+        if result is _END:
+            self._results = tuple(self._walked)
+            return False
+        self._walked.append(result)
+        return True
+
+    async def _pull(self) -> bool:
+        """ Walk on to the next result, and to those after it that are there without waiting, so a synchronous
+        walk does not take a round trip to the loop thread for every result. The first result that is not there
+        yet is left pulled ahead. """
+        if not await self._walk_on():
+            return False
+        while self._results is None:
+            self._ahead = asyncio.ensure_future(_anext(self.iterator))
+            # one step of the loop, in which the pull ahead takes a result that is there already
+            await asyncio.sleep(0)
+            if not self._ahead.done() or not await self._walk_on():
+                break
+        return True
+
+    def _walk_ahead(self) -> None:
+        """ Start walking on the loop, up to the first result, when that did not start yet """
+        if self._ahead is None and self._results is None and not self._walked:
+            self._ahead = asyncio.ensure_future(_anext(self.iterator))
+
+    def _cancel_ahead(self) -> None:
+        if self._ahead is not None:
+            self._ahead.cancel()
 
     def __aiter__(self) -> AsyncIterator[CommandResult]:
-        return async_iterator(self._results) if self._results else self._walk()
+        return async_iterator(self._results) if self._results is not None else self._walk()
 
     def __iter__(self) -> Iterator[CommandResult]:
-        return iter(self._results) if self._results else sync_iterator(self.__aiter__())
+        return iter(self._results) if self._results is not None else self._iterate()
 
     def __bool__(self) -> bool:
-        return self.succeeds_if(self)
+        # a short circuiting walk stops by itself, so walk it to the end to have its outstanding commands cancelled
+        return self.succeeds_if(tuple(self) if self.short_circuit else self)
+
+    def cancel(self) -> None:
+        """ Have the remainder of the walk cancel its outstanding commands and report them as cancelled """
+        if self._cancellation is not None:
+            self._cancellation.cancel()
 
     def __str__(self) -> str:
         return '\n'.join((str(result) for result in iter(self)))
 
 
 class CommandSet(AsyncCommand[CommandSetResult]):
+    """ Runs its commands at the same time, yielding their results in order of completion; the results of a nested
+    command set are walked to the end before the next result, though its commands start as soon as it returned its
+    result. With short_circuit, nested command sets are walked at the same time, so the result deciding the set is
+    seen as soon as it is there. Synchronous commands are called in executor, the default executor of the loop when
+    None: a ThreadPoolExecutor. With a ProcessPoolExecutor, for CPU-bound commands, the commands and their results
+    have to be picklable.
+
+    With retention, results keep only that part of their output, trimmed as soon as their command finished;
+    nested command sets inherit it unless they have their own. """
     commands: Tuple[Command, ...]
     _succeeds_if: Callable[[Iterable], bool]
-    def __init__(self, *commands: Command, succeeds_if: Callable[[Iterable], bool] = ALL_SUCCEED):
+    _concurrency: Optional[ConcurrencyLimit]
+    _short_circuit: bool
+    _single_flight: Optional[SingleFlight]
+    _rate_limiter: Optional[RateLimiter]
+    _executor: Optional[Executor]
+    _retention: Optional[Retention]
+    _limited = False
+    def __init__(self, *commands: Command, succeeds_if: Callable[[Iterable], bool] = ALL_SUCCEED,
+                 concurrency: Optional[ConcurrencyLimit] = None, short_circuit: bool = False,
+                 timeout: Optional[float] = None, single_flight: Optional[SingleFlight] = None,
+                 rate_limiter: Optional[RateLimiter] = None, executor: Optional[Executor] = None,
+                 retention: Optional[Retention] = None):
+        if short_circuit and succeeds_if not in (ALL_SUCCEED, ANY_SUCCEEDS):
+            raise ValueError('short_circuit is only possible with ALL_SUCCEED or ANY_SUCCEEDS')
         self.commands = commands
         self._succeeds_if = succeeds_if
+        self._concurrency = concurrency
+        self._short_circuit = short_circuit
+        self.timeout = timeout
+        self._single_flight = single_flight
+        self._rate_limiter = rate_limiter
+        self._executor = executor
+        self._retention = retention
     async def run(self) -> CommandSetResult:
-        return CommandSetResult(command=self, iterator=self._walk(), succeeds_if=self._succeeds_if)
+        cancellation = _Cancellation()
+        scope = _Scope.of(self, self._concurrency, self._single_flight, self._rate_limiter, self._retention)
+        walk = self._walk_short_circuit if self._short_circuit else self._walk
+        return CommandSetResult(
+            command=self,
+            iterator=scope.walk(self, walk(scope, cancellation)),
+            succeeds_if=self._succeeds_if,
+            short_circuit=self._short_circuit,
+            _cancellation=cancellation,
+        )
     def __str__(self) -> str:
         return '\n'.join((str(command) for command in self.commands))
     def __hash__(self) -> int:
         return hash(self.commands)
-    async def _walk(self) -> AsyncIterator[CommandResult]:
-        futures = [command.run() for command in self.commands if isinstance(command, AsyncCommand)]
+    def _decides(self, result: CommandResult) -> bool:
+        return self._short_circuit and not result.cancelled and bool(result) is (self._succeeds_if is ANY_SUCCEEDS)
+
+    async def _walk(self, scope: _Scope, cancellation: _Cancellation) -> AsyncIterator[CommandResult]:
+        # like asyncio.as_completed, but knowing the command of a task, to report it when it was cancelled
+        if cancellation.requested:
+            for command in self.commands:
+                yield _CancelledResult(command)
+            return
+        done: asyncio.Queue[asyncio.Task] = asyncio.Queue()
+
+        def finished(task: asyncio.Task) -> None:
+            done.put_nowait(task)
+            # a nested set starts walking right away, so its commands run while the sets before it are walked
+            if (nested := _set_result(task)) is not None:
+                nested._walk_ahead()
 
-        for next_result in asyncio.as_completed(futures):
-            async for subresult in _walk_over_result(await next_result):
-                yield subresult
+        for command in self.commands:
+            cancellation.start(command, scope, self._executor).add_done_callback(finished)
+        try:
+            while cancellation.running:
+                task = await done.get()
+                result = cancellation.finished(task)
+                if isinstance(result, CommandSetResult):
+                    async for subresult in cancellation.walk(result):
+                        yield subresult
+                else:
+                    yield result
+        finally:
+            cancellation.cancel_running()
+            # nested sets walking ahead that are not walked
+            while not done.empty():
+                if (nested := _set_result(done.get_nowait())) is not None:
+                    nested._cancel_ahead()
+
+    async def _walk_short_circuit(self, scope: _Scope, cancellation: _Cancellation) -> AsyncIterator[CommandResult]:
+        # nested results are walked concurrently as well, so a result deciding the set is seen as soon as it is there
+        results: asyncio.Queue[Union[CommandResult, asyncio.Task]] = asyncio.Queue()
 
+        async def run_and_walk(command: Command) -> None:
+            async for subresult in cancellation.walk(await cancellation.run(command, scope, self._executor)):
+                results.put_nowait(subresult)
+
+        tasks = set()
         for command in self.commands:
-            if not isinstance(command, AsyncCommand):
-                yield command()
+            tasks.add(task := asyncio.ensure_future(run_and_walk(command)))
+            task.add_done_callback(results.put_nowait)
+        try:
+            while tasks:
+                result = await results.get()
+                if isinstance(result, asyncio.Task):
+                    tasks.discard(result)
+                    result.result()
+                    continue
+                yield result
+                if self._decides(result):
+                    cancellation.cancel()
+        finally:
+            for task in tasks:
+                task.cancel()
 
 
 @frozen_dataclass()
@@ -151,33 +584,401 @@ class DependingCommandSet(AsyncCommand[CommandSetResult]):
     if_succeeds: Optional[AsyncCommand] = None
     if_fails: Optional[AsyncCommand] = None
     succeeds_if: Callable[[Iterable], bool] = ALL_SUCCEED
+    concurrency: Optional[ConcurrencyLimit] = None
+    timeout: Optional[float] = None
+    single_flight: Optional[SingleFlight] = None
+    rate_limiter: Optional[RateLimiter] = None
+    retention: Optional[Retention] = None
+    _limited = False
 
     async def run(self) -> CommandSetResult:
-        return CommandSetResult(command=self, iterator=self._walk(), succeeds_if=self.succeeds_if)
+        cancellation = _Cancellation()
+        scope = _Scope.of(self, self.concurrency, self.single_flight, self.rate_limiter, self.retention)
+        return CommandSetResult(
+            command=self,
+            iterator=scope.walk(self, self._walk(scope, cancellation)),
+            succeeds_if=self.succeeds_if,
+            _cancellation=cancellation,
+        )
 
-    async def _walk(self) -> AsyncIterator[CommandResult]:
-        async for subresult in _walk_over_result(first_result := await self.first_command.run()):
+    async def _walk(self, scope: _Scope, cancellation: _Cancellation) -> AsyncIterator[CommandResult]:
+        first_result = await cancellation.run(self.first_command, scope)
+        async for subresult in cancellation.walk(first_result):
             yield subresult
-        if first_result and self.if_succeeds is not None:
-            async for subresult in _walk_over_result(await self.if_succeeds.run()):
-                yield subresult
-        if not first_result and self.if_fails is not None:
-            async for subresult in _walk_over_result(await self.if_fails.run()):
+        if (next_command := self.if_succeeds if first_result else self.if_fails) is not None:
+            async for subresult in cancellation.walk(await cancellation.run(next_command, scope)):
                 yield subresult
 
     def __str__(self) -> str:
         return str(self.first_command)
 
 
-def try_until_succeeds(*commands: AsyncCommand, count: int = 1) -> DependingCommandSet:
-    commands = commands * count
-    return DependingCommandSet(
-        commands[0],
-        if_fails=try_until_succeeds(*commands[1:]) if len(commands) > 2 else commands[1],
-        succeeds_if=ANY_SUCCEEDS
+class Retry(AsyncCommand[CommandSetResult]):
+    """ Runs the commands one after another until one succeeds, for at most `attempts` rounds. Before every next
+    round it backs off: `backoff` seconds at first, multiplied by `factor` every round up to `max_backoff`, and
+    moved by up to `jitter` times itself. With race, the commands of a round run at the same time and the first
+    success cancels the others. No round is started that could not begin before the deadline.
+
+    Only the results of the last round are kept, so memory does not depend on the number of attempts, unless
+    all_rounds has the results of every round walked. Like ANY_SUCCEEDS, the result is successful if one of them
+    is. """
+    commands: Tuple[AsyncCommand, ...]
+    attempts: int
+    backoff: float
+    factor: float
+    max_backoff: Optional[float]
+    jitter: float
+    race: bool
+    all_rounds: bool
+    _concurrency: Optional[ConcurrencyLimit]
+    _single_flight: Optional[SingleFlight]
+    _rate_limiter: Optional[RateLimiter]
+    _retention: Optional[Retention]
+    _racing: Optional[CommandSet]
+    _limited = False
+    def __init__(self, *commands: AsyncCommand, attempts: int = 1, backoff: float = 0.0, factor: float = 2.0,
+                 max_backoff: Optional[float] = None, jitter: float = 0.1, race: bool = False,
+                 all_rounds: bool = False, timeout: Optional[float] = None,
+                 concurrency: Optional[ConcurrencyLimit] = None, single_flight: Optional[SingleFlight] = None,
+                 rate_limiter: Optional[RateLimiter] = None, retention: Optional[Retention] = None):
+        if attempts < 1:
+            raise ValueError('attempts must be at least 1')
+        self.commands = commands
+        self.attempts = attempts
+        self.backoff = backoff
+        self.factor = factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.race = race
+        self.all_rounds = all_rounds
+        self.timeout = timeout
+        self._concurrency = concurrency
+        self._single_flight = single_flight
+        self._rate_limiter = rate_limiter
+        self._retention = retention
+        self._racing = CommandSet(*commands, succeeds_if=ANY_SUCCEEDS, short_circuit=True) if race else None
+    async def run(self) -> CommandSetResult:
+        cancellation = _Cancellation()
+        scope = _Scope.of(self, self._concurrency, self._single_flight, self._rate_limiter, self._retention)
+        return CommandSetResult(
+            command=self,
+            iterator=scope.walk(self, self._walk(scope, cancellation)),
+            succeeds_if=ANY_SUCCEEDS,
+            _cancellation=cancellation,
+        )
+    def __str__(self) -> str:
+        return '\n'.join((str(command) for command in self.commands))
+    def __hash__(self) -> int:
+        return hash(self.commands)
+    def delay(self, attempt: int) -> float:
+        """ Seconds to back off after round `attempt` failed, counting from 1 """
+        delay = self.backoff * self.factor ** (attempt - 1)
+        if self.max_backoff is not None:
+            delay = min(delay, self.max_backoff)
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+    async def _round(self, scope: _Scope, cancellation: _Cancellation) -> list[CommandResult]:
+        results: list[CommandResult] = []
+        for command in (self.commands if self._racing is None else (self._racing,)):
+            async for result in cancellation.walk(await cancellation.run(command, scope)):
+                results.append(result)
+            if any(results):
+                break
+        return results
+
+    async def _walk(self, scope: _Scope, cancellation: _Cancellation) -> AsyncIterator[CommandResult]:
+        loop = asyncio.get_running_loop()
+        for attempt in range(1, self.attempts + 1):
+            results = await self._round(scope, cancellation)
+            if attempt == self.attempts or cancellation.requested or any(results):
+                break
+            if self.all_rounds:
+                for result in results:
+                    yield result
+            delay = self.delay(attempt)
+            if scope.deadline is not None and loop.time() + delay >= scope.deadline:
+                break
+            await asyncio.sleep(delay)
+        for result in results:
+            yield result
+
+
+def try_until_succeeds(*commands: AsyncCommand, count: int = 1) -> Retry:
+    return Retry(*commands, attempts=count, all_rounds=True)
+
+
+@dataclass(frozen=True)
+class _Scope:
+    """ What a command set passes on to the commands it runs, and through them to nested command sets """
+    limit: Optional[ConcurrencyLimit] = None
+    deadline: Optional[float] = None
+    single_flight: Optional[SingleFlight] = None
+    rate_limiter: Optional[RateLimiter] = None
+    retention: Optional[Retention] = None
+    # profiled node of the command set, parent of the nodes of the commands it runs
+    node: Optional[profiling.Node] = field(default=None, compare=False)
+
+    @classmethod
+    def of(cls, command: AsyncCommand, limit: Optional[ConcurrencyLimit], single_flight: Optional[SingleFlight],
+           rate_limiter: Optional[RateLimiter], retention: Optional[Retention] = None) -> _Scope:
+        """ Scope of a command set, inheriting what it does not set itself from the set it runs in """
+        node = profiling.current.get()
+        if (profile := profiling.active.get()) is not None and (node is None or node.command is not command):
+            # run by itself, like the root of a profile, rather than by a command set that made its node already
+            node = profile.add(command, node)
+        return cls(
+            concurrency.current.get() if limit is None else limit,
+            _deadline_for(command),
+            singleflight.current.get() if single_flight is None else single_flight,
+            ratelimit.current.get() if rate_limiter is None else rate_limiter,
+            _retention.current.get() if retention is None else retention,
+            node,
+        )
+
+    def walk(self, command: Command, results: AsyncIterator[CommandResult]) -> AsyncIterator[CommandResult]:
+        """ The results of command, ending the node of() made for it once they are walked """
+        if self.node is None or self.node.command is not command or profiling.current.get() is self.node:
+            return results
+        return profiling.walk(results, self.node)
+
+
+def _run(command: AsyncCommand, scope: _Scope) -> Coroutine[object, None, CommandResult]:
+    """ Run command in scope, making the scope the default for nested command sets """
+    if (profile := profiling.active.get()) is not None:
+        return _run_profiled(command, scope, profile)
+    if (recorder := metrics._installed) is None or not command._limited:
+        return _run_scoped(command, scope)
+    # command sets only return a result to walk, so only the commands they run get a span
+    return _run_spanned(command, lambda: _run_scoped(command, scope), recorder)
+
+
+async def _run_spanned(command: Command, run: Callable[[], Awaitable[CommandResult]],
+                       recorder: Optional[metrics.Metrics], span: Optional[metrics.Span] = None) -> CommandResult:
+    """ Have run() run command in a span, recorded in recorder if any """
+    if span is None:
+        span = metrics.Span(command, parent=metrics.current.get())
+    token = metrics.current.set(span)
+    try:
+        span.result = result = await run()
+        span.finish(span.outcome_of(result))
+        return result
+    except asyncio.CancelledError:
+        span.finish(metrics.CANCELLED)
+        raise
+    except BaseException:
+        span.finish(metrics.EXCEPTION)
+        raise
+    finally:
+        metrics.current.reset(token)
+        if recorder is not None:
+            recorder.record(span)
+
+
+async def _run_profiled(command: Command, scope: _Scope, profile: profiling.Profile,
+                        executor: Optional[Executor] = None) -> CommandResult:
+    """ Run command in scope as a node of profile. The node of a command set lasts until its last result. """
+    node = profile.add(command, scope.node)
+    token = profiling.current.set(node)
+    try:
+        if isinstance(command, AsyncCommand) and not command._limited:
+            result = await _run_scoped(command, scope)
+        else:
+            node.span = metrics.Span(command, start=node.start, parent=metrics.current.get())
+            if isinstance(command, AsyncCommand):
+                result = await _run_spanned(command, lambda: _run_scoped(command, scope), metrics._installed, node.span)
+            else:
+                result = await _run_spanned(command, lambda: _run_in_executor(command, scope, executor), None, node.span)
+    except BaseException:
+        node.finish()
+        raise
+    finally:
+        profiling.current.reset(token)
+    if isinstance(result, CommandSetResult):
+        result.iterator = profiling.walk(result.iterator, node)
+    else:
+        node.finish()
+    return result
+
+
+async def _run_scoped(command: AsyncCommand, scope: _Scope) -> CommandResult:
+    if scope == _NO_SCOPE:
+        return await _run_unlimited(command)
+    tokens = (
+        concurrency.current.set(scope.limit),
+        _deadline.set(scope.deadline),
+        singleflight.current.set(scope.single_flight),
+        ratelimit.current.set(scope.rate_limiter),
+        _retention.current.set(scope.retention),
+    )
+    try:
+        if not command._limited:
+            return await _run_unlimited(command)
+        deadline = _deadline_for(command)
+        if scope.single_flight is None:
+            return _retained(await _run_limited(command, scope, deadline), scope)
+        # the run is shared, so it is bound by the deadline of the one starting it; others may give up earlier
+        return _retained(await _within_deadline(
+            command,
+            scope.single_flight.run(command, lambda: _run_limited(command, scope, deadline)),
+            deadline,
+        ), scope, shared=True)
+    finally:
+        concurrency.current.reset(tokens[0])
+        _deadline.reset(tokens[1])
+        singleflight.current.reset(tokens[2])
+        ratelimit.current.reset(tokens[3])
+        _retention.current.reset(tokens[4])
+
+
+def _retained(result: CommandResult, scope: _Scope, shared: bool = False) -> CommandResult:
+    """ Result with only the output the retention of scope keeps, before it is passed on; a copy of a result
+    shared with other runs, which may keep more """
+    if scope.retention is not None:
+        if shared:
+            result = copy.copy(result)
+        result.retain(scope.retention)
+    return result
+
+
+_NO_SCOPE = _Scope()
+
+
+async def _run_unlimited(command: AsyncCommand) -> CommandResult:
+    """ Run command outside of any limit, still within its deadline """
+    if command._keeps_deadline:
+        return await command.run()
+    return await _within_deadline(command, command.run(), _deadline_for(command))
+
+
+async def _run_limited(command: Command, scope: _Scope, deadline: Optional[float],
+                       start: Optional[Callable[[], Awaitable[CommandResult]]] = None) -> CommandResult:
+    """ Run command once the limits of scope allow it, or what start() returns instead of command.run() """
+    span = metrics.span()
+    if scope.rate_limiter is not None:
+        try:
+            waited = await asyncio.wait_for(scope.rate_limiter.wait(getattr(command, 'target', command)),
+                                            _remaining(deadline))
+        except asyncio.TimeoutError:
+            return _TimedOutResult('', command)
+        if span is not None:
+            span.queue_wait += waited
+            span.rate_wait += waited
+    waiting = time.perf_counter() if span is not None and scope.limit is not None else None
+    async with _slot(command, scope.limit, deadline) as acquired:
+        if span is not None and waiting is not None:
+            span.queue_wait += time.perf_counter() - waiting
+        if not acquired:
+            return _TimedOutResult('', command)
+        if start is not None:
+            return await _within_deadline(command, start(), deadline)
+        assert isinstance(command, AsyncCommand)
+        if command._keeps_deadline:
+            return await command.run()
+        return await _within_deadline(command, command.run(), deadline)
+
+
+async def _run_in_executor(command: Command, scope: _Scope, executor: Optional[Executor]) -> CommandResult:
+    """ Call the synchronous command in executor, within the limits of scope. A call that is cancelled or times
+    out is only abandoned, it runs on until it returns by itself. """
+    loop = asyncio.get_running_loop()
+    return _retained(
+        await _run_limited(command, scope, scope.deadline, lambda: loop.run_in_executor(executor, command)), scope,
     )
 
 
+@asynccontextmanager
+async def _slot(command: Command, limit: Optional[ConcurrencyLimit], deadline: Optional[float]) -> AsyncIterator[bool]:
+    """ Occupy a slot of limit, yielding whether that succeeded before deadline """
+    if limit is None:
+        yield True
+        return
+    slot = limit.slot(command)
+    try:
+        await asyncio.wait_for(slot.__aenter__(), _remaining(deadline))
+    except asyncio.TimeoutError:
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        await slot.__aexit__(None, None, None)
+
+
+class _Cancellation:
+    """ Cancellation of one command set walk: cancels the commands it is running and the nested results it is
+    walking. Cancelled commands are reported as cancelled results, so the walk still ends normally. """
+    requested: bool
+    # the commands running, by their task
+    running: dict[asyncio.Task, Command]
+    _walking: dict[int, CommandSetResult]
+
+    def __init__(self) -> None:
+        self.requested = False
+        self.running = {}
+        self._walking = {}
+
+    def cancel(self) -> None:
+        self.requested = True
+        self.cancel_running()
+        for result in self._walking.values():
+            result.cancel()
+
+    def cancel_running(self) -> None:
+        for task in self.running:
+            task.cancel()
+
+    def start(self, command: Command, scope: _Scope, executor: Optional[Executor] = None) -> asyncio.Task:
+        """ Start running command in scope, a synchronous command in executor; its result is taken with
+        finished() """
+        if isinstance(command, AsyncCommand):
+            task = asyncio.ensure_future(_run(command, scope))
+        elif (profile := profiling.active.get()) is not None:
+            task = asyncio.ensure_future(_run_profiled(command, scope, profile, executor))
+        else:
+            task = asyncio.ensure_future(_run_in_executor(command, scope, executor))
+        self.running[task] = command
+        return task
+
+    def finished(self, task: asyncio.Task) -> CommandResult:
+        """ Result of the done task, a cancelled result when it was cancelled """
+        command = self.running.pop(task)
+        return _CancelledResult(command) if task.cancelled() else task.result()
+
+    async def run(self, command: Command, scope: _Scope, executor: Optional[Executor] = None) -> CommandResult:
+        """ Run command in scope; a synchronous command is called in executor """
+        if self.requested:
+            return _CancelledResult(command)
+        task = self.start(command, scope, executor)
+        try:
+            await asyncio.wait((task,))
+        except BaseException:
+            self.running.pop(task, None)
+            task.cancel()
+            raise
+        return self.finished(task)
+
+    async def walk(self, result: CommandResult) -> AsyncIterator[CommandResult]:
+        if not isinstance(result, CommandSetResult):
+            yield result
+            return
+        if self.requested:
+            result.cancel()
+        self._walking[id(result)] = result
+        try:
+            async for subresult in result:
+                yield subresult
+        finally:
+            del self._walking[id(result)]
+
+
+def _set_result(task: asyncio.Task) -> Optional[CommandSetResult]:
+    """ Result of the done task, when it is the result of a command set """
+    if task.cancelled() or task.exception() is not None:
+        return None
+    result = task.result()
+    return result if isinstance(result, CommandSetResult) else None
+
+
 async def _walk_over_result(result: CommandResult) -> AsyncIterator[CommandResult]:
     if isinstance(result, CommandSetResult):
         async for subresult in result:
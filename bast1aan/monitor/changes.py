@@ -0,0 +1,172 @@
+""" Tracking the state of commands over their runs, passing on only the changes of state """
+from __future__ import annotations
+
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Optional, AsyncIterable, AsyncIterator, Iterable, Union
+
+from bast1aan.monitor.base import Command, CommandResult
+
+# number of runs over which flapping is detected, as in Nagios
+FLAP_RUNS = 21
+
+
+@dataclass(frozen=True)
+class Change:
+    """ Command went from state previous (None when it had none yet) to state ok with result. A change with
+    flapping set reports that the command started flapping; its changes are held back until it stopped. """
+    command: Command
+    ok: bool
+    previous: Optional[bool]
+    result: CommandResult
+    at: float
+    flapping: bool = False
+
+
+class _State:
+    """ What is kept per command: its state, the streak of runs disagreeing with it and the outcomes of its last
+    FLAP_RUNS runs as bits, most recent in the lowest """
+    __slots__ = ('ok', 'streak', 'outcomes', 'runs', 'flapping')
+
+    def __init__(self) -> None:
+        self.ok: Optional[bool] = None
+        self.streak = 0
+        self.outcomes = 0
+        self.runs = 0
+        self.flapping = False
+
+    def flap_ratio(self) -> float:
+        """ Fraction of the last FLAP_RUNS - 1 runs that differed from the run before; runs before the first run do
+        not differ, so a command needs several changes to start flapping """
+        runs = min(self.runs, FLAP_RUNS) - 1
+        if runs < 1:
+            return 0.0
+        mask = (1 << runs) - 1
+        return bin((self.outcomes ^ (self.outcomes >> 1)) & mask).count('1') / (FLAP_RUNS - 1)
+
+
+class StateTracker:
+    """ Keeps the last known state of every command, by its hash, and reports a Change only when it changes.
+
+    With hysteresis, a failing command is only reported failing after `fall` failed runs in a row, and a
+    succeeding one succeeding after `rise` successful runs. A command whose runs changed outcome in more than
+    flap_high of its last FLAP_RUNS runs is flapping: that is reported once, and changes are held back until it
+    changes in less than flap_low of them, when its state is reported if it differs; a flap_high of 1 disables
+    flap detection. Cancelled and skipped results say nothing about a command, so they are ignored.
+
+    Runs that change nothing only update the state kept for the command in place. """
+    rise: int
+    fall: int
+    flap_high: float
+    flap_low: float
+    report_initial: bool
+    _states: dict[Command, _State]
+
+    def __init__(self, *, rise: int = 1, fall: int = 1, flap_high: float = 0.5, flap_low: float = 0.25,
+                 report_initial: bool = True):
+        if rise < 1 or fall < 1:
+            raise ValueError('rise and fall must be at least 1')
+        self.rise = rise
+        self.fall = fall
+        self.flap_high = flap_high
+        self.flap_low = flap_low
+        self.report_initial = report_initial
+        self._states = {}
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def state(self, command: Command) -> Optional[bool]:
+        state = self._states.get(command)
+        return None if state is None else state.ok
+
+    def forget(self, command: Command) -> None:
+        self._states.pop(command, None)
+
+    def update(self, result: CommandResult) -> Optional[Change]:
+        """ Account result to the state of its command, returning the change it caused if any """
+        if result.cancelled or result.skipped:
+            return None
+        if (state := self._states.get(result.command)) is None:
+            state = self._states[result.command] = _State()
+        ok = bool(result)
+        differs = ok != state.outcomes & 1
+        state.outcomes = ((state.outcomes << 1) | ok) & ((1 << FLAP_RUNS) - 1)
+        state.runs += 1
+        if state.ok is None:
+            state.ok = ok
+            return self._change(result, ok, None) if self.report_initial else None
+        # only a run that differs from the one before can start flapping
+        if not state.flapping and differs and state.flap_ratio() > self.flap_high:
+            state.flapping = True
+            state.streak = 0
+            return self._change(result, state.ok, state.ok, flapping=True)
+        if state.flapping:
+            if state.flap_ratio() >= self.flap_low:
+                return None
+            state.flapping = False
+            if ok == state.ok:
+                return None
+            previous, state.ok = state.ok, ok
+            return self._change(result, ok, previous)
+        if ok == state.ok:
+            state.streak = 0
+            return None
+        state.streak += 1
+        if state.streak < (self.rise if ok else self.fall):
+            return None
+        state.streak = 0
+        previous, state.ok = state.ok, ok
+        return self._change(result, ok, previous)
+
+    @staticmethod
+    def _change(result: CommandResult, ok: bool, previous: Optional[bool], flapping: bool = False) -> Change:
+        return Change(result.command, ok, previous, result, time.time(), flapping)
+
+
+class ChangeStream(AsyncIterable[Change]):
+    """ Changes of the results fed to it, through a queue of at most maxsize changes. Feeding waits while the queue
+    is full, so a slow consumer slows down the producer instead of having the queue grow. """
+    tracker: StateTracker
+    _queue: Optional[asyncio.Queue[Optional[Change]]]
+
+    def __init__(self, tracker: Optional[StateTracker] = None, maxsize: int = 1024):
+        self.tracker = tracker or StateTracker()
+        self.maxsize = maxsize
+        self._queue = None
+
+    @property
+    def queue(self) -> asyncio.Queue[Optional[Change]]:
+        # created on first use, so within the loop that uses it
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.maxsize)
+        return self._queue
+
+    async def feed(self, results: Union[CommandResult, AsyncIterable[CommandResult], Iterable[CommandResult]]) -> int:
+        """ Update the tracker with results, a (command set) result or results, queueing the changes; returns the
+        number of changes """
+        changes = 0
+        if isinstance(results, AsyncIterable):
+            async for result in results:
+                changes += await self._put(result)
+        elif isinstance(results, CommandResult):
+            changes += await self._put(results)
+        else:
+            for result in results:
+                changes += await self._put(result)
+        return changes
+
+    async def _put(self, result: CommandResult) -> int:
+        if (change := self.tracker.update(result)) is None:
+            return 0
+        await self.queue.put(change)
+        return 1
+
+    async def close(self) -> None:
+        """ End the iteration of the consumer, once it took the changes queued before """
+        await self.queue.put(None)
+
+    async def __aiter__(self) -> AsyncIterator[Change]:
+        while (change := await self.queue.get()) is not None:
+            yield change
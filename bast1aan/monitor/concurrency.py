@@ -0,0 +1,81 @@
+""" Concurrency limits shared by all commands in a (nested) command tree """
+from __future__ import annotations
+
+import asyncio
+from contextlib import asynccontextmanager, AsyncExitStack
+from contextvars import ContextVar
+from typing import Optional, Hashable, AsyncIterator, Union, Mapping, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from bast1aan.monitor.base import Command
+
+current: ContextVar[Optional[ConcurrencyLimit]] = ContextVar('current', default=None)
+
+
+class _KeyedSemaphores:
+    """ Semaphores per key, created on first use and dropped again when nobody holds or waits for them """
+    def __init__(self, limit: int):
+        self._limit = limit
+        self._semaphores: dict[Hashable, tuple[asyncio.Semaphore, int]] = {}
+
+    @asynccontextmanager
+    async def acquire(self, key: Hashable) -> AsyncIterator[None]:
+        semaphore, users = self._semaphores.get(key, (None, 0))
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self._limit)
+        self._semaphores[key] = (semaphore, users + 1)
+        try:
+            async with semaphore:
+                yield
+        finally:
+            semaphore, users = self._semaphores[key]
+            if users == 1:
+                del self._semaphores[key]
+            else:
+                self._semaphores[key] = (semaphore, users - 1)
+
+    def __len__(self) -> int:
+        return len(self._semaphores)
+
+
+class ConcurrencyLimit:
+    """ Caps the number of commands running at once: in total, per target (the `target` attribute of a
+    command, if it has one) and per command class. A class limit may be given as one number for every class,
+    or as a mapping from class to number; classes not in the mapping are not limited. """
+    total: Optional[int]
+    per_target: Optional[int]
+    per_class: Union[int, Mapping[type, int], None]
+
+    def __init__(self, total: Optional[int] = None, *, per_target: Optional[int] = None,
+                 per_class: Union[int, Mapping[type, int], None] = None):
+        self.total = total
+        self.per_target = per_target
+        self.per_class = per_class
+        self._total: Optional[asyncio.Semaphore] = None
+        self._targets = _KeyedSemaphores(per_target) if per_target else None
+        self._classes: dict[type, asyncio.Semaphore] = {}
+
+    def _class_semaphore(self, cls: type) -> Optional[asyncio.Semaphore]:
+        if self.per_class is None:
+            return None
+        if (semaphore := self._classes.get(cls)) is None:
+            limit = self.per_class if isinstance(self.per_class, int) else self.per_class.get(cls)
+            if limit is None:
+                return None
+            semaphore = self._classes[cls] = asyncio.Semaphore(limit)
+        return semaphore
+
+    @asynccontextmanager
+    async def slot(self, command: Command) -> AsyncIterator[None]:
+        async with AsyncExitStack() as stack:
+            # narrowest limits first, so no global slot is held while waiting for a busy target
+            if self._targets is not None and (target := getattr(command, 'target', None)) is not None:
+                await stack.enter_async_context(self._targets.acquire(target))
+            if (semaphore := self._class_semaphore(type(command))) is not None:
+                await stack.enter_async_context(semaphore)
+            if self.total:
+                if self._total is None:
+                    # created on first use, as semaphores bind to the running loop on Python < 3.10
+                    self._total = asyncio.Semaphore(self.total)
+                await stack.enter_async_context(self._total)
+            yield
@@ -0,0 +1,193 @@
+""" Running commands as a dependency graph, where every node runs as soon as the nodes it depends on allow it """
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass
+from typing import Optional, Callable, Hashable, Iterable, Sequence, AsyncIterator
+
+from bast1aan.monitor.base import AsyncCommand, CommandResult, CommandSetResult, CommandSet, DependingCommandSet, \
+    ALL_SUCCEED, _SkippedResult, _Scope, _Cancellation
+from bast1aan.monitor.concurrency import ConcurrencyLimit
+from bast1aan.monitor.ratelimit import RateLimiter
+from bast1aan.monitor.retention import Retention
+from bast1aan.monitor.singleflight import SingleFlight
+
+
+@dataclass(eq=False)
+class Node:
+    """ Command of a graph, run after its upstream nodes when runs_if allows it given their results """
+    name: Hashable
+    command: AsyncCommand
+    upstream: tuple[Hashable, ...] = ()
+    runs_if: Callable[[Sequence[CommandResult]], bool] = ALL_SUCCEED
+
+
+class Graph(AsyncCommand[CommandSetResult]):
+    """ Runs its nodes in topological order, every node as soon as its upstream nodes are done, so independent
+    nodes run at the same time. A node whose upstream results do not satisfy its runs_if is skipped, and so is
+    everything downstream of it, as far as skipped results do not satisfy those nodes either (by default every
+    upstream node has to succeed). Skipped nodes are reported as skipped results.
+
+    The results are the results of the nodes in order of completion, nested command sets walked. """
+    nodes: dict[Hashable, Node]
+    _succeeds_if: Callable[[Iterable], bool]
+    _concurrency: Optional[ConcurrencyLimit]
+    _single_flight: Optional[SingleFlight]
+    _rate_limiter: Optional[RateLimiter]
+    _retention: Optional[Retention]
+    _limited = False
+    def __init__(self, *, succeeds_if: Callable[[Iterable], bool] = ALL_SUCCEED,
+                 concurrency: Optional[ConcurrencyLimit] = None, timeout: Optional[float] = None,
+                 single_flight: Optional[SingleFlight] = None, rate_limiter: Optional[RateLimiter] = None,
+                 retention: Optional[Retention] = None):
+        self.nodes = {}
+        self._succeeds_if = succeeds_if
+        self._concurrency = concurrency
+        self.timeout = timeout
+        self._single_flight = single_flight
+        self._rate_limiter = rate_limiter
+        self._retention = retention
+
+    def add(self, name: Hashable, command: AsyncCommand, *, after: Iterable[Hashable] = (),
+            runs_if: Callable[[Sequence[CommandResult]], bool] = ALL_SUCCEED) -> Node:
+        """ Add command as node name, depending on the nodes named in after, which may be added later """
+        if name in self.nodes:
+            raise ValueError(f'Node already exists: {name!r}')
+        node = self.nodes[name] = Node(name, command, tuple(after), runs_if)
+        return node
+
+    @classmethod
+    def compile(cls, command: AsyncCommand, *, concurrency: Optional[ConcurrencyLimit] = None,
+                timeout: Optional[float] = None, single_flight: Optional[SingleFlight] = None,
+                rate_limiter: Optional[RateLimiter] = None, retention: Optional[Retention] = None) -> Graph:
+        """ Graph running a tree of CommandSets and DependingCommandSets: the commands of a set run at the same
+        time, the branches of a DependingCommandSet after every command of its first command. Only the settings
+        passed here apply, those of the sets in the tree are not compiled. """
+        graph = cls(concurrency=concurrency, timeout=timeout, single_flight=single_flight, rate_limiter=rate_limiter,
+                    retention=retention)
+        _, succeeds_if = graph._compile(command, (), ALL_SUCCEED, {})
+        graph._succeeds_if = lambda results: succeeds_if([result for result in results if not result.skipped])
+        return graph
+
+    def _compile(self, command: AsyncCommand, upstream: tuple[Hashable, ...],
+                 runs_if: Callable[[Sequence[CommandResult]], bool], compiled: dict[tuple, Hashable]
+                 ) -> tuple[tuple[Hashable, ...], Callable[[Iterable], bool]]:
+        """ Add the nodes of command, returning their names and what the results of them have to satisfy. Equal
+        commands after the same nodes, on the same condition, are compiled into one node, so they run once. """
+        if isinstance(command, CommandSet):
+            names: dict[Hashable, None] = {}
+            for child in command.commands:
+                if not isinstance(child, AsyncCommand):
+                    raise TypeError(f'Only asynchronous commands can be compiled: {child}')
+                names.update(dict.fromkeys(self._compile(child, upstream, runs_if, compiled)[0]))
+            return tuple(names), command._succeeds_if
+        if isinstance(command, DependingCommandSet):
+            first, first_succeeds_if = self._compile(command.first_command, upstream, runs_if, compiled)
+            names = dict.fromkeys(first)
+            if command.if_succeeds is not None:
+                names.update(dict.fromkeys(self._compile(command.if_succeeds, first, _Ran(first_succeeds_if),
+                                                         compiled)[0]))
+            if command.if_fails is not None:
+                names.update(dict.fromkeys(self._compile(command.if_fails, first, _Ran(first_succeeds_if, fails=True),
+                                                         compiled)[0]))
+            return tuple(names), command.succeeds_if
+        key = (command, upstream, runs_if)
+        if (name := compiled.get(key)) is None:
+            name = compiled[key] = len(self.nodes)
+            self.add(name, command, after=upstream, runs_if=runs_if)
+        return (name,), ALL_SUCCEED
+
+    def order(self) -> list[Node]:
+        """ The nodes in topological order; raises ValueError for unknown upstream nodes and cycles """
+        downstream = self._downstream()
+        waiting = {name: len(node.upstream) for name, node in self.nodes.items()}
+        order = [node for node in self.nodes.values() if not node.upstream]
+        for node in order:
+            for name in downstream[node.name]:
+                waiting[name] -= 1
+                if not waiting[name]:
+                    order.append(self.nodes[name])
+        if len(order) < len(self.nodes):
+            raise ValueError(f'Graph has a cycle through: {[name for name, n in waiting.items() if n]!r}')
+        return order
+
+    def _downstream(self) -> dict[Hashable, list[Hashable]]:
+        downstream: dict[Hashable, list[Hashable]] = {name: [] for name in self.nodes}
+        for node in self.nodes.values():
+            for name in node.upstream:
+                if name not in downstream:
+                    raise ValueError(f'Unknown upstream node of {node.name!r}: {name!r}')
+                downstream[name].append(node.name)
+        return downstream
+
+    async def run(self) -> CommandSetResult:
+        self.order()
+        cancellation = _Cancellation()
+        scope = _Scope.of(self, self._concurrency, self._single_flight, self._rate_limiter, self._retention)
+        return CommandSetResult(
+            command=self,
+            iterator=scope.walk(self, self._walk(scope, cancellation)),
+            succeeds_if=self._succeeds_if,
+            _cancellation=cancellation,
+        )
+
+    def __str__(self) -> str:
+        return '\n'.join((str(node.command) for node in self.nodes.values()))
+
+    def __hash__(self) -> int:
+        return id(self)
+
+    async def _walk(self, scope: _Scope, cancellation: _Cancellation) -> AsyncIterator[CommandResult]:
+        downstream = self._downstream()
+        waiting = {name: len(node.upstream) for name, node in self.nodes.items()}
+        results: dict[Hashable, CommandResult] = {}
+        done: asyncio.Queue[asyncio.Task] = asyncio.Queue()
+
+        async def run(node: Node) -> tuple[Node, CommandResult, list[CommandResult]]:
+            result = await cancellation.run(node.command, scope)
+            return node, result, [subresult async for subresult in cancellation.walk(result)]
+
+        tasks = set()
+
+        def start(node: Node) -> None:
+            tasks.add(task := asyncio.ensure_future(run(node)))
+            task.add_done_callback(done.put_nowait)
+
+        for node in self.nodes.values():
+            if not node.upstream:
+                start(node)
+        try:
+            while tasks:
+                task = await done.get()
+                tasks.discard(task)
+                finished = [task.result()]
+                while finished:
+                    node, result, subresults = finished.pop()
+                    results[node.name] = result
+                    for subresult in subresults:
+                        yield subresult
+                    for name in downstream[node.name]:
+                        waiting[name] -= 1
+                        if waiting[name]:
+                            continue
+                        ready = self.nodes[name]
+                        if ready.runs_if([results[upstream] for upstream in ready.upstream]):
+                            start(ready)
+                        else:
+                            skipped = _SkippedResult(ready.command)
+                            finished.append((ready, skipped, [skipped]))
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+@dataclass(frozen=True)
+class _Ran:
+    """ runs_if satisfied when the results that were not skipped satisfy succeeds_if, or with fails do not; there
+    has to be one. Equal for equal conditions, so equal commands on them compile into one node. """
+    succeeds_if: Callable[[Iterable], bool]
+    fails: bool = False
+
+    def __call__(self, results: Sequence[CommandResult]) -> bool:
+        ran = [result for result in results if not result.skipped]
+        return bool(ran) and bool(self.succeeds_if(ran)) != self.fails
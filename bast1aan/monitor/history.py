@@ -0,0 +1,257 @@
+""" Compact history of command results: ring buffers of typed columns, optionally in memory-mapped files """
+from __future__ import annotations
+
+import hashlib
+import math
+import mmap
+import os
+import struct
+import time
+from bisect import bisect_left
+from collections import Counter
+from typing import Optional, Union, Sequence, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from bast1aan.monitor.base import Command, CommandResult
+    from bast1aan.monitor.metrics import Span
+
+_MAGIC = b'BMHIST01'
+# magic, capacity, samples appended in total
+_HEADER = struct.Struct('<8sQQ')
+_HEADER_SIZE = 64
+
+# latencies are also kept as the index of a logarithmic bucket in one byte, for quantiles without sorting
+_BUCKET_MIN = 1e-6
+_BUCKET_RATIO = 1.1
+_BUCKET_LOG = math.log(_BUCKET_RATIO)
+
+DURATION = 'duration'
+RTT = 'rtt'
+
+
+def _bucket(value: float) -> int:
+    """ 0 for no value, otherwise 1 to 255: bucket b above 1 holds values up to _BUCKET_MIN * _BUCKET_RATIO ** (b - 1) """
+    if value != value:
+        return 0
+    if value <= _BUCKET_MIN:
+        return 1
+    return min(255, 1 + math.ceil(math.log(value / _BUCKET_MIN) / _BUCKET_LOG - 1e-9))
+
+
+def _bucket_value(bucket: int) -> float:
+    """ Geometric middle of bucket, within half a bucket of everything in it """
+    return _BUCKET_MIN * _BUCKET_RATIO ** (bucket - 1.5) if bucket > 1 else _BUCKET_MIN
+
+
+class _Chronological(Sequence[float]):
+    """ Column of a ring buffer indexed from the oldest sample on, for bisecting """
+    def __init__(self, history: History, column: memoryview[float]):
+        self._history = history
+        self._column = column
+
+    def __len__(self) -> int:
+        return len(self._history)
+
+    def __getitem__(self, index):  # type: ignore[no-untyped-def, override]
+        return self._column[self._history._physical(index)]
+
+
+class History:
+    """ The last `capacity` samples of one command: time (seconds since the epoch), ok, duration and round trip
+    time (both in seconds, NaN when unknown), each in a typed column of a ring buffer. With a path, the buffer is a
+    memory-mapped file that is created when missing and survives restarts.
+
+    Samples are expected to be appended in chronological order. Queries run over the raw columns: no Python
+    object is created per sample. Quantiles come from logarithmic buckets kept next to the latencies and are
+    within 5% of the exact value. """
+    capacity: int
+    path: Optional[str]
+
+    def __init__(self, capacity: int = 100000, path: Optional[str] = None):
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1')
+        self.capacity = capacity
+        self.path = path
+        size = _HEADER_SIZE + capacity * (3 * 8 + 3)
+        self._buffer: Union[mmap.mmap, bytearray]
+        if path is None:
+            self._buffer = bytearray(size)
+            _HEADER.pack_into(self._buffer, 0, _MAGIC, capacity, 0)
+        else:
+            self._buffer = self._map(path, size)
+        view = memoryview(self._buffer)
+        offset = _HEADER_SIZE
+        self._times = view[offset:offset + 8 * capacity].cast('d')
+        offset += 8 * capacity
+        self._durations = view[offset:offset + 8 * capacity].cast('d')
+        offset += 8 * capacity
+        self._rtts = view[offset:offset + 8 * capacity].cast('d')
+        offset += 8 * capacity
+        self._ok = view[offset:offset + capacity]
+        self._duration_buckets = view[offset + capacity:offset + 2 * capacity]
+        self._rtt_buckets = view[offset + 2 * capacity:offset + 3 * capacity]
+        self._appended = _HEADER.unpack_from(self._buffer, 0)[2]
+
+    def _map(self, path: str, size: int) -> mmap.mmap:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            existing = os.fstat(fd).st_size
+            if existing == 0:
+                os.ftruncate(fd, size)
+                os.pwrite(fd, _HEADER.pack(_MAGIC, self.capacity, 0), 0)
+            else:
+                magic, capacity, _ = _HEADER.unpack(os.pread(fd, _HEADER.size, 0))
+                if magic != _MAGIC or existing != size or capacity != self.capacity:
+                    raise ValueError(f'{path} is no history of capacity {self.capacity}')
+            return mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+    def __len__(self) -> int:
+        return min(self._appended, self.capacity)
+
+    @property
+    def appended(self) -> int:
+        """ Number of samples appended in total, including the ones overwritten since """
+        return self._appended
+
+    def append(self, ok: bool, duration: Optional[float] = None, rtt: Optional[float] = None,
+               at: Optional[float] = None) -> None:
+        index = self._appended % self.capacity
+        self._times[index] = time.time() if at is None else at
+        self._ok[index] = 1 if ok else 0
+        self._durations[index] = math.nan if duration is None else duration
+        self._duration_buckets[index] = 0 if duration is None else _bucket(duration)
+        self._rtts[index] = math.nan if rtt is None else rtt
+        self._rtt_buckets[index] = 0 if rtt is None else _bucket(rtt)
+        self._appended += 1
+        _HEADER.pack_into(self._buffer, 0, _MAGIC, self.capacity, self._appended)
+
+    def record(self, result: CommandResult, duration: Optional[float] = None, at: Optional[float] = None) -> None:
+        """ Append result, with its average round trip time when it has one, like a PingResult """
+        rtt = getattr(result, 'rtt_avg', None)
+        self.append(bool(result), duration, None if rtt is None else rtt / 1000, at)
+
+    def _physical(self, index: int) -> int:
+        """ Position in the columns of the index-th oldest sample """
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return (self._appended - len(self) + index) % self.capacity
+
+    def _range(self, since: Optional[float], until: Optional[float]) -> tuple[int, int]:
+        """ Indexes from the oldest sample on of the samples from since up to until """
+        times = _Chronological(self, self._times)
+        start = 0 if since is None else bisect_left(times, since)
+        end = len(self) if until is None else bisect_left(times, until)
+        return start, end
+
+    def _segments(self, column: memoryview, since: Optional[float], until: Optional[float]) -> list[memoryview]:
+        """ The parts of column with the samples from since up to until, oldest first """
+        return self._segments_between(column, *self._range(since, until))
+
+    def _segments_between(self, column: memoryview, start: int, end: int) -> list[memoryview]:
+        if start >= end:
+            return []
+        first, last = self._physical(start), self._physical(end - 1) + 1
+        if first < last:
+            return [column[first:last]]
+        return [column[first:], column[:last]]
+
+    def count(self, since: Optional[float] = None, until: Optional[float] = None) -> int:
+        start, end = self._range(since, until)
+        return max(0, end - start)
+
+    def availability(self, since: Optional[float] = None, until: Optional[float] = None) -> Optional[float]:
+        """ Fraction of the samples from since up to until that were ok, None without samples """
+        segments = self._segments(self._ok, since, until)
+        total = sum(len(segment) for segment in segments)
+        if not total:
+            return None
+        return sum(segment.tobytes().count(1) for segment in segments) / total
+
+    def quantile(self, q: float, column: str = DURATION, since: Optional[float] = None,
+                 until: Optional[float] = None) -> Optional[float]:
+        """ q-quantile (0.99 for p99) of the durations or round trip times from since up to until, None without
+        any """
+        buckets = self._duration_buckets if column == DURATION else self._rtt_buckets
+        counts: Counter[int] = Counter()
+        for segment in self._segments(buckets, since, until):
+            # iterating bytes yields the small ints Python keeps cached, so this counts without allocating
+            counts.update(segment.tobytes())
+        del counts[0]
+        if not (total := sum(counts.values())):
+            return None
+        rank = q * total
+        seen = 0
+        for bucket in sorted(counts):
+            seen += counts[bucket]
+            if seen >= rank:
+                return _bucket_value(bucket)
+        return _bucket_value(max(counts))
+
+    def state_changes(self, since: Optional[float] = None, until: Optional[float] = None) -> list[float]:
+        """ Times of the samples from since up to until whose ok differs from the sample before, which may be
+        from before since """
+        start, end = self._range(since, until)
+        start = max(0, start - 1)
+        ok = b''.join(segment.tobytes() for segment in self._segments_between(self._ok, start, end))
+        if len(ok) < 2:
+            return []
+        # ok flags are 0 or 1 per byte, so xor of the flags and the flags shifted by one marks every change
+        changed = (int.from_bytes(ok[:-1], 'little') ^ int.from_bytes(ok[1:], 'little')).to_bytes(len(ok) - 1, 'little')
+        times = _Chronological(self, self._times)
+        changes = []
+        index = changed.find(1)
+        while index >= 0:
+            changes.append(times[start + index + 1])
+            index = changed.find(1, index + 1)
+        return changes
+
+    def flush(self) -> None:
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.flush()
+
+    def close(self) -> None:
+        for view in (self._times, self._durations, self._rtts, self._ok, self._duration_buckets, self._rtt_buckets):
+            view.release()
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+
+
+class HistoryStore:
+    """ A History per command, in `directory` when given, in a file named after str() of the command """
+    capacity: int
+    directory: Optional[str]
+    _histories: dict[Command, History]
+
+    def __init__(self, capacity: int = 100000, directory: Optional[str] = None):
+        self.capacity = capacity
+        self.directory = directory
+        self._histories = {}
+
+    def __getitem__(self, command: Command) -> History:
+        if (history := self._histories.get(command)) is None:
+            path = None
+            if self.directory is not None:
+                name = hashlib.sha1(str(command).encode()).hexdigest()
+                path = os.path.join(self.directory, f'{name}.history')
+            history = self._histories[command] = History(self.capacity, path)
+        return history
+
+    def __contains__(self, command: Command) -> bool:
+        return command in self._histories
+
+    def record(self, result: CommandResult, duration: Optional[float] = None) -> None:
+        self[result.command].record(result, duration)
+
+    def record_span(self, span: Span) -> None:
+        """ For Metrics(on_span=...): record every command run that returned a result """
+        if span.result is not None:
+            self[span.command].record(span.result, span.duration)
+
+    def close(self) -> None:
+        for history in self._histories.values():
+            history.close()
+        self._histories.clear()
@@ -0,0 +1,323 @@
+""" HTTP(S) checks over asyncio streams, keeping connections alive between checks and resuming TLS sessions """
+from __future__ import annotations
+
+import asyncio
+import ssl
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Literal, Optional, ClassVar, Union
+from urllib.parse import urlsplit
+
+from bast1aan.monitor._util import frozen_dataclass
+from bast1aan.monitor.base import AsyncCommand, CommandResult, Command, _within_deadline, _deadline_for
+from bast1aan.monitor.resolver import Resolver
+from bast1aan.monitor.retention import Retention
+from bast1aan.monitor.tcp import Connection, connect, _reason
+
+_DEFAULT_PORTS = {'http': 80, 'https': 443}
+_CHUNK = 65536
+# errors of a request and its response that fail the check, rather than the run
+_EXCHANGE_ERRORS = (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError)
+
+# scheme, host, port, whether the certificate is verified and the IP version it is limited to, if any
+_Key = tuple[str, str, int, bool, int]
+
+
+class _ResumingContext(ssl.SSLContext):
+    """ Client context offering the last session of a host when connecting to it again, which saves a full
+    handshake when the server accepts it """
+    sessions: dict[str, ssl.SSLSession]
+    max_sessions = 10000
+
+    def wrap_bio(self, incoming: ssl.MemoryBIO, outgoing: ssl.MemoryBIO, server_side: bool = False,
+                 server_hostname: Union[str, bytes, None] = None, session: Optional[ssl.SSLSession] = None
+                 ) -> ssl.SSLObject:
+        if session is None and isinstance(server_hostname, str):
+            session = self.sessions.get(server_hostname)
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+    def keep(self, server_hostname: str, ssl_object: Optional[ssl.SSLObject]) -> None:
+        if ssl_object is None or ssl_object.session is None:
+            return
+        self.sessions.pop(server_hostname, None)
+        self.sessions[server_hostname] = ssl_object.session
+        while len(self.sessions) > self.max_sessions:
+            del self.sessions[next(iter(self.sessions))]
+
+
+@dataclass(eq=False)
+class _Pooled:
+    connection: Connection
+    idle_since: float = 0.0
+
+
+class ConnectionPool:
+    """ Keeps at most max_idle idle connections per scheme, host and port, for idle_timeout seconds. Connections
+    belong to the loop they were made on, so they are kept per loop. New TLS connections resume the session of
+    the last connection to the same host. """
+    max_idle: int
+    idle_timeout: float
+    _idle: dict[asyncio.AbstractEventLoop, dict[_Key, deque[_Pooled]]]
+    _contexts: dict[bool, _ResumingContext]
+
+    def __init__(self, max_idle: int = 4, idle_timeout: float = 30.0):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._contexts = {}
+
+    def __len__(self) -> int:
+        """ Number of idle connections """
+        return sum(len(idle) for connections in self._idle.values() for idle in connections.values())
+
+    def context(self, verify: bool = True) -> _ResumingContext:
+        if (context := self._contexts.get(verify)) is None:
+            context = self._contexts[verify] = _ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.sessions = {}
+            if verify:
+                context.load_default_certs()
+            else:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+        return context
+
+    def acquire(self, key: _Key) -> Optional[Connection]:
+        """ An idle connection for key that the server did not close, if any """
+        loop = asyncio.get_running_loop()
+        for closed in [other for other in self._idle if other.is_closed()]:
+            del self._idle[closed]
+        idle = self._idle.get(loop, {}).get(key)
+        now = time.monotonic()
+        while idle:
+            pooled = idle.pop()
+            if now - pooled.idle_since < self.idle_timeout and not pooled.connection.reader.at_eof():
+                return pooled.connection
+            pooled.connection.close()
+        return None
+
+    def release(self, key: _Key, connection: Connection) -> None:
+        """ Keep connection for a next request, closing the one idle longest when there are too many """
+        idle = self._idle.setdefault(asyncio.get_running_loop(), {}).setdefault(key, deque())
+        idle.append(_Pooled(connection, time.monotonic()))
+        while len(idle) > self.max_idle:
+            idle.popleft().connection.close()
+
+    def clear(self) -> None:
+        """ Close the idle connections of the running loop and forget those of other loops """
+        connections = self._idle.pop(asyncio.get_running_loop(), {})
+        self._idle.clear()
+        for idle in connections.values():
+            for pooled in idle:
+                pooled.connection.close()
+
+
+class HttpResult(CommandResult):
+    """ Result of an HttpCommand, times in seconds: connect is None when a kept-alive connection was reused,
+    first_byte is the time until the status line was received and total the time until the body was. Body is
+    at most max_body bytes of the body. """
+    __slots__ = ('ok', 'command', 'status', 'reason', 'headers', 'body', 'message', 'address', 'resolution',
+                 'connect', 'first_byte', 'total', 'reused', 'tls_resumed')
+    ok: bool
+    command: Command
+    status: Optional[int]
+    reason: str
+    headers: tuple[tuple[str, str], ...]
+    body: bytes
+    message: str
+    address: Optional[str]
+    resolution: Optional[float]
+    connect: Optional[float]
+    first_byte: Optional[float]
+    total: Optional[float]
+    reused: bool
+    tls_resumed: Optional[bool]
+
+    def __init__(self, ok: bool, command: Command, status: Optional[int] = None, reason: str = '',
+                 headers: tuple[tuple[str, str], ...] = (), body: bytes = b'', message: str = '',
+                 address: Optional[str] = None, resolution: Optional[float] = None, connect: Optional[float] = None,
+                 first_byte: Optional[float] = None, total: Optional[float] = None, reused: bool = False,
+                 tls_resumed: Optional[bool] = None):
+        self.ok = ok
+        self.command = command
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.message = message
+        self.address = address
+        self.resolution = resolution
+        self.connect = connect
+        self.first_byte = first_byte
+        self.total = total
+        self.reused = reused
+        self.tls_resumed = tls_resumed
+
+    def __bool__(self) -> bool:
+        return self.ok
+
+    def __str__(self) -> str:
+        if self.status is None:
+            return self.message
+        assert self.total is not None
+        return f'{self.command}: {self.status} {self.reason} in {self.total * 1000:.1f} ms'
+
+    def retain(self, retention: Retention) -> None:
+        self.body = retention.apply(self.ok, self.body)
+
+    def header(self, name: str) -> Optional[str]:
+        name = name.lower()
+        return next((value for key, value in self.headers if key.lower() == name), None)
+
+
+class _Response:
+    """ Response as read from a connection, and whether the connection can be used for a next request """
+    def __init__(self) -> None:
+        self.version = ''
+        self.status = 0
+        self.reason = ''
+        self.headers: list[tuple[str, str]] = []
+        self.body = bytearray()
+        self.first_byte = 0.0
+        self.keep_alive = False
+
+
+@frozen_dataclass(eq=True)
+class HttpCommand(AsyncCommand):
+    """ Requests url over HTTP/1.1, succeeding on the expected status, or any status below 400 when expect is
+    None. Connections are kept alive in the pool of the class. """
+    url: str
+    method: str = 'GET'
+    expect: Optional[int] = None
+    headers: tuple[tuple[str, str], ...] = ()
+    verify: bool = True
+    max_body: int = 65536
+    only: Literal[0, 4, 6] = 0
+    timeout: Optional[float] = None
+    _keeps_deadline = True
+    pool: ClassVar[ConnectionPool] = ConnectionPool()
+    resolver: ClassVar[Optional[Resolver]] = Resolver()
+
+    @property
+    def target(self) -> str:
+        return urlsplit(self.url).hostname or ''
+
+    def _key(self) -> _Key:
+        parts = urlsplit(self.url)
+        return parts.scheme, parts.hostname or '', parts.port or _DEFAULT_PORTS[parts.scheme], self.verify, self.only
+
+    def _request(self) -> bytes:
+        parts = urlsplit(self.url)
+        path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        lines = [f'{self.method} {path} HTTP/1.1', f'Host: {parts.netloc.rpartition("@")[2]}']
+        names = {name.lower() for name, _ in self.headers}
+        if 'user-agent' not in names:
+            lines.append('User-Agent: bast1aan-monitor')
+        lines += [f'{name}: {value}' for name, value in self.headers]
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    async def run(self) -> CommandResult:
+        return await _within_deadline(self, self._check(), _deadline_for(self))
+
+    async def _check(self) -> HttpResult:
+        key = self._key()
+        scheme, hostname, port, verify, _ = key
+        context = self.pool.context(verify) if scheme == 'https' else None
+        started = time.perf_counter()
+        # a kept-alive connection may have been closed by the server meanwhile, then try a new one
+        while (connection := self.pool.acquire(key)) is not None:
+            try:
+                response = await self._exchange(connection, started)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                connection.close()
+                continue
+            except _EXCHANGE_ERRORS as e:
+                return self._failed(connection, e, reused=True)
+            except BaseException:
+                connection.close()
+                raise
+            return self._result(key, connection, response, started, reused=True)
+        try:
+            connection = await connect(hostname, port, self.only, self.resolver, context)
+        except OSError as e:
+            return HttpResult(False, self, message=f'{self}: {_reason(e)}')
+        try:
+            response = await self._exchange(connection, started)
+        except _EXCHANGE_ERRORS as e:
+            return self._failed(connection, e, reused=False)
+        except BaseException:
+            connection.close()
+            raise
+        return self._result(key, connection, response, started, reused=False)
+
+    def _failed(self, connection: Connection, error: Exception, reused: bool) -> HttpResult:
+        connection.close()
+        return HttpResult(False, self, message=f'{self}: {error}', address=connection.address,
+                          resolution=None if reused else connection.resolution,
+                          connect=None if reused else connection.connect, reused=reused)
+
+    def _result(self, key: _Key, connection: Connection, response: _Response, started: float,
+                reused: bool) -> HttpResult:
+        ssl_object = connection.writer.get_extra_info('ssl_object')
+        if ssl_object is not None:
+            self.pool.context(self.verify).keep(key[1], ssl_object)
+        if response.keep_alive:
+            self.pool.release(key, connection)
+        else:
+            connection.close()
+        ok = response.status < 400 if self.expect is None else response.status == self.expect
+        return HttpResult(
+            ok, self, response.status, response.reason, tuple(response.headers), bytes(response.body),
+            address=connection.address,
+            resolution=None if reused else connection.resolution,
+            connect=None if reused else connection.connect,
+            first_byte=response.first_byte,
+            total=time.perf_counter() - started,
+            reused=reused,
+            tls_resumed=None if ssl_object is None else ssl_object.session_reused,
+        )
+
+    async def _exchange(self, connection: Connection, started: float) -> _Response:
+        reader, writer = connection.reader, connection.writer
+        writer.write(self._request())
+        await writer.drain()
+        response = _Response()
+        status_line = await reader.readuntil(b'\r\n')
+        response.first_byte = time.perf_counter() - started
+        response.version, status, response.reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        response.status = int(status)
+        while (line := await reader.readuntil(b'\r\n')) != b'\r\n':
+            name, _, value = line.decode('latin-1').partition(':')
+            response.headers.append((name.strip(), value.strip()))
+        headers = {name.lower(): value.lower() for name, value in response.headers}
+        tokens = {token.strip() for token in headers.get('connection', '').split(',')}
+        response.keep_alive = 'close' not in tokens if response.version == 'HTTP/1.1' else 'keep-alive' in tokens
+        if self.method == 'HEAD' or response.status in (204, 304) or 100 <= response.status < 200:
+            return response
+        if headers.get('transfer-encoding', '').endswith('chunked'):
+            while size := int((await reader.readuntil(b'\r\n')).split(b';')[0], 16):
+                await self._read_body(reader, response, size)
+                await reader.readexactly(2)
+            while await reader.readuntil(b'\r\n') != b'\r\n':
+                pass
+        elif 'content-length' in headers:
+            await self._read_body(reader, response, int(headers['content-length']))
+        else:
+            # the body ends when the connection does
+            await self._read_body(reader, response, None)
+            response.keep_alive = False
+        return response
+
+    async def _read_body(self, reader: asyncio.StreamReader, response: _Response, size: Optional[int]) -> None:
+        """ Read size bytes, or up to the end of the stream when None, keeping what fits in max_body """
+        while size is None or size > 0:
+            data = await (reader.read(_CHUNK) if size is None else reader.readexactly(min(size, _CHUNK)))
+            if not data:
+                return
+            if size is not None:
+                size -= len(data)
+            if (room := self.max_body - len(response.body)) > 0:
+                response.body += data[:room]
+
+    def __str__(self) -> str:
+        return f'{self.method} {self.url}'
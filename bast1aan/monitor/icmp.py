@@ -0,0 +1,203 @@
+""" In-process ICMP/ICMPv6 echo engine, multiplexing all echo requests over one socket per address family """
+from __future__ import annotations
+
+import asyncio
+import os
+import socket
+import struct
+import weakref
+from dataclasses import dataclass, field
+from typing import Literal, Optional
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+ICMPV6_ECHO_REQUEST = 128
+ICMPV6_ECHO_REPLY = 129
+
+PAYLOAD_SIZE = 56
+REPLY_TIMEOUT = 10.0
+
+_HEADER = struct.Struct('!BBHHH')
+_engines: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, IcmpEngine] = weakref.WeakKeyDictionary()
+
+
+def checksum(data: bytes) -> int:
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+class _IcmpSocket:
+    """ One non-blocking ICMP socket. Datagram ICMP sockets are preferred, as they do not need privileges;
+    raw sockets are used when the kernel does not allow them (net.ipv4.ping_group_range). """
+    family: int
+    raw: bool
+    ident: int
+
+    def __init__(self, family: int, loop: asyncio.AbstractEventLoop):
+        proto = socket.IPPROTO_ICMP if family == socket.AF_INET else socket.IPPROTO_ICMPV6
+        try:
+            self._sock = socket.socket(family, socket.SOCK_DGRAM, proto)
+            self.raw = False
+        except PermissionError:
+            self._sock = socket.socket(family, socket.SOCK_RAW, proto)
+            self.raw = True
+        self._sock.setblocking(False)
+        self.family = family
+        # datagram sockets get their identifier overwritten by the kernel, which only delivers our own replies
+        self.ident = os.getpid() & 0xffff
+        self._loop = loop
+        self._sequence = 0
+        self._waiters: dict[int, asyncio.Future[float]] = {}
+        loop.add_reader(self._sock.fileno(), self._on_readable)
+
+    def _next_sequence(self) -> int:
+        for _ in range(0x10000):
+            self._sequence = (self._sequence + 1) & 0xffff
+            if self._sequence not in self._waiters:
+                return self._sequence
+        raise RuntimeError('No free ICMP sequence numbers')
+
+    def _packet(self, sequence: int) -> bytes:
+        echo_type = ICMP_ECHO_REQUEST if self.family == socket.AF_INET else ICMPV6_ECHO_REQUEST
+        payload = bytes(i & 0xff for i in range(PAYLOAD_SIZE))
+        header = _HEADER.pack(echo_type, 0, 0, self.ident, sequence)
+        if self.family == socket.AF_INET:
+            # the kernel computes ICMPv6 checksums itself, because they cover the IPv6 pseudo header
+            header = _HEADER.pack(echo_type, 0, checksum(header + payload), self.ident, sequence)
+        return header + payload
+
+    async def echo(self, sockaddr: tuple, timeout: float = REPLY_TIMEOUT) -> Optional[float]:
+        """ Send one echo request, return the round trip time in seconds or None when no reply arrived in time """
+        sequence = self._next_sequence()
+        waiter = self._waiters[sequence] = self._loop.create_future()
+        try:
+            sent = self._loop.time()
+            self._sock.sendto(self._packet(sequence), sockaddr)
+            received = await asyncio.wait_for(waiter, timeout)
+            return received - sent
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            del self._waiters[sequence]
+
+    def _on_readable(self) -> None:
+        while True:
+            try:
+                data = self._sock.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+            received = self._loop.time()
+            if self.raw and self.family == socket.AF_INET:
+                data = data[(data[0] & 0x0f) * 4:]
+            if len(data) < _HEADER.size:
+                continue
+            echo_type, _, _, ident, sequence = _HEADER.unpack_from(data)
+            if echo_type != (ICMP_ECHO_REPLY if self.family == socket.AF_INET else ICMPV6_ECHO_REPLY):
+                continue
+            if self.raw and ident != self.ident:
+                continue
+            waiter = self._waiters.get(sequence)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(received)
+
+    def close(self) -> None:
+        self._loop.remove_reader(self._sock.fileno())
+        self._sock.close()
+
+
+@dataclass
+class EchoStatistics:
+    target: str
+    address: str
+    transmitted: int = 0
+    rtts: list[Optional[float]] = field(default_factory=list)
+
+    @property
+    def received(self) -> int:
+        return sum(1 for rtt in self.rtts if rtt is not None)
+
+    def __bool__(self) -> bool:
+        return self.received > 0
+
+    def __str__(self) -> str:
+        """ Format like the iputils ping output, so results read the same for both engines """
+        name = self.address if self.target == self.address else f'{self.target} ({self.address})'
+        lines = [f'PING {name} {PAYLOAD_SIZE} data bytes']
+        for sequence, rtt in enumerate(self.rtts, 1):
+            if rtt is not None:
+                lines.append(f'{PAYLOAD_SIZE + 8} bytes from {name}: icmp_seq={sequence} time={rtt * 1000:.3f} ms')
+        loss = 100 - (self.received * 100 // self.transmitted) if self.transmitted else 100
+        lines += [
+            '',
+            f'--- {self.target} ping statistics ---',
+            f'{self.transmitted} packets transmitted, {self.received} received, {loss}% packet loss',
+        ]
+        if rtts := [rtt * 1000 for rtt in self.rtts if rtt is not None]:
+            avg = sum(rtts) / len(rtts)
+            mdev = (sum(rtt * rtt for rtt in rtts) / len(rtts) - avg * avg) ** 0.5
+            lines.append(f'rtt min/avg/max/mdev = {min(rtts):.3f}/{avg:.3f}/{max(rtts):.3f}/{mdev:.3f} ms')
+        return '\n'.join(lines)
+
+
+class IcmpEngine:
+    """ Echo engine for one event loop, sharing one socket per address family between all targets """
+    _loop: asyncio.AbstractEventLoop
+    _sockets: dict[int, _IcmpSocket]
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self._loop = loop or asyncio.get_running_loop()
+        self._sockets = {}
+
+    @classmethod
+    def get(cls) -> IcmpEngine:
+        loop = asyncio.get_running_loop()
+        if (engine := _engines.get(loop)) is None:
+            engine = _engines[loop] = cls(loop)
+        return engine
+
+    def socket(self, family: int) -> _IcmpSocket:
+        if (sock := self._sockets.get(family)) is None:
+            sock = self._sockets[family] = _IcmpSocket(family, self._loop)
+        return sock
+
+    async def resolve(self, target: str, only: Literal[0, 4, 6] = 0) -> tuple[int, tuple]:
+        family = {4: socket.AF_INET, 6: socket.AF_INET6}.get(only, socket.AF_UNSPEC)
+        infos = await self._loop.getaddrinfo(target, None, family=family, type=socket.SOCK_RAW)
+        family, _, _, _, sockaddr = infos[0]
+        return family, sockaddr
+
+    async def ping(self, target: str, count: int = 1, only: Literal[0, 4, 6] = 0, interval: float = 1.0,
+                   timeout: float = REPLY_TIMEOUT, *, address: Optional[tuple[int, tuple]] = None) -> EchoStatistics:
+        """ Ping target count times, interval seconds apart, at address: the (family, sockaddr) target has already
+        been resolved to, if given. Raises socket.gaierror when target does not resolve and OSError when the echo
+        request cannot be sent. """
+        family, sockaddr = address if address is not None else await self.resolve(target, only)
+        sock = self.socket(family)
+        statistics = EchoStatistics(target, sockaddr[0])
+        echoes = []
+        for i in range(count):
+            if i:
+                await asyncio.sleep(interval)
+            echoes.append(asyncio.ensure_future(sock.echo(sockaddr, timeout)))
+            statistics.transmitted += 1
+            await asyncio.sleep(0)
+        try:
+            statistics.rtts = list(await asyncio.gather(*echoes))
+        except BaseException:
+            for echo in echoes:
+                echo.cancel()
+            raise
+        return statistics
+
+    def close(self) -> None:
+        for sock in self._sockets.values():
+            sock.close()
+        self._sockets.clear()
+        if _engines.get(self._loop) is self:
+            del _engines[self._loop]
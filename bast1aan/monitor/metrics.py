@@ -0,0 +1,221 @@
+""" Metrics and tracing of command runs, with an HTTP endpoint in the Prometheus text exposition format """
+from __future__ import annotations
+
+import asyncio
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Optional, Callable, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from bast1aan.monitor.base import Command, CommandResult
+
+# span of the command running in this context, only set while metrics are installed
+current: ContextVar[Optional[Span]] = ContextVar('current', default=None)
+
+# installed metrics; while None, runs are not measured at all
+_installed: Optional[Metrics] = None
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+OK = 'ok'
+ERROR = 'error'
+CANCELLED = 'cancelled'
+TIMED_OUT = 'timed_out'
+EXCEPTION = 'exception'
+
+
+def install(metrics: Optional[Metrics]) -> None:
+    """ Have every command run from now on be recorded in metrics; None stops recording """
+    global _installed
+    _installed = metrics
+
+
+def installed() -> Optional[Metrics]:
+    return _installed
+
+
+def span() -> Optional[Span]:
+    """ Span of the running command, or None when it is neither measured nor profiled """
+    return current.get()
+
+
+@dataclass(eq=False)
+class Span:
+    """ One run of a command. Times are in seconds of time.perf_counter(). Queue wait is the time spent waiting
+    for the rate limiter and a concurrency slot, of which rate wait for the rate limiter. Spawn is the time
+    starting the process of an ExecutorCommand and process the time it ran after that. """
+    command: Command
+    start: float = field(default_factory=time.perf_counter)
+    end: Optional[float] = None
+    outcome: Optional[str] = None
+    queue_wait: float = 0.0
+    rate_wait: float = 0.0
+    spawn: Optional[float] = None
+    process: Optional[float] = None
+    exit_code: Optional[int] = None
+    output_bytes: Optional[int] = None
+    parent: Optional[Span] = None
+    result: Optional[CommandResult] = None
+
+    @property
+    def duration(self) -> Optional[float]:
+        return None if self.end is None else self.end - self.start
+
+    def finish(self, outcome: str) -> None:
+        self.end = time.perf_counter()
+        self.outcome = outcome
+
+    @staticmethod
+    def outcome_of(result: CommandResult) -> str:
+        if result.cancelled:
+            return CANCELLED
+        if result.timed_out:
+            return TIMED_OUT
+        return OK if result else ERROR
+
+
+class Histogram:
+    """ Counts of observations per bucket, with their sum; a last bucket counts everything above the others """
+    buckets: tuple[float, ...]
+    counts: list[int]
+    sum: float
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+
+class Metrics:
+    """ Aggregates the spans of command runs into histograms and counters per command class, and passes
+    every span on to on_span, for tracing. on_span is called in the task of the run and should not block. """
+    buckets: tuple[float, ...]
+    on_span: Optional[Callable[[Span], object]]
+    run_seconds: dict[str, Histogram]
+    queue_wait_seconds: dict[str, Histogram]
+    spawn_seconds: dict[str, Histogram]
+    runs: dict[tuple[str, str], int]
+    exit_codes: dict[tuple[str, int], int]
+    output_bytes: dict[str, int]
+    loop_lag_seconds: Histogram
+
+    def __init__(self, *, buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+                 on_span: Optional[Callable[[Span], object]] = None):
+        self.buckets = buckets
+        self.on_span = on_span
+        self.run_seconds = {}
+        self.queue_wait_seconds = {}
+        self.spawn_seconds = {}
+        self.runs = {}
+        self.exit_codes = {}
+        self.output_bytes = {}
+        self.loop_lag_seconds = Histogram(buckets)
+
+    def _histogram(self, histograms: dict[str, Histogram], name: str) -> Histogram:
+        if (histogram := histograms.get(name)) is None:
+            histogram = histograms[name] = Histogram(self.buckets)
+        return histogram
+
+    def record(self, span: Span) -> None:
+        name = type(span.command).__name__
+        if span.duration is not None:
+            self._histogram(self.run_seconds, name).observe(span.duration)
+        self._histogram(self.queue_wait_seconds, name).observe(span.queue_wait)
+        if span.spawn is not None:
+            self._histogram(self.spawn_seconds, name).observe(span.spawn)
+        key = (name, span.outcome or EXCEPTION)
+        self.runs[key] = self.runs.get(key, 0) + 1
+        if span.exit_code is not None:
+            code = (name, span.exit_code)
+            self.exit_codes[code] = self.exit_codes.get(code, 0) + 1
+        if span.output_bytes is not None:
+            self.output_bytes[name] = self.output_bytes.get(name, 0) + span.output_bytes
+        if self.on_span is not None:
+            self.on_span(span)
+
+    async def watch_loop(self, interval: float = 0.5) -> None:
+        """ Measure until cancelled how much later than asked for the running event loop wakes up a sleeper """
+        loop = asyncio.get_running_loop()
+        while True:
+            asked = loop.time() + interval
+            await asyncio.sleep(interval)
+            self.loop_lag_seconds.observe(max(0.0, loop.time() - asked))
+
+    def exposition(self) -> str:
+        """ The metrics in the Prometheus text exposition format """
+        lines: list[str] = []
+        for name, description, histograms in (
+            ('monitor_command_run_seconds', 'Duration of command runs', self.run_seconds),
+            ('monitor_command_queue_wait_seconds', 'Time commands waited for the rate limiter and a concurrency slot',
+             self.queue_wait_seconds),
+            ('monitor_command_spawn_seconds', 'Time spent starting the process of a command', self.spawn_seconds),
+        ):
+            lines += (f'# HELP {name} {description}', f'# TYPE {name} histogram')
+            for command, histogram in sorted(histograms.items()):
+                lines += _histogram_lines(name, histogram, f'command="{_escape(command)}"')
+        lines += ('# HELP monitor_command_runs_total Finished command runs by outcome',
+                  '# TYPE monitor_command_runs_total counter')
+        lines += (f'monitor_command_runs_total{{command="{_escape(command)}",outcome="{outcome}"}} {count}'
+                  for (command, outcome), count in sorted(self.runs.items()))
+        lines += ('# HELP monitor_command_exit_codes_total Exit codes of command processes',
+                  '# TYPE monitor_command_exit_codes_total counter')
+        lines += (f'monitor_command_exit_codes_total{{command="{_escape(command)}",code="{code}"}} {count}'
+                  for (command, code), count in sorted(self.exit_codes.items()))
+        lines += ('# HELP monitor_command_output_bytes_total Output written by command processes',
+                  '# TYPE monitor_command_output_bytes_total counter')
+        lines += (f'monitor_command_output_bytes_total{{command="{_escape(command)}"}} {count}'
+                  for command, count in sorted(self.output_bytes.items()))
+        lines += ('# HELP monitor_event_loop_lag_seconds How late the event loop wakes up sleepers',
+                  '# TYPE monitor_event_loop_lag_seconds histogram')
+        lines += _histogram_lines('monitor_event_loop_lag_seconds', self.loop_lag_seconds)
+        return '\n'.join(lines) + '\n'
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 9464) -> asyncio.Server:
+        """ Serve the exposition over HTTP on GET /metrics, until the returned server is closed """
+        return await asyncio.start_server(self._handle, host, port)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = await reader.readline()
+            while await reader.readline() not in (b'\r\n', b'\n', b''):
+                pass
+            method, path, *_ = request.decode('latin-1').split() + ['', '']
+            if method == 'GET' and path.split('?')[0] == '/metrics':
+                status, body = '200 OK', self.exposition().encode()
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+            writer.write(
+                f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _histogram_lines(name: str, histogram: Histogram, labels: str = '') -> list[str]:
+    separator = ',' if labels else ''
+    lines = []
+    cumulative = 0
+    for bound, count in zip((*(repr(float(b)) for b in histogram.buckets), '+Inf'), histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+    suffix = f'{{{labels}}}' if labels else ''
+    lines += (f'{name}_sum{suffix} {histogram.sum}', f'{name}_count{suffix} {cumulative}')
+    return lines
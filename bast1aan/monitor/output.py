@@ -0,0 +1,45 @@
+""" Size-capped capture of command output """
+from __future__ import annotations
+
+from typing import Optional
+
+
+class CappedOutput:
+    """ Output of one stream, keeping at most `limit` bytes: the first half as head and the last half as tail.
+    What falls in between is dropped and counted. Without a limit, everything is kept. """
+    limit: Optional[int]
+    dropped: int
+
+    def __init__(self, limit: Optional[int] = None):
+        self.limit = limit
+        self.dropped = 0
+        self._head = bytearray()
+        self._tail = bytearray()
+
+    def write(self, data: bytes) -> None:
+        if self.limit is None:
+            self._head += data
+            return
+        if (room := self.limit // 2 - len(self._head)) > 0:
+            self._head += data[:room]
+            data = data[room:]
+        if not data:
+            return
+        tail_limit = self.limit - self.limit // 2
+        if len(data) >= tail_limit:
+            self.dropped += len(self._tail) + len(data) - tail_limit
+            self._tail[:] = data[len(data) - tail_limit:]
+            return
+        self._tail += data
+        if (excess := len(self._tail) - tail_limit) > 0:
+            del self._tail[:excess]
+            self.dropped += excess
+
+    def __len__(self) -> int:
+        """ Number of bytes written, including the dropped ones """
+        return len(self._head) + len(self._tail) + self.dropped
+
+    def __bytes__(self) -> bytes:
+        if self.dropped:
+            return b'%s\n[... %d bytes dropped ...]\n%s' % (self._head, self.dropped, self._tail)
+        return bytes(self._head + self._tail)
@@ -1,16 +1,149 @@
 from __future__ import annotations
 import asyncio
+import re
+import socket
 import time
-from collections import defaultdict
+from dataclasses import dataclass
 
-from typing import Literal
+from typing import Literal, Optional, ClassVar
 
+from bast1aan.monitor import metrics
 from bast1aan.monitor._util import frozen_dataclass
-from bast1aan.monitor.base import ExecutorCommand, CommandResult
+from bast1aan.monitor.base import ExecutorCommand, CommandResult, Command, _TimedOutResult, _within_deadline, \
+    _deadline_for, _remaining
+from bast1aan.monitor.icmp import IcmpEngine, EchoStatistics
+from bast1aan.monitor.pingworker import PingWorkers, _REPLY
+from bast1aan.monitor.ratelimit import RateLimiter
+from bast1aan.monitor.resolver import Resolver, Address, host
+from bast1aan.monitor.retention import Retention
 
 IPV4: Literal[4] = 4
 IPV6: Literal[6] = 6
-_previous_runs: dict[PingCommand, float] = defaultdict(float)
+SUBPROCESS: Literal['subprocess'] = 'subprocess'
+NATIVE: Literal['native'] = 'native'
+PERSISTENT: Literal['persistent'] = 'persistent'
+
+_SUMMARY = re.compile(rb'(\d+) packets transmitted, (\d+) (?:packets )?received.*?([\d.]+)% packet loss')
+_RTT = re.compile(rb'(?:rtt|round-trip) min/avg/max(?:/mdev)? = ([\d.]+)/([\d.]+)/([\d.]+)(?:/([\d.]+))? ms')
+
+
+@dataclass(frozen=True)
+class PingStatistics:
+    """ Numbers of a ping run, times in milliseconds """
+    transmitted: int = 0
+    received: int = 0
+    loss: float = 100.0
+    rtt_min: Optional[float] = None
+    rtt_avg: Optional[float] = None
+    rtt_max: Optional[float] = None
+    rtt_mdev: Optional[float] = None
+    rtts: tuple[float, ...] = ()
+
+    @classmethod
+    def parse(cls, output: bytes) -> PingStatistics:
+        """ Parse the output of iputils or busybox ping, without decoding it """
+        rtts = tuple(float(match.group(1)) for match in _REPLY.finditer(output))
+        if summary := _SUMMARY.search(output):
+            transmitted, received, loss = int(summary.group(1)), int(summary.group(2)), float(summary.group(3))
+        else:
+            transmitted, received, loss = 0, len(rtts), 100.0
+        if rtt := _RTT.search(output):
+            rtt_min, rtt_avg, rtt_max, rtt_mdev = (float(value) if value else None for value in rtt.groups())
+            return cls(transmitted, received, loss, rtt_min, rtt_avg, rtt_max, rtt_mdev, rtts)
+        return cls(transmitted, received, loss, rtts=rtts)
+
+    @classmethod
+    def from_echo(cls, echo: EchoStatistics) -> PingStatistics:
+        rtts = tuple(rtt * 1000 for rtt in echo.rtts if rtt is not None)
+        loss = 100.0 - echo.received * 100.0 / echo.transmitted if echo.transmitted else 100.0
+        if not rtts:
+            return cls(echo.transmitted, echo.received, loss)
+        avg = sum(rtts) / len(rtts)
+        mdev = max(0.0, sum(rtt * rtt for rtt in rtts) / len(rtts) - avg * avg) ** 0.5
+        return cls(echo.transmitted, echo.received, loss, min(rtts), avg, max(rtts), mdev, rtts)
+
+
+class PingResult(CommandResult):
+    """ Result of a PingCommand. The output is kept as it was received and is only decoded by str(),
+    the statistics are parsed from it on first access. Address is what the target resolved to and was pinged,
+    resolution the seconds resolving took, which are not part of the round trip times. """
+    __slots__ = ('ok', 'command', 'output', 'echo', 'address', 'resolution', '_statistics')
+    ok: bool
+    command: Command
+    output: bytes
+    echo: Optional[EchoStatistics]
+    address: Optional[str]
+    resolution: Optional[float]
+    _statistics: Optional[PingStatistics]
+
+    def __init__(self, ok: bool, command: Command, output: bytes = b'', echo: Optional[EchoStatistics] = None,
+                 address: Optional[str] = None, resolution: Optional[float] = None):
+        self.ok = ok
+        self.command = command
+        self.output = output
+        self.echo = echo
+        self.address = address
+        self.resolution = resolution
+        self._statistics = None
+
+    def __bool__(self) -> bool:
+        return self.ok
+
+    @property
+    def target(self) -> str:
+        return self.command.target if isinstance(self.command, PingCommand) else str(self.command)
+
+    def __str__(self) -> str:
+        return str(self.echo) if self.echo is not None else self.output.decode()
+
+    def retain(self, retention: Retention) -> None:
+        # the statistics are parsed first, so they are kept
+        self.statistics
+        if self.echo is not None and retention.limit(self.ok) is not None:
+            # of the echoes only their text is kept, as if it was the output of a ping process
+            self.output, self.echo = str(self.echo).encode(), None
+        self.output = retention.apply(self.ok, self.output)
+
+    @property
+    def statistics(self) -> PingStatistics:
+        if self._statistics is None:
+            if self.echo is not None:
+                self._statistics = PingStatistics.from_echo(self.echo)
+            else:
+                self._statistics = PingStatistics.parse(self.output)
+        return self._statistics
+
+    @property
+    def transmitted(self) -> int:
+        return self.statistics.transmitted
+
+    @property
+    def received(self) -> int:
+        return self.statistics.received
+
+    @property
+    def loss(self) -> float:
+        return self.statistics.loss
+
+    @property
+    def rtt_min(self) -> Optional[float]:
+        return self.statistics.rtt_min
+
+    @property
+    def rtt_avg(self) -> Optional[float]:
+        return self.statistics.rtt_avg
+
+    @property
+    def rtt_max(self) -> Optional[float]:
+        return self.statistics.rtt_max
+
+    @property
+    def rtt_mdev(self) -> Optional[float]:
+        return self.statistics.rtt_mdev
+
+    @property
+    def rtts(self) -> tuple[float, ...]:
+        return self.statistics.rtts
 
 
 @frozen_dataclass(eq=True)
@@ -19,22 +152,105 @@ class PingCommand(ExecutorCommand):
     count: int = 1
     only: Literal[0, 4, 6] = 0
     interval: float = 0.2
+    engine: Literal['subprocess', 'native', 'persistent'] = SUBPROCESS
+    timeout: Optional[float] = None
+    # seconds a persistent ping process is kept running without checks
+    idle_timeout: float = 60.0
+    cache_executable = True
+    # spaces out pings to the same target by the interval of the command; not used by the persistent engine, whose
+    # process spaces its pings itself
+    rate_limiter: ClassVar[RateLimiter] = RateLimiter()
+    # resolves targets before pinging, so ping gets an address and resolving is timed apart; None, the default,
+    # leaves resolving to ping
+    resolver: ClassVar[Optional[Resolver]] = None
     @property
     def command(self) -> str:
-        args = ['-c', str(self.count)]
+        return ' '.join(self.argv)
+
+    @property
+    def argv(self) -> tuple[str, ...]:
+        return self._argv(self.target)
+
+    def _argv(self, destination: str) -> tuple[str, ...]:
+        args = ['ping', '-c', str(self.count)]
         if self.only == IPV4:
             args.append('-4')
         if self.only == IPV6:
             args.append('-6')
-        return 'ping %s %s' % (' '.join(args), self.target)
+        return (*args, destination)
 
     async def run(self) -> CommandResult:
-        await self._wait_if_necessary()
-        return await super().run()
+        deadline = _deadline_for(self)
+        if self.engine != PERSISTENT:
+            try:
+                await asyncio.wait_for(self._wait_if_necessary(), _remaining(deadline))
+            except asyncio.TimeoutError:
+                return _TimedOutResult('', self)
+        if self.resolver is None:
+            if self.engine == NATIVE:
+                return await _within_deadline(self, self._run_native(), deadline)
+            if self.engine == PERSISTENT:
+                return await self._run_persistent(self.target, deadline)
+            return await self._execute(self.argv, deadline)
+        family = {IPV4: socket.AF_INET, IPV6: socket.AF_INET6}.get(self.only, socket.AF_UNSPEC)
+        resolving = time.perf_counter()
+        try:
+            addresses = await asyncio.wait_for(self.resolver.resolve(self.target, family), _remaining(deadline))
+        except asyncio.TimeoutError:
+            return _TimedOutResult('', self)
+        except socket.gaierror as e:
+            return PingResult(False, self, f'ping: {self.target}: {e.strerror}'.encode(),
+                              resolution=time.perf_counter() - resolving)
+        resolution = time.perf_counter() - resolving
+        address = addresses[0]
+        if self.engine == NATIVE:
+            result = await _within_deadline(self, self._run_native(address), deadline)
+        elif self.engine == PERSISTENT:
+            result = await self._run_persistent(host(address), deadline)
+        else:
+            result = await self._execute(self._argv(host(address)), deadline)
+        if isinstance(result, PingResult):
+            result.address = host(address)
+            result.resolution = resolution
+        return result
 
-    async def _wait_if_necessary(self) -> None:
-        wait = (_previous_runs[self] + self.interval) - time.time()
-        if wait > 0.0:
-            await asyncio.sleep(wait)
-        _previous_runs[self] = time.time()
+    async def _run_native(self, address: Optional[Address] = None) -> CommandResult:
+        try:
+            statistics = await IcmpEngine.get().ping(self.target, self.count, self.only, address=address)
+        except socket.gaierror as e:
+            return PingResult(False, self, f'ping: {self.target}: {e.strerror}'.encode())
+        except OSError as e:
+            return PingResult(False, self, f'ping: sendmsg: {e.strerror}'.encode())
+        return PingResult(bool(statistics), self, echo=statistics)
+
+    def _persistent_argv(self, destination: str) -> tuple[str, ...]:
+        args = ['ping', '-i', str(self.interval)]
+        if self.only == IPV4:
+            args.append('-4')
+        if self.only == IPV6:
+            args.append('-6')
+        return (*args, destination)
+
+    async def _run_persistent(self, destination: str, deadline: Optional[float]) -> CommandResult:
+        """ The replies to the next count pings of the ping process kept running for destination. The rate
+        limiter is not waited for: that process spaces its pings by the interval itself, whatever the number of
+        checks it serves. """
+        try:
+            rtts, output = await PingWorkers.get().window(
+                self._persistent_argv(destination), self.interval, self.count, deadline, self._spawn, self.idle_timeout,
+            )
+        except FileNotFoundError as e:
+            return PingResult(False, self, f'{e.filename}: command not found'.encode())
+        echo = EchoStatistics(self.target, destination, self.count, rtts)
+        if not echo and output:
+            return PingResult(False, self, output)
+        return PingResult(bool(echo), self, echo=echo)
 
+    def _result(self, ok: bool, stdout: bytes, stderr: bytes) -> CommandResult:
+        return PingResult(ok, self, b'\n'.join((stdout, stderr)))
+
+    async def _wait_if_necessary(self) -> None:
+        waited = await self.rate_limiter.wait(self.target, self.interval)
+        if (span := metrics.span()) is not None:
+            span.queue_wait += waited
+            span.rate_wait += waited
@@ -0,0 +1,223 @@
+""" Long-running ping processes, one per target, whose replies serve the checks of that target """
+from __future__ import annotations
+
+import asyncio
+import atexit
+import os
+import re
+import signal
+import weakref
+from collections import deque
+from typing import Optional, Callable, Awaitable, Sequence
+
+from bast1aan.monitor.base import _kill, _remaining
+
+# seconds to wait for the replies to the last pings of a window
+LINGER = 1.0
+RESTART_DELAY = 1.0
+
+# a reply in the output of ping, of iputils as well as busybox, with its round trip time in milliseconds
+_REPLY = re.compile(rb'(?:icmp_)?seq=\d+ .*?time=([\d.]+) ms')
+
+Spawn = Callable[[Sequence[str]], Awaitable[asyncio.subprocess.Process]]
+
+_registries: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, PingWorkers] = weakref.WeakKeyDictionary()
+# every process still running, killed when the interpreter exits; they run in their own session, so they would
+# outlive it otherwise
+_processes: weakref.WeakSet[asyncio.subprocess.Process] = weakref.WeakSet()
+
+
+@atexit.register
+def _kill_all() -> None:
+    for process in list(_processes):
+        if process.returncode is None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+
+class PingWorker:
+    """ One ping process without a count, pinging every interval seconds until it is stopped. Replies are kept with
+    the time their echo request was sent (arrival minus round trip time), so a check takes the replies to the
+    requests sent during its window. Output that is no reply, like an error of ping, is kept as well. A process
+    that exits while the worker is in use or was used within idle_timeout is started again after RESTART_DELAY
+    seconds, otherwise on the next window. """
+    argv: tuple[str, ...]
+    interval: float
+    idle_timeout: float
+    users: int
+    last_used: float
+    # timer stopping the worker once it is idle, kept by its PingWorkers
+    idle_timer: Optional[asyncio.TimerHandle]
+    output: bytes
+    _replies: deque[tuple[float, float]]
+
+    def __init__(self, argv: Sequence[str], interval: float, spawn: Spawn, keep: int = 4096):
+        self.argv = tuple(argv)
+        self.interval = interval
+        self.idle_timeout = 60.0
+        self.users = 0
+        self.idle_timer = None
+        self.output = b''
+        self._spawn = spawn
+        self._replies = deque(maxlen=keep)
+        self._loop = asyncio.get_running_loop()
+        self.last_used = self._loop.time()
+        self._process: Optional[asyncio.subprocess.Process] = None
+        self._starting: Optional[asyncio.Future[None]] = None
+        self._reading: Optional[asyncio.Future[None]] = None
+        self._restarting: Optional[asyncio.Future[None]] = None
+        self._ready: asyncio.Future[None] = self._loop.create_future()
+        self._first_line = 0.0
+        self._changed: asyncio.Future[None] = self._loop.create_future()
+        self._stopped = False
+
+    @property
+    def running(self) -> bool:
+        return self._process is not None and self._process.returncode is None
+
+    async def _start(self) -> None:
+        """ Start the process unless it runs, waiting up to LINGER seconds until it printed its first line, which
+        ping does right before sending its first echo request """
+        if self.running:
+            return
+        if self._starting is None:
+            self._starting = asyncio.ensure_future(self._spawn_and_read())
+            self._starting.add_done_callback(lambda _: setattr(self, '_starting', None))
+        await asyncio.shield(self._starting)
+        try:
+            await asyncio.wait_for(asyncio.shield(self._ready), LINGER)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _spawn_and_read(self) -> None:
+        self._ready = self._loop.create_future()
+        self._first_line = self._loop.time()
+        self.output = b''
+        self._process = process = await self._spawn(self.argv)
+        _processes.add(process)
+        self._reading = asyncio.ensure_future(self._read(process))
+
+    async def _read(self, process: asyncio.subprocess.Process) -> None:
+        assert process.stdout is not None and process.stderr is not None
+        errors = asyncio.ensure_future(process.stderr.read())
+        while line := await process.stdout.readline():
+            if match := _REPLY.search(line):
+                rtt = float(match.group(1)) / 1000
+                self._replies.append((self._loop.time() - rtt, rtt))
+            else:
+                self.output = line
+            self._notify()
+        self.output = (self.output + await errors).strip()
+        await process.wait()
+        self._notify()
+        if not self._stopped and (self.users or self._loop.time() - self.last_used < self.idle_timeout):
+            self._loop.call_later(RESTART_DELAY, self._restart)
+
+    def _restart(self) -> None:
+        if not self._stopped and not self.running:
+            self._restarting = asyncio.ensure_future(self._start())
+
+    def _notify(self) -> None:
+        if not self._ready.done():
+            self._first_line = self._loop.time()
+            self._ready.set_result(None)
+        if not self._changed.done():
+            self._changed.set_result(None)
+        self._changed = self._loop.create_future()
+
+    async def window(self, count: int, deadline: Optional[float]) -> list[Optional[float]]:
+        """ Round trip times in seconds of the count echo requests sent from now on, in order of arrival, None for
+        the requests without reply before deadline or LINGER seconds after the window of count intervals """
+        self.users += 1
+        try:
+            start = self._loop.time()
+            if not self.running:
+                await asyncio.wait_for(self._start(), _remaining(deadline))
+                # a new process sends its first request right after its first line
+                start = self._first_line
+            # half an interval of slack on both ends, for the time output takes to arrive and for a process that
+            # does not keep its interval precisely
+            start -= self.interval / 2
+            end = start + (count + 1) * self.interval
+            until = end + LINGER if deadline is None else min(end + LINGER, deadline)
+            while True:
+                rtts: list[Optional[float]] = [rtt for sent, rtt in self._replies if start <= sent < end]
+                if len(rtts) >= count or not self.running or self._loop.time() >= until:
+                    return rtts[:count] + [None] * (count - len(rtts))
+                try:
+                    await asyncio.wait_for(asyncio.shield(self._changed), until - self._loop.time())
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.TimeoutError:
+            return [None] * count
+        finally:
+            self.users -= 1
+            self.last_used = self._loop.time()
+
+    async def stop(self) -> None:
+        self._stopped = True
+        if self._process is not None:
+            await _kill(self._process)
+
+
+class PingWorkers:
+    """ The workers of one loop, one per ping command line, stopped after their idle_timeout without windows """
+    _workers: dict[tuple[str, ...], PingWorker]
+    _stopping: set[asyncio.Future[None]]
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self._loop = loop or asyncio.get_running_loop()
+        self._workers = {}
+        self._stopping = set()
+
+    @classmethod
+    def get(cls) -> PingWorkers:
+        """ The workers of the running loop """
+        loop = asyncio.get_running_loop()
+        if (workers := _registries.get(loop)) is None:
+            workers = _registries[loop] = cls(loop)
+        return workers
+
+    def __len__(self) -> int:
+        return len(self._workers)
+
+    def __getitem__(self, argv: Sequence[str]) -> PingWorker:
+        return self._workers[tuple(argv)]
+
+    async def window(self, argv: Sequence[str], interval: float, count: int, deadline: Optional[float],
+                     spawn: Spawn, idle_timeout: float = 60.0) -> tuple[list[Optional[float]], bytes]:
+        """ Round trip times of the next count replies of the worker for argv, started when there is none, and
+        its last output that was no reply """
+        if (worker := self._workers.get(tuple(argv))) is None:
+            worker = self._workers[tuple(argv)] = PingWorker(argv, interval, spawn)
+        worker.idle_timeout = idle_timeout
+        try:
+            return await worker.window(count, deadline), worker.output
+        finally:
+            if worker.idle_timer is None:
+                worker.idle_timer = self._loop.call_later(idle_timeout, self._stop_if_idle, worker)
+
+    def _stop_if_idle(self, worker: PingWorker) -> None:
+        worker.idle_timer = None
+        if worker.users:
+            # the window using it sets the timer again when it ends
+            return
+        if (idle := self._loop.time() - worker.last_used) < worker.idle_timeout:
+            worker.idle_timer = self._loop.call_later(worker.idle_timeout - idle, self._stop_if_idle, worker)
+            return
+        if self._workers.get(worker.argv) is worker:
+            del self._workers[worker.argv]
+        stopping = asyncio.ensure_future(worker.stop())
+        self._stopping.add(stopping)
+        stopping.add_done_callback(self._stopping.discard)
+
+    async def stop(self) -> None:
+        workers = list(self._workers.values())
+        self._workers.clear()
+        for worker in workers:
+            if worker.idle_timer is not None:
+                worker.idle_timer.cancel()
+                worker.idle_timer = None
+        await asyncio.gather(*(worker.stop() for worker in workers))
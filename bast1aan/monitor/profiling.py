@@ -0,0 +1,256 @@
+""" Profiling one evaluation of a tree of commands: when every command and command set in it ran, the chain of
+them that determined how long it took, as a Chrome trace and as a summary """
+from __future__ import annotations
+
+import json
+import time
+from contextvars import ContextVar, Token
+from dataclasses import dataclass, field
+from typing import Optional, AsyncIterator, Iterable, Any, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from bast1aan.monitor.base import Command, CommandResult
+    from bast1aan.monitor.metrics import Span
+
+# profile of the evaluation running in this context; while None, nothing is profiled
+active: ContextVar[Optional[Profile]] = ContextVar('active', default=None)
+
+# node of the command running in this context, parent of the commands run from it
+current: ContextVar[Optional[Node]] = ContextVar('current', default=None)
+
+# kinds of time of a critical path
+RATE_WAIT = 'rate_wait'
+SLOT_WAIT = 'slot_wait'
+SPAWN = 'spawn'
+PROCESS = 'process'
+RUN = 'run'
+SET = 'set'
+WALK_WAIT = 'walk_wait'
+
+
+@dataclass(eq=False)
+class Node:
+    """ One run of a command in a profile, times in seconds of time.perf_counter(). The node of a command set
+    lasts until its last result, has the commands it ran as children and knows when the walk of its result
+    started; the node of any other command has the span of its run, with the time it waited and spent on its
+    process. """
+    command: Command
+    parent: Optional[Node] = None
+    start: float = field(default_factory=time.perf_counter)
+    end: Optional[float] = None
+    walked: Optional[float] = None
+    span: Optional[Span] = None
+    children: list[Node] = field(default_factory=list)
+
+    @property
+    def name(self) -> str:
+        if self.span is None:
+            return type(self.command).__name__
+        return next(iter(str(self.command).splitlines()), '') or type(self.command).__name__
+
+    @property
+    def duration(self) -> float:
+        assert self.end is not None
+        return self.end - self.start
+
+    @property
+    def wait(self) -> float:
+        """ Seconds the result of a command set waited to be walked, after its run """
+        if self.span is not None:
+            return 0.0
+        assert self.end is not None
+        return (self.end if self.walked is None else self.walked) - self.start
+
+    def finish(self) -> None:
+        if self.end is None:
+            self.end = time.perf_counter()
+
+    def breakdown(self) -> dict[str, float]:
+        """ Seconds of the run of a command per kind of time: waiting for the rate limiter, like the interval
+        between pings to one target, and for a concurrency slot; starting its process and the process running;
+        and the rest of the run """
+        if self.span is None:
+            return {}
+        kinds = {
+            RATE_WAIT: self.span.rate_wait,
+            SLOT_WAIT: self.span.queue_wait - self.span.rate_wait,
+            SPAWN: self.span.spawn or 0.0,
+            PROCESS: self.span.process or 0.0,
+        }
+        kinds[RUN] = max(0.0, self.duration - sum(kinds.values()))
+        return kinds
+
+
+def _chain(children: Iterable[Node], end: float) -> list[Node]:
+    """ The children that in turn kept their parent from ending before end: the one that ended last, the one
+    that ended last before that one started, and so on; in order of time """
+    chain: list[Node] = []
+    ends = [(node.end, node) for node in children if node.end is not None and node.end <= end]
+    while ends:
+        _, last = max(ends, key=lambda item: item[0])
+        chain.append(last)
+        ends = [(end, node) for end, node in ends if end <= last.start]
+    return chain[::-1]
+
+
+class Profile:
+    """ Profile of everything run while it is entered, by the commands and command sets run in a command set:
+
+        profile = Profile()
+        with profile:
+            list(command_set())
+        profile.write_trace('trace.json')
+        print(profile.summary())
+
+    The command set evaluated, like command_set here, is the root node, whether it is called or its run() is
+    awaited. Nodes that did not end when the profile is left, like a result that was not walked, end with it. """
+    start: Optional[float]
+    end: Optional[float]
+    nodes: list[Node]
+    _token: Optional[Token[Optional[Profile]]]
+
+    def __init__(self) -> None:
+        self.start = None
+        self.end = None
+        self.nodes = []
+        self._token = None
+
+    def __enter__(self) -> Profile:
+        self.start = time.perf_counter()
+        self._token = active.set(self)
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        assert self._token is not None
+        active.reset(self._token)
+        self._token = None
+        self.end = time.perf_counter()
+        for node in self.nodes:
+            if node.end is None:
+                node.end = self.end
+
+    def add(self, command: Command, parent: Optional[Node]) -> Node:
+        node = Node(command, parent)
+        self.nodes.append(node)
+        if parent is not None:
+            parent.children.append(node)
+        return node
+
+    @property
+    def roots(self) -> list[Node]:
+        return [node for node in self.nodes if node.parent is None]
+
+    @property
+    def duration(self) -> float:
+        assert self.start is not None and self.end is not None, 'Profile was not left yet'
+        return self.end - self.start
+
+    def critical_path(self) -> list[Node]:
+        """ The nodes that determined the wall time, parents before their children """
+        path: list[Node] = []
+
+        def visit(nodes: list[Node]) -> None:
+            for node in nodes:
+                path.append(node)
+                assert node.end is not None
+                visit(_chain(node.children, node.end))
+
+        assert self.end is not None, 'Profile was not left yet'
+        visit(_chain(self.roots, self.end))
+        return path
+
+    def contributions(self) -> list[tuple[Node, dict[str, float]]]:
+        """ The seconds every node of the critical path added to it, per kind of time. For a command set that is
+        the time its critical children did not run, like starting them and backing off between them, and apart
+        from that the time the results of its critical children waited to be walked. The root waits for its own
+        walk. """
+        contributions = []
+        for node in self.critical_path():
+            if node.span is not None:
+                contributions.append((node, node.breakdown()))
+            else:
+                assert node.end is not None
+                chain = _chain(node.children, node.end)
+                own = node.duration - node.wait - sum(child.duration for child in chain)
+                waits = sum(child.wait for child in chain) + (node.wait if node.parent is None else 0.0)
+                contributions.append((node, {SET: max(0.0, own), WALK_WAIT: waits}))
+        return contributions
+
+    def summary(self, top: int = 10) -> str:
+        """ The critical path per kind of time, and the top nodes that added most to it """
+        contributions = self.contributions()
+        critical = sum(sum(kinds.values()) for _, kinds in contributions)
+        totals: dict[str, float] = {}
+        for _, kinds in contributions:
+            for kind, seconds in kinds.items():
+                totals[kind] = totals.get(kind, 0.0) + seconds
+        lines = [f'Critical path {critical:.3f} s of {self.duration:.3f} s wall time, {len(self.nodes)} nodes']
+        lines += (f'  {kind:<10} {seconds:10.3f} s {_percentage(seconds, critical):>6}'
+                  for kind, seconds in sorted(totals.items(), key=lambda item: -item[1]) if seconds > 0)
+        lines.append('Top contributors:')
+        ranked = sorted(contributions, key=lambda contribution: -sum(contribution[1].values()))[:top]
+        for node, kinds in ranked:
+            seconds = sum(kinds.values())
+            parts = ', '.join(f'{kind} {value:.3f} s' for kind, value in kinds.items() if value > 0)
+            lines.append(f'  {seconds:10.3f} s {_percentage(seconds, critical):>6}  {node.name}  ({parts})')
+        return '\n'.join(lines)
+
+    def trace_events(self) -> list[dict[str, Any]]:
+        """ Every node as a complete event of the Chrome trace event format, on a thread of its own where it
+        overlaps a node that is not its parent, so the nodes stack up as in a flame graph """
+        assert self.start is not None, 'Profile was not entered yet'
+        critical = set(self.critical_path())
+        events = []
+        lanes: list[float] = []
+
+        def place(nodes: list[Node], lane: Optional[int]) -> None:
+            # end of the sibling last placed on the lane of the parent
+            free = float('-inf')
+            for node in sorted(nodes, key=lambda node: node.start):
+                assert node.end is not None
+                if lane is not None and free <= node.start:
+                    tid, free = lane, node.end
+                else:
+                    tid = next((i for i, end in enumerate(lanes) if end <= node.start), len(lanes))
+                    if tid == len(lanes):
+                        lanes.append(node.end)
+                    lanes[tid] = node.end
+                args: dict[str, Any] = {'critical': node in critical}
+                if node.span is not None:
+                    args.update(node.breakdown(), outcome=node.span.outcome, exit_code=node.span.exit_code)
+                else:
+                    args[WALK_WAIT] = node.wait
+                events.append({
+                    'name': node.name, 'cat': 'command' if node.span is not None else 'set', 'ph': 'X',
+                    'ts': (node.start - start) * 1e6, 'dur': node.duration * 1e6, 'pid': 1, 'tid': tid,
+                    'args': args,
+                })
+                place(node.children, tid)
+
+        start = self.start
+        place(self.roots, None)
+        return events
+
+    def write_trace(self, path: str) -> None:
+        """ Write the trace events to path, to be opened in chrome://tracing, Perfetto or speedscope """
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': self.trace_events(), 'displayTimeUnit': 'ms'}, file)
+
+
+async def walk(results: AsyncIterator[CommandResult], node: Node) -> AsyncIterator[CommandResult]:
+    """ Walk the results of the command set of node, ending node with the last result, or when the walk stops
+    before that """
+    node.walked = time.perf_counter()
+    last: Optional[float] = None
+    try:
+        async for result in results:
+            last = time.perf_counter()
+            yield result
+        # rather than when the walk came back for another result
+        node.end = last
+    finally:
+        node.finish()
+
+
+def _percentage(part: float, whole: float) -> str:
+    return f'{part / whole * 100:.1f}%' if whole > 0 else '-'
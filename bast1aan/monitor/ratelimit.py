@@ -0,0 +1,101 @@
+""" Rate limiting of command starts, in total and per key """
+from __future__ import annotations
+
+import asyncio
+import bisect
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import Optional, Hashable
+
+current: ContextVar[Optional[RateLimiter]] = ContextVar('current', default=None)
+
+
+class RateLimiter:
+    """ Token buckets limiting how often commands start: one for all starts, spaced `interval` seconds apart,
+    and one per key (like a target host), spaced `per_key_interval` apart unless the caller passes its own
+    interval. Both allow bursts of `burst` starts.
+
+    Every caller reserves the first moment both buckets allow, in order of arrival, and only sleeps until
+    then; so waiters are served first come, first served, without waking each other. Buckets are kept as the
+    moment they are full again (GCRA), on the monotonic clock. Full buckets hold no information and are
+    evicted, and at most max_keys keys are remembered, dropping the least recently used. A start held back by
+    its key is booked in the global bucket on its own, `interval` apart from other starts, so it does not hold
+    back the starts of other keys. """
+    interval: Optional[float]
+    burst: int
+    per_key_interval: Optional[float]
+    per_key_burst: int
+    max_keys: int
+    _tat: float
+    # starts held back by their key, taken from the global bucket apart
+    _booked: list[float]
+    _keys: OrderedDict[Hashable, float]
+
+    def __init__(self, interval: Optional[float] = None, burst: int = 1, *, per_key_interval: Optional[float] = None,
+                 per_key_burst: int = 1, max_keys: int = 10000):
+        self.interval = interval
+        self.burst = burst
+        self.per_key_interval = per_key_interval
+        self.per_key_burst = per_key_burst
+        self.max_keys = max_keys
+        self._tat = 0.0
+        self._booked = []
+        self._keys = OrderedDict()
+
+    def __len__(self) -> int:
+        """ Number of keys remembered """
+        return len(self._keys)
+
+    def reserve(self, key: Optional[Hashable] = None, interval: Optional[float] = None) -> float:
+        """ Reserve a start, returning the monotonic time it is allowed at """
+        now = time.monotonic()
+        start = now
+        if interval is None:
+            interval = self.per_key_interval
+        key_tat = 0.0
+        if key is not None and interval:
+            key_tat = self._keys.pop(key, 0.0)
+            start = max(start, key_tat - (self.per_key_burst - 1) * interval)
+        if self.interval:
+            start = self._reserve_global(now, start)
+        if key is not None and interval:
+            self._keys[key] = max(key_tat, start) + interval
+            self._evict(now)
+        return start
+
+    def _reserve_global(self, now: float, earliest: float) -> float:
+        """ Reserve the first start of the global bucket at or after earliest """
+        assert self.interval
+        del self._booked[:bisect.bisect_left(self._booked, now - self.interval)]
+        if earliest > max(now, self._tat):
+            # held back by its key: booked apart, so later starts of other keys do not wait for it
+            start = self._around_booked(earliest)
+            bisect.insort(self._booked, start)
+            return start
+        start = self._around_booked(max(earliest, self._tat - (self.burst - 1) * self.interval))
+        self._tat = max(self._tat, start) + self.interval
+        return start
+
+    def _around_booked(self, start: float) -> float:
+        """ The first moment from start that is at least interval away from the booked starts """
+        assert self.interval
+        for booked in self._booked[bisect.bisect_right(self._booked, start - self.interval):]:
+            if booked >= start + self.interval:
+                break
+            start = booked + self.interval
+        return start
+
+    def _evict(self, now: float) -> None:
+        while self._keys:
+            key, tat = next(iter(self._keys.items()))
+            if tat > now and len(self._keys) <= self.max_keys:
+                return
+            del self._keys[key]
+
+    async def wait(self, key: Optional[Hashable] = None, interval: Optional[float] = None) -> float:
+        """ Wait until a start is allowed, returning the seconds waited """
+        if (delay := self.reserve(key, interval) - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+            return delay
+        return 0.0
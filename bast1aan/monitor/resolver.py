@@ -0,0 +1,96 @@
+""" Cached asynchronous resolution of host names """
+from __future__ import annotations
+
+import asyncio
+import socket
+import time
+from collections import OrderedDict
+from typing import Union
+
+# family and sockaddr, as in the result of getaddrinfo()
+Address = tuple[int, tuple]
+
+
+def host(address: Address) -> str:
+    """ Text form of the host of address, with the scope of a link-local IPv6 address """
+    family, sockaddr = address
+    if family == socket.AF_INET6 and sockaddr[3] and '%' not in sockaddr[0]:
+        return f'{sockaddr[0]}%{sockaddr[3]}'
+    return sockaddr[0]
+
+
+class Resolver:
+    """ Caches getaddrinfo() results as (family, sockaddr) tuples for `ttl` seconds, and failures to resolve for
+    `negative_ttl` seconds; temporary failures (EAI_AGAIN) are not cached. getaddrinfo() does not tell the TTL
+    of the records, so the same ttl holds for every name. At most max_entries names are kept, dropping the least
+    recently used. Lookups of a name that is being resolved wait for that resolution instead of starting their own.
+
+    Lookups run in the executor of the running loop; the cache is shared by all loops using the resolver. """
+    ttl: float
+    negative_ttl: float
+    max_entries: int
+    _cache: OrderedDict[tuple[str, int], tuple[float, Union[list[Address], socket.gaierror]]]
+    _pending: dict[tuple[asyncio.AbstractEventLoop, str, int], asyncio.Future[list[Address]]]
+
+    def __init__(self, ttl: float = 60.0, negative_ttl: float = 10.0, max_entries: int = 10000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self._pending = {}
+
+    def __len__(self) -> int:
+        """ Number of names cached """
+        return len(self._cache)
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def cached(self, host: str, family: int = socket.AF_UNSPEC) -> bool:
+        """ Whether resolving host would be answered from the cache """
+        entry = self._cache.get((host, family))
+        return entry is not None and entry[0] > time.monotonic()
+
+    async def resolve(self, host: str, family: int = socket.AF_UNSPEC) -> list[Address]:
+        """ Addresses of host, in the order of getaddrinfo(); raises socket.gaierror when it does not resolve """
+        key = (host, family)
+        if (entry := self._cache.get(key)) is not None:
+            expires, addresses = entry
+            if expires > time.monotonic():
+                self._cache.move_to_end(key)
+                if isinstance(addresses, socket.gaierror):
+                    raise socket.gaierror(*addresses.args)
+                return addresses
+            del self._cache[key]
+        loop = asyncio.get_running_loop()
+        if (pending := self._pending.get((loop, host, family))) is None:
+            pending = self._pending[loop, host, family] = asyncio.ensure_future(self._lookup(host, family))
+            pending.add_done_callback(lambda future: self._landed((loop, host, family), future))
+        # one waiter giving up does not cancel the lookup for the others
+        return await asyncio.shield(pending)
+
+    def _landed(self, key: tuple[asyncio.AbstractEventLoop, str, int], future: asyncio.Future[list[Address]]) -> None:
+        del self._pending[key]
+        if not future.cancelled():
+            # retrieved, so nobody waiting anymore is no reason for a warning
+            future.exception()
+
+    async def _lookup(self, host: str, family: int) -> list[Address]:
+        loop = asyncio.get_running_loop()
+        try:
+            infos = await loop.getaddrinfo(host, None, family=family, type=socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            if e.errno != socket.EAI_AGAIN:
+                self._store((host, family), self.negative_ttl, e)
+            raise
+        addresses: list[Address] = [(info[0], info[4]) for info in infos]
+        self._store((host, family), self.ttl, addresses)
+        return addresses
+
+    def _store(self, key: tuple[str, int], ttl: float, value: Union[list[Address], socket.gaierror]) -> None:
+        if ttl <= 0:
+            return
+        self._cache[key] = (time.monotonic() + ttl, value)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
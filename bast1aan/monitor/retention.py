@@ -0,0 +1,36 @@
+""" How much of the output of their commands results keep """
+from __future__ import annotations
+
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Optional, TypeVar
+
+AnyStr = TypeVar('AnyStr', str, bytes)
+
+
+@dataclass(frozen=True)
+class Retention:
+    """ Output kept by successful and by failed results: all of it when None, none when 0, otherwise that many
+    characters (or bytes) from the start, followed by '...' when cut. Numbers parsed from the output, like the
+    round trip times of a ping, are kept regardless. """
+    success: Optional[int] = None
+    failure: Optional[int] = None
+
+    def limit(self, ok: bool) -> Optional[int]:
+        return self.success if ok else self.failure
+
+    def apply(self, ok: bool, output: AnyStr) -> AnyStr:
+        """ What is kept of output """
+        limit = self.limit(ok)
+        if limit is None or len(output) <= limit:
+            return output
+        if limit == 0:
+            return output[:0]
+        return output[:limit] + ('...' if isinstance(output, str) else b'...')  # type: ignore[return-value, operator]
+
+
+FULL = Retention()
+ON_FAILURE = Retention(success=0)
+NONE = Retention(0, 0)
+
+current: ContextVar[Optional[Retention]] = ContextVar('current', default=None)
@@ -0,0 +1,190 @@
+""" Scheduler running commands repeatedly, each on its own interval """
+from __future__ import annotations
+
+import asyncio
+import heapq
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Optional, Callable, Union
+
+from bast1aan.monitor.base import AsyncCommand, CommandResult, CommandSetResult, _run, _Scope
+from bast1aan.monitor.concurrency import ConcurrencyLimit
+from bast1aan.monitor.retention import Retention
+from bast1aan.monitor.singleflight import SingleFlight
+
+
+@dataclass(eq=False)
+class Check:
+    command: AsyncCommand
+    interval: float
+    jitter: float
+    due: float
+    runs: int = 0
+    skipped: int = 0
+    last_result: Optional[CommandResult] = None
+    last_error: Optional[BaseException] = None
+    _task: Optional[asyncio.Task] = field(default=None, repr=False)
+    _removed: bool = field(default=False, repr=False)
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+
+@dataclass
+class SchedulingLag:
+    """ How late checks were started compared to when they were due, in seconds """
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+    last: float = 0.0
+
+    def add(self, lag: float) -> None:
+        self.count += 1
+        self.total += lag
+        self.last = lag
+        if lag > self.max:
+            self.max = lag
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+class Scheduler:
+    """ Runs commands on their own intervals from one task, keeping the due checks in a heap.
+
+    First runs are spread over `stagger` times the interval and every next run is moved by up to `jitter`
+    times the interval, so checks added at once do not keep firing at the same moment. A check that is
+    still running when it is due again is skipped for that round. """
+    on_result: Optional[Callable[[Check, CommandResult], object]]
+    concurrency: Optional[ConcurrencyLimit]
+    single_flight: Optional[SingleFlight]
+    retention: Optional[Retention]
+    jitter: float
+    stagger: float
+    lag: SchedulingLag
+    _checks: dict[AsyncCommand, Check]
+    _heap: list[tuple[float, int, Check]]
+    # runs in progress, including those of checks removed since
+    _running: set[asyncio.Task]
+
+    def __init__(self, *, on_result: Optional[Callable[[Check, CommandResult], object]] = None,
+                 concurrency: Optional[ConcurrencyLimit] = None, single_flight: Optional[SingleFlight] = None,
+                 jitter: float = 0.1, stagger: float = 1.0, seed: Optional[int] = None,
+                 retention: Optional[Retention] = None):
+        self.on_result = on_result
+        self.concurrency = concurrency
+        self.single_flight = single_flight
+        self.retention = retention
+        self.jitter = jitter
+        self.stagger = stagger
+        self.lag = SchedulingLag()
+        self._checks = {}
+        self._heap = []
+        self._running = set()
+        self._counter = 0
+        self._random = random.Random(seed)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopped = False
+
+    def _time(self) -> float:
+        return self._loop.time() if self._loop is not None else time.monotonic()
+
+    def _push(self, check: Check) -> None:
+        self._counter += 1
+        heapq.heappush(self._heap, (check.due, self._counter, check))
+        if self._wakeup is not None and self._heap[0][2] is check:
+            self._wakeup.set()
+
+    def add(self, command: AsyncCommand, interval: float, *, jitter: Optional[float] = None) -> Check:
+        if command in self._checks:
+            raise ValueError(f'Command is already scheduled: {command}')
+        check = Check(
+            command,
+            interval,
+            self.jitter if jitter is None else jitter,
+            self._time() + self._random.uniform(0, interval * self.stagger),
+        )
+        self._checks[command] = check
+        self._push(check)
+        return check
+
+    def remove(self, command: Union[AsyncCommand, Check]) -> None:
+        """ Unschedule command; a run in progress is finished, but not repeated """
+        check = self._checks.pop(command.command if isinstance(command, Check) else command)
+        check._removed = True
+
+    def __contains__(self, command: AsyncCommand) -> bool:
+        return command in self._checks
+
+    def __len__(self) -> int:
+        return len(self._checks)
+
+    @property
+    def checks(self) -> tuple[Check, ...]:
+        return tuple(self._checks.values())
+
+    async def run(self) -> None:
+        """ Run the due checks until stop() is called """
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._stopped = False
+        try:
+            while not self._stopped:
+                now = self._loop.time()
+                while self._heap and self._heap[0][0] <= now:
+                    due, _, check = heapq.heappop(self._heap)
+                    if check._removed or due != check.due:
+                        continue
+                    self._start(check, now)
+                self._wakeup.clear()
+                try:
+                    timeout = self._heap[0][0] - now if self._heap else None
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            tasks = list(self._running)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._wakeup = None
+
+    def stop(self) -> None:
+        self._stopped = True
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _start(self, check: Check, now: float) -> None:
+        self.lag.add(now - check.due)
+        if check.running:
+            check.skipped += 1
+        else:
+            check._task = asyncio.ensure_future(self._execute(check))
+            self._running.add(check._task)
+            check._task.add_done_callback(self._running.discard)
+        jitter = self._random.uniform(-check.jitter, check.jitter) * check.interval
+        # anchored on the due time to keep the cadence, but never catching up with a burst of runs
+        check.due = max(check.due + check.interval + jitter, now)
+        self._push(check)
+
+    async def _execute(self, check: Check) -> None:
+        try:
+            result = await _run(check.command, _Scope(self.concurrency, single_flight=self.single_flight,
+                                                     retention=self.retention))
+            if isinstance(result, CommandSetResult):
+                async for _ in result:
+                    pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            check.last_error = e
+            return
+        check.runs += 1
+        check.last_result = result
+        check.last_error = None
+        if self.on_result is not None:
+            self.on_result(check, result)
@@ -0,0 +1,249 @@
+""" Running a very large command set in worker processes, each running its share of the commands on its own loop """
+from __future__ import annotations
+
+import asyncio
+import io
+import multiprocessing
+import os
+import pickle
+from multiprocessing.connection import Connection
+from multiprocessing.context import BaseContext
+from typing import Optional, Callable, Iterable, AsyncIterator, Union
+
+from bast1aan.monitor.base import Command, AsyncCommand, CommandResult, CommandSetResult, CommandSet, ALL_SUCCEED, \
+    _CommandResult, _TimedOutResult, _Scope, _run, _run_in_executor, _walk_over_result, _remaining
+from bast1aan.monitor.concurrency import ConcurrencyLimit
+from bast1aan.monitor.retention import Retention
+
+# what a worker sends per command: its index and its (walked) results, or the exception it raised
+_Message = tuple[int, Union[list[CommandResult], BaseException]]
+
+
+class _Pickler(pickle.Pickler):
+    """ Pickles the commands being run as their index, as the parent has them already """
+    def __init__(self, file: io.BytesIO, indexes: dict[int, int]):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self._indexes = indexes
+
+    def persistent_id(self, obj: object) -> Optional[int]:
+        return self._indexes.get(id(obj)) if isinstance(obj, Command) else None
+
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, file: io.BytesIO, commands: list[Command]):
+        super().__init__(file)
+        self._commands = commands
+
+    def persistent_load(self, pid: int) -> Command:
+        return self._commands[pid]
+
+
+def _dumps(message: _Message, indexes: dict[int, int]) -> bytes:
+    buffer = io.BytesIO()
+    try:
+        _Pickler(buffer, indexes).dump(message)
+    except (pickle.PicklingError, TypeError, AttributeError) as e:
+        if isinstance(message[1], BaseException):
+            return _dumps((message[0], RuntimeError(repr(message[1]))), indexes)
+        return _dumps((message[0], e), indexes)
+    return buffer.getvalue()
+
+
+def _work(connection: Connection, commands: list[tuple[int, Command]], limit: Optional[ConcurrencyLimit],
+          retention: Optional[Retention]) -> None:
+    """ Entry point of a worker process """
+    try:
+        asyncio.run(_serve(connection, commands, limit, retention))
+    finally:
+        connection.close()
+
+
+async def _serve(connection: Connection, commands: list[tuple[int, Command]], limit: Optional[ConcurrencyLimit],
+                 retention: Optional[Retention]) -> None:
+    # output is dropped before the results are sent, so it is not pickled for nothing
+    scope = _Scope(limit, retention=retention)
+    indexes = {id(command): index for index, command in commands}
+
+    async def run(index: int, command: Command) -> None:
+        message: _Message
+        try:
+            if isinstance(command, AsyncCommand):
+                result = await _run(command, scope)
+            else:
+                result = await _run_in_executor(command, scope, None)
+            message = (index, [subresult async for subresult in _walk_over_result(result)])
+        except Exception as e:
+            message = (index, e)
+        connection.send_bytes(_dumps(message, indexes))
+
+    await asyncio.gather(*(run(index, command) for index, command in commands))
+
+
+def _default_context() -> BaseContext:
+    start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return multiprocessing.get_context(start_method)
+
+
+class _Worker:
+    """ Parent side of a worker process running the commands of one shard that have no results yet """
+    shard: int
+    restarts: int
+    pending: dict[int, Command]
+    _process: Optional[multiprocessing.process.BaseProcess]
+    _connection: Optional[Connection]
+
+    def __init__(self, shard: int) -> None:
+        self.shard = shard
+        self.restarts = 0
+        self.pending = {}
+        self._process = None
+        self._connection = None
+
+    def start(self, context: BaseContext, limit: Optional[ConcurrencyLimit], retention: Optional[Retention],
+              received: Callable[[_Worker, Optional[bytes]], None]) -> None:
+        """ Start the process, having received() called with every message and with None once it exited """
+        parent, child = context.Pipe(duplex=False)
+        self._process = context.Process(  # type: ignore[attr-defined]
+            target=_work, args=(child, list(self.pending.items()), limit, retention), daemon=True,
+        )
+        self._process.start()
+        child.close()
+        self._connection = parent
+        asyncio.get_running_loop().add_reader(parent.fileno(), self._readable, received)
+
+    def _readable(self, received: Callable[[_Worker, Optional[bytes]], None]) -> None:
+        assert self._connection is not None
+        while self._connection.poll():
+            try:
+                message = self._connection.recv_bytes()
+            except (EOFError, OSError):
+                self._close_connection()
+                received(self, None)
+                return
+            received(self, message)
+
+    def _close_connection(self) -> None:
+        if self._connection is not None:
+            asyncio.get_running_loop().remove_reader(self._connection.fileno())
+            self._connection.close()
+            self._connection = None
+
+    async def join(self) -> Optional[int]:
+        """ Wait for the process to exit, returning its exit code """
+        if self._process is None:
+            return None
+        process, self._process = self._process, None
+        await asyncio.get_running_loop().run_in_executor(None, process.join)
+        return process.exitcode
+
+    async def stop(self) -> None:
+        self._close_connection()
+        if self._process is not None and self._process.is_alive():
+            self._process.kill()
+        await self.join()
+
+
+class ShardedCommandSet(AsyncCommand[CommandSetResult]):
+    """ Runs its commands in `shards` worker processes, partitioned by the hash of the commands; every worker runs
+    its share on its own loop, like a CommandSet. The results stream back to this process, are yielded in order
+    of completion, and decide success with succeeds_if, as those of a CommandSet.
+
+    A worker that exits before every command of its shard has a result is started again with the commands that
+    have none, at most `restarts` times; after that they get an error result, as does a command that raised an
+    exception in its worker. Workers are started by a forkserver where there is one, else spawned, unless
+    mp_context says otherwise: a forked worker would inherit the threads of this process, like the loop thread of
+    the synchronous API, without them running. Commands and their results have to be picklable. The results keep
+    referring to the commands given here; nested commands are copies.
+
+    The concurrency limit applies to every worker on its own; there is no single flight or rate limiting across
+    the workers. When the timeout expires, the workers are stopped and the commands without result time out. """
+    commands: tuple[Command, ...]
+    shards: int
+    restarts: int
+    _succeeds_if: Callable[[Iterable], bool]
+    _concurrency: Optional[ConcurrencyLimit]
+    _retention: Optional[Retention]
+    _context: BaseContext
+    _limited = False
+
+    def __init__(self, *commands: Command, shards: Optional[int] = None,
+                 succeeds_if: Callable[[Iterable], bool] = ALL_SUCCEED, concurrency: Optional[ConcurrencyLimit] = None,
+                 timeout: Optional[float] = None, restarts: int = 3, mp_context: Optional[BaseContext] = None,
+                 retention: Optional[Retention] = None):
+        self.commands = commands
+        self.shards = max(1, min(shards or os.cpu_count() or 1, len(commands)))
+        self.restarts = restarts
+        self._succeeds_if = succeeds_if
+        self._concurrency = concurrency
+        self.timeout = timeout
+        self._context = mp_context or _default_context()
+        self._retention = retention
+
+    @classmethod
+    def of(cls, command_set: CommandSet, shards: Optional[int] = None, *, restarts: int = 3,
+           mp_context: Optional[BaseContext] = None) -> ShardedCommandSet:
+        """ Sharded version of command_set, with its succeeds_if, concurrency limit, timeout and retention """
+        return cls(*command_set.commands, shards=shards, succeeds_if=command_set._succeeds_if,
+                   concurrency=command_set._concurrency, timeout=command_set.timeout, restarts=restarts,
+                   mp_context=mp_context, retention=command_set._retention)
+
+    async def run(self) -> CommandSetResult:
+        # for the deadline, and the node of the set when profiled; the workers run with the settings of the set
+        scope = _Scope.of(self, None, None, None)
+        return CommandSetResult(
+            command=self,
+            iterator=scope.walk(self, self._walk(scope.deadline)),
+            succeeds_if=self._succeeds_if,
+        )
+
+    def __str__(self) -> str:
+        return '\n'.join((str(command) for command in self.commands))
+
+    def __hash__(self) -> int:
+        return id(self)
+
+    async def _walk(self, deadline: Optional[float]) -> AsyncIterator[CommandResult]:
+        workers = [_Worker(shard) for shard in range(self.shards)]
+        for index, command in enumerate(self.commands):
+            workers[hash(command) % self.shards].pending[index] = command
+        messages: asyncio.Queue[tuple[_Worker, Optional[bytes]]] = asyncio.Queue()
+
+        def received(worker: _Worker, message: Optional[bytes]) -> None:
+            messages.put_nowait((worker, message))
+
+        running = set()
+        for worker in workers:
+            if worker.pending:
+                worker.start(self._context, self._concurrency, self._retention, received)
+                running.add(worker)
+        commands = list(self.commands)
+        try:
+            while running:
+                try:
+                    worker, message = await asyncio.wait_for(messages.get(), _remaining(deadline))
+                except asyncio.TimeoutError:
+                    for worker in running:
+                        for command in worker.pending.values():
+                            yield _TimedOutResult('', command)
+                    return
+                if message is not None:
+                    index, results = _Unpickler(io.BytesIO(message), commands).load()
+                    del worker.pending[index]
+                    if isinstance(results, BaseException):
+                        yield _CommandResult.Error(f'Worker of shard {worker.shard} raised {results!r}', commands[index])
+                        continue
+                    for result in results:
+                        yield result
+                    continue
+                exitcode = await worker.join()
+                if not worker.pending:
+                    running.discard(worker)
+                elif worker.restarts < self.restarts:
+                    worker.restarts += 1
+                    worker.start(self._context, self._concurrency, self._retention, received)
+                else:
+                    running.discard(worker)
+                    for command in worker.pending.values():
+                        yield _CommandResult.Error(f'Worker of shard {worker.shard} exited with code {exitcode}', command)
+        finally:
+            await asyncio.gather(*(worker.stop() for worker in workers))
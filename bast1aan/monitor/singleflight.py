@@ -0,0 +1,71 @@
+""" Sharing one run of a command between everyone asking for it at the same time """
+from __future__ import annotations
+
+import asyncio
+from contextvars import ContextVar
+from typing import Optional, Callable, Awaitable, Hashable, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from bast1aan.monitor.base import CommandResult
+
+current: ContextVar[Optional[SingleFlight]] = ContextVar('current', default=None)
+
+
+class SingleFlight:
+    """ Deduplicates runs of equal commands: while a command runs, everyone running an equal command gets
+    the result of that same run. With a ttl, results are also kept for that many seconds after the run,
+    so they can be reused across scheduler cycles; at most max_cached results are kept. """
+    ttl: float
+    max_cached: int
+    _flights: dict[Hashable, tuple[asyncio.Future[CommandResult], int]]
+    _cache: dict[Hashable, tuple[float, CommandResult]]
+
+    def __init__(self, ttl: float = 0.0, max_cached: int = 10000):
+        self.ttl = ttl
+        self.max_cached = max_cached
+        self._flights = {}
+        self._cache = {}
+
+    def __len__(self) -> int:
+        """ Number of runs in flight """
+        return len(self._flights)
+
+    async def run(self, key: Hashable, run: Callable[[], Awaitable[CommandResult]]) -> CommandResult:
+        loop = asyncio.get_running_loop()
+        if self.ttl and (cached := self._cache.get(key)) is not None:
+            if cached[0] > loop.time():
+                return cached[1]
+            del self._cache[key]
+        future: asyncio.Future[CommandResult]
+        if (flight := self._flights.get(key)) is None:
+            future = asyncio.ensure_future(run())
+            future.add_done_callback(lambda f: self._landed(key, f))
+            waiters = 0
+        else:
+            future, waiters = flight
+        self._flights[key] = (future, waiters + 1)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # the run is only cancelled when nobody is waiting for it anymore
+            if not future.done() and self._flights[key][1] == 1:
+                future.cancel()
+            raise
+        finally:
+            if not future.done():
+                self._flights[key] = (future, self._flights[key][1] - 1)
+
+    def _landed(self, key: Hashable, future: asyncio.Future[CommandResult]) -> None:
+        del self._flights[key]
+        if not self.ttl or future.cancelled() or future.exception() is not None:
+            return
+        result = future.result()
+        if result.cancelled or result.timed_out:
+            return
+        if len(self._cache) >= self.max_cached:
+            now = asyncio.get_running_loop().time()
+            for expired in [k for k, (expires, _) in self._cache.items() if expires <= now]:
+                del self._cache[expired]
+            while len(self._cache) >= self.max_cached:
+                del self._cache[next(iter(self._cache))]
+        self._cache[key] = (asyncio.get_running_loop().time() + self.ttl, result)
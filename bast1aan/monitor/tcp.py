@@ -0,0 +1,119 @@
+""" Checking whether TCP ports accept connections, with asyncio streams instead of a process per check """
+from __future__ import annotations
+
+import asyncio
+import os
+import socket
+import ssl
+import time
+from dataclasses import dataclass
+from typing import Literal, Optional, ClassVar
+
+from bast1aan.monitor._util import frozen_dataclass
+from bast1aan.monitor.base import AsyncCommand, CommandResult, Command, _within_deadline, _deadline_for
+from bast1aan.monitor.ping import IPV4, IPV6
+from bast1aan.monitor.resolver import Resolver, host
+
+
+@dataclass
+class Connection:
+    """ Connection made by connect(); address is what the target resolved to and was connected to, resolution and
+    connect the seconds resolving and connecting (including a TLS handshake) took """
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+    address: str
+    resolution: float
+    connect: float
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+async def connect(target: str, port: int, only: Literal[0, 4, 6] = 0, resolver: Optional[Resolver] = None,
+                  ssl_context: Optional[ssl.SSLContext] = None) -> Connection:
+    """ Connect to the first address of target that accepts the connection. Raises socket.gaierror when target
+    does not resolve, otherwise the OSError of connecting to the last address. """
+    family = {IPV4: socket.AF_INET, IPV6: socket.AF_INET6}.get(only, socket.AF_UNSPEC)
+    resolving = time.perf_counter()
+    if resolver is not None:
+        addresses = [host(address) for address in await resolver.resolve(target, family)]
+    else:
+        loop = asyncio.get_running_loop()
+        infos = await loop.getaddrinfo(target, port, family=family, type=socket.SOCK_STREAM)
+        addresses = [host((info[0], info[4])) for info in infos]
+    resolution = time.perf_counter() - resolving
+    error: Optional[OSError] = None
+    for address in addresses:
+        connecting = time.perf_counter()
+        try:
+            reader, writer = await asyncio.open_connection(
+                address, port, ssl=ssl_context, server_hostname=target if ssl_context is not None else None,
+            )
+        except OSError as e:
+            error = e
+            continue
+        return Connection(reader, writer, address, resolution, time.perf_counter() - connecting)
+    assert error is not None
+    raise error
+
+
+def _reason(error: OSError) -> str:
+    """ Description of error; asyncio puts the address in the strerror of failed connects """
+    return os.strerror(error.errno) if error.errno else str(error)
+
+
+class TcpResult(CommandResult):
+    """ Result of a TcpCommand, times in seconds """
+    __slots__ = ('ok', 'command', 'message', 'address', 'resolution', 'connect')
+    ok: bool
+    command: Command
+    message: str
+    address: Optional[str]
+    resolution: Optional[float]
+    connect: Optional[float]
+
+    def __init__(self, ok: bool, command: Command, message: str = '', address: Optional[str] = None,
+                 resolution: Optional[float] = None, connect: Optional[float] = None):
+        self.ok = ok
+        self.command = command
+        self.message = message
+        self.address = address
+        self.resolution = resolution
+        self.connect = connect
+
+    def __bool__(self) -> bool:
+        return self.ok
+
+    def __str__(self) -> str:
+        return self.message
+
+
+@frozen_dataclass(eq=True)
+class TcpCommand(AsyncCommand):
+    """ Succeeds when target accepts a connection on port, which is closed again right away """
+    target: str
+    port: int
+    only: Literal[0, 4, 6] = 0
+    timeout: Optional[float] = None
+    _keeps_deadline = True
+    # resolves targets before connecting; None resolves them on every connect
+    resolver: ClassVar[Optional[Resolver]] = Resolver()
+
+    async def run(self) -> CommandResult:
+        return await _within_deadline(self, self._connect(), _deadline_for(self))
+
+    async def _connect(self) -> TcpResult:
+        try:
+            connection = await connect(self.target, self.port, self.only, self.resolver)
+        except socket.gaierror as e:
+            return TcpResult(False, self, f'{self}: {e.strerror}')
+        except OSError as e:
+            return TcpResult(False, self, f'{self}: {_reason(e)}')
+        connection.close()
+        return TcpResult(
+            True, self, f'Connected to {self} ({connection.address}) in {connection.connect * 1000:.1f} ms',
+            connection.address, connection.resolution, connection.connect,
+        )
+
+    def __str__(self) -> str:
+        return f'{self.target}:{self.port}'
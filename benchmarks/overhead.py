@@ -0,0 +1,210 @@
+""" Overhead of the framework itself: command sets, depending chains, retries and result handling, run on
+synthetic commands of tunable latency, plus the spawn cost of ExecutorCommand.
+
+Every scenario is repeated, reporting throughput in commands per second, p50/p99 latency of one repetition and
+the peak memory traced during a separate repetition (tracing slows down the timed ones otherwise).
+
+Run with: python -m benchmarks.overhead [--json] [--repeat N] [--latency SECONDS] [--scale FACTOR] [scenario ...]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass, asdict
+from typing import Any, Callable, Awaitable, Optional
+
+from bast1aan.monitor import CommandSet, DependingCommandSet, try_until_succeeds
+from bast1aan.monitor.base import AsyncCommand, CommandResult, CommandSetResult, _CommandResult
+
+from benchmarks.spawn import ExecUname, CachedExecUname
+
+
+class Latency(AsyncCommand):
+    """ Command taking `latency` seconds, succeeding on runs for which `ok` says so """
+    latency: float
+    ok: Callable[[int], bool]
+    runs: int
+
+    def __init__(self, latency: float = 0.0, ok: Callable[[int], bool] = lambda run: True):
+        self.latency = latency
+        self.ok = ok
+        self.runs = 0
+
+    async def run(self) -> CommandResult:
+        self.runs += 1
+        await asyncio.sleep(self.latency)
+        return _CommandResult(self.ok(self.runs), 'latency %s run %d' % (self.latency, self.runs), self)
+
+    def __str__(self) -> str:
+        return f'Latency {self.latency}'
+
+    def __hash__(self) -> int:
+        return id(self)
+
+
+@dataclass
+class Scenario:
+    name: str
+    commands: int
+    # builds the function running one repetition; a coroutine function unless sync
+    build: Callable[[], Callable[[], Any]]
+    # repetitions run through the sync API, outside of an event loop
+    sync: bool = False
+
+
+@dataclass
+class Measurement:
+    name: str
+    commands: int
+    repeat: int
+    throughput: float
+    p50_ms: float
+    p99_ms: float
+    peak_memory_kib: float
+
+
+async def _walk(result: CommandResult) -> None:
+    if isinstance(result, CommandSetResult):
+        async for _ in result:
+            pass
+
+
+def scenarios(latency: float, scale: float) -> list[Scenario]:
+    wide = max(1, int(10000 * scale))
+    deep = max(1, int(200 * scale))
+    count = max(1, int(1000 * scale))
+    spawns = max(1, int(20 * scale))
+
+    def wide_commandset() -> Callable[[], Awaitable[object]]:
+        command_set = CommandSet(*(Latency(latency) for _ in range(wide)))
+        return lambda: _walk_run(command_set)
+
+    def deep_depending_chain() -> Callable[[], Awaitable[object]]:
+        command: AsyncCommand = Latency(latency)
+        for _ in range(deep - 1):
+            command = DependingCommandSet(Latency(latency), if_succeeds=command)
+        return lambda: _walk_run(command)
+
+    def retry_large_count() -> Callable[[], Awaitable[object]]:
+        def build() -> Awaitable[object]:
+            # fails every attempt but the last, so all of them run
+            return _walk_run(try_until_succeeds(Latency(latency, lambda run: run == count), count=count))
+        return build
+
+    def sync_iteration_and_str() -> Callable[[], None]:
+        command_set = CommandSet(*(Latency(latency) for _ in range(wide)))
+
+        def iterate() -> None:
+            result = command_set()
+            for _ in result:
+                pass
+            str(result)
+        return iterate
+
+    def executor_spawn(command: AsyncCommand) -> Callable[[], Callable[[], Awaitable[object]]]:
+        async def spawn() -> None:
+            for _ in range(spawns):
+                assert await command.run()
+        return lambda: spawn
+
+    return [
+        Scenario('wide_commandset', wide, wide_commandset),
+        Scenario('deep_depending_chain', deep, deep_depending_chain),
+        Scenario('try_until_succeeds', count, retry_large_count),
+        Scenario('sync_iteration_and_str', wide, sync_iteration_and_str, sync=True),
+        Scenario('executor_spawn', spawns, executor_spawn(ExecUname())),
+        Scenario('executor_spawn_cached', spawns, executor_spawn(CachedExecUname())),
+    ]
+
+
+async def _walk_run(command: AsyncCommand) -> None:
+    await _walk(await command.run())
+
+
+def _durations(scenario: Scenario, repeat: int) -> list[float]:
+    run = scenario.build()
+    durations = []
+    if scenario.sync:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            durations.append(time.perf_counter() - start)
+        return durations
+
+    async def timed() -> None:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            await run()
+            durations.append(time.perf_counter() - start)
+    asyncio.run(timed())
+    return durations
+
+
+def _peak_memory(scenario: Scenario) -> int:
+    run = scenario.build()
+    tracemalloc.start()
+    try:
+        if scenario.sync:
+            run()
+        else:
+            asyncio.run(run())
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _percentile(durations: list[float], fraction: float) -> float:
+    ordered = sorted(durations)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def measure(scenario: Scenario, repeat: int) -> Measurement:
+    durations = _durations(scenario, repeat)
+    p50 = _percentile(durations, 0.5)
+    return Measurement(
+        name=scenario.name,
+        commands=scenario.commands,
+        repeat=repeat,
+        throughput=scenario.commands / p50 if p50 else 0.0,
+        p50_ms=p50 * 1000,
+        p99_ms=_percentile(durations, 0.99) * 1000,
+        peak_memory_kib=_peak_memory(scenario) / 1024,
+    )
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.overhead', description=__doc__.split('\n\n')[0])
+    parser.add_argument('scenarios', nargs='*', help='names of the scenarios to run, all by default')
+    parser.add_argument('--repeat', type=int, default=10, help='repetitions per scenario')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds every synthetic command takes')
+    parser.add_argument('--scale', type=float, default=1.0, help='factor on the number of commands per scenario')
+    parser.add_argument('--json', action='store_true', help='write the results as JSON, for tracking regressions')
+    args = parser.parse_args(argv)
+
+    selected = [s for s in scenarios(args.latency, args.scale) if not args.scenarios or s.name in args.scenarios]
+    if unknown := set(args.scenarios) - {s.name for s in selected}:
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+    measurements = [measure(scenario, args.repeat) for scenario in selected]
+
+    if args.json:
+        json.dump({
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'latency': args.latency,
+            'scale': args.scale,
+            'results': [asdict(m) for m in measurements],
+        }, sys.stdout, indent=2)
+        print()
+        return
+    for m in measurements:
+        print('%-24s %6d commands  %10.0f /s  p50 %9.3f ms  p99 %9.3f ms  peak %9.1f KiB' % (
+            m.name, m.commands, m.throughput, m.p50_ms, m.p99_ms, m.peak_memory_kib))
+
+
+if __name__ == '__main__':
+    main()
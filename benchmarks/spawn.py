@@ -0,0 +1,57 @@
+""" Spawn latency of ExecutorCommand through the shell, through exec, and through exec with a cached executable.
+
+Run with: python -m benchmarks.spawn [count]
+"""
+from __future__ import annotations
+
+import asyncio
+import statistics
+import sys
+import time
+from typing import ClassVar, Optional, Sequence
+
+from bast1aan.monitor.base import ExecutorCommand
+
+
+class ShellUname(ExecutorCommand):
+    @property
+    def command(self) -> str:
+        return 'uname'
+
+    def __hash__(self) -> int:
+        return hash(self.command)
+
+
+class ExecUname(ShellUname):
+    @property
+    def argv(self) -> Optional[Sequence[str]]:
+        return ('uname',)
+
+
+class CachedExecUname(ExecUname):
+    cache_executable: ClassVar[bool] = True
+
+
+async def measure(command: ExecutorCommand, count: int) -> list[float]:
+    durations = []
+    for _ in range(count):
+        start = time.perf_counter()
+        result = await command.run()
+        durations.append(time.perf_counter() - start)
+        assert result, str(result)
+    return durations
+
+
+def main(count: int = 200) -> None:
+    for command in (ShellUname(), ExecUname(), CachedExecUname()):
+        durations = sorted(asyncio.run(measure(command, count)))
+        print('%-16s mean %.3f ms  p50 %.3f ms  p99 %.3f ms' % (
+            type(command).__name__,
+            statistics.mean(durations) * 1000,
+            durations[len(durations) // 2] * 1000,
+            durations[min(len(durations) - 1, int(len(durations) * 0.99))] * 1000,
+        ))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
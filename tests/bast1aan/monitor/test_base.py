@@ -1,5 +1,15 @@
-from bast1aan.monitor import PingCommand, IPV4, IPV6, CommandSet, DependingCommandSet, ANY_SUCCEEDS, try_until_succeeds
-from bast1aan.monitor.base import AsyncCommand, _CommandResult
+import asyncio
+import os
+import time
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Optional, Sequence, Coroutine
+
+import pytest
+
+from bast1aan.monitor import PingCommand, IPV4, IPV6, CommandSet, DependingCommandSet, ANY_SUCCEEDS, Retry, \
+    try_until_succeeds
+from bast1aan.monitor.base import Command, AsyncCommand, ExecutorCommand, CommandResult, _CommandResult
 
 class OnlySecondSucceeds(AsyncCommand):
     cnt: int
@@ -254,3 +264,363 @@ def test_try_until_succeeds_with_count_3_fails() -> None:
 
     assert cmd.cnt == 5, "All 5 times the command should have been executed"
 
+def test_try_until_succeeds_lists_every_attempt() -> None:
+    command_result = try_until_succeeds(OnlySecondSucceeds(), OnlySecondSucceeds(), count=2)()
+
+    assert [bool(result) for result in command_result] == [False, False, True]
+
+
+class Sleep(AsyncCommand):
+    duration: float
+    ok: bool
+    finished: bool
+    def __init__(self, duration: float, ok: bool = True):
+        self.duration = duration
+        self.ok = ok
+        self.finished = False
+    async def run(self) -> _CommandResult:
+        await asyncio.sleep(self.duration)
+        self.finished = True
+        return _CommandResult(self.ok, str(self), self)
+    def __str__(self) -> str:
+        return f"Sleep {self.duration=} {self.ok=}"
+    def __hash__(self) -> int:
+        return id(self)
+
+class Shell(ExecutorCommand):
+    def __init__(self, command: str, timeout: Optional[float] = None):
+        self._command = command
+        self.timeout = timeout
+    @property
+    def command(self) -> str:
+        return self._command
+    def __hash__(self) -> int:
+        return hash(self._command)
+
+def test_short_circuit_any_succeeds_cancels_outstanding() -> None:
+    command_set = CommandSet(
+        fast := Sleep(0.01),
+        slow := Sleep(5),
+        CommandSet(nested_slow1 := Sleep(5), nested_slow2 := Sleep(5)),
+        succeeds_if=ANY_SUCCEEDS,
+        short_circuit=True,
+    )
+    before = time.monotonic()
+    result_set = command_set()
+    assert bool(result_set) is True
+    assert time.monotonic() - before < 1
+    results = {result.command: result for result in result_set}
+    assert bool(results[fast]) is True
+    assert results[slow].cancelled and not results[slow].error
+    assert results[nested_slow1].cancelled and results[nested_slow2].cancelled
+    assert not slow.finished
+
+def test_short_circuit_all_succeed_stops_at_first_failure() -> None:
+    command_set = CommandSet(
+        Sleep(0.01, ok=False),
+        CommandSet(Sleep(0.02), Sleep(5)),
+        short_circuit=True,
+    )
+    before = time.monotonic()
+    result_set = command_set()
+    assert bool(result_set) is False
+    assert time.monotonic() - before < 1
+    assert [result.cancelled for result in result_set].count(True) == 2
+    assert [result.error for result in result_set].count(True) == 1
+
+def test_short_circuit_cancels_nested_set_being_walked() -> None:
+    command_set = CommandSet(
+        CommandSet(Sleep(0.01), nested_slow := Sleep(5)),
+        succeeds_if=ANY_SUCCEEDS,
+        short_circuit=True,
+    )
+    result_set = command_set()
+    assert bool(result_set) is True
+    assert [result.command for result in result_set if result.cancelled] == [nested_slow]
+
+def test_short_circuit_kills_subprocess() -> None:
+    command_set = CommandSet(Sleep(0.1), Shell('sleep 5'), succeeds_if=ANY_SUCCEEDS, short_circuit=True)
+    before = time.monotonic()
+    assert bool(command_set()) is True
+    assert time.monotonic() - before < 1
+
+def test_short_circuit_requires_any_or_all() -> None:
+    with pytest.raises(ValueError):
+        CommandSet(Sleep(0.01), succeeds_if=lambda results: True, short_circuit=True)
+
+def test_without_short_circuit_everything_runs() -> None:
+    command_set = CommandSet(Sleep(0.01), slow := Sleep(0.2), succeeds_if=ANY_SUCCEEDS)
+    result_set = command_set()
+    assert len(list(result_set)) == 2
+    assert slow.finished
+
+def test_without_short_circuit_nested_sets_are_walked_one_after_the_other() -> None:
+    before = time.monotonic()
+    result_set = CommandSet(CommandSet(Sleep(0.1), Sleep(0.3)), CommandSet(Sleep(0.2)))()
+    assert [result.command.duration for result in result_set] == [0.1, 0.3, 0.2]  # type: ignore[attr-defined]
+    assert time.monotonic() - before < 0.45, "Nested sets start right away"
+
+def test_command_timeout_keeps_partial_output_and_kills_process_group() -> None:
+    command = Shell('echo $$; echo partial; sleep 30 & sleep 30', timeout=0.3)
+    before = time.monotonic()
+    result = command()
+    assert time.monotonic() - before < 1
+    assert bool(result) is False
+    assert result.timed_out and result.error
+    assert 'partial' in str(result)
+    pgid = int(str(result).split()[0])
+    for _ in range(20):
+        # signals to the rest of the group are delivered asynchronously
+        if not _running_in_process_group(pgid):
+            break
+        time.sleep(0.05)
+    assert _running_in_process_group(pgid) == []
+
+def _running_in_process_group(pgid: int) -> list[str]:
+    running = []
+    for pid in filter(str.isdigit, os.listdir('/proc')):
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                state, _, group = f.read().rsplit(')', 1)[1].split()[:3]
+        except OSError:
+            continue
+        if int(group) == pgid and state != 'Z':
+            running.append(pid)
+    return running
+
+def test_command_within_timeout() -> None:
+    result = Shell('echo done', timeout=5)()
+    assert bool(result) is True
+    assert not result.timed_out
+    assert str(result).startswith('done')
+
+def test_commandset_timeout() -> None:
+    command_set = CommandSet(slow := Sleep(5), fast := Sleep(0.01), Shell('sleep 5'), timeout=0.3)
+    before = time.monotonic()
+    results = {result.command: result for result in command_set()}
+    assert time.monotonic() - before < 1
+    assert results[slow].timed_out
+    assert not results[fast].timed_out and bool(results[fast]) is True
+    assert [result.timed_out for result in results.values()].count(True) == 2
+
+def test_timeout_propagates_to_nested_sets() -> None:
+    # nested sets are walked one after the other, the second only gets what is left of the timeout
+    command_set = CommandSet(
+        DependingCommandSet(Sleep(0.01), if_succeeds=Sleep(5), timeout=10),
+        CommandSet(Shell('sleep 5', timeout=10), timeout=10),
+        timeout=0.3,
+    )
+    before = time.monotonic()
+    result_set = command_set()
+    assert sorted(result.timed_out for result in result_set) == [False, True, True]
+    assert time.monotonic() - before < 1
+    assert bool(result_set) is False
+
+def test_own_timeout_without_limits() -> None:
+    slow = Sleep(5)
+    slow.timeout = 0.1
+    before = time.monotonic()
+    assert slow().timed_out
+    result_set = CommandSet(slow)()
+    assert [result.timed_out for result in result_set] == [True]
+    assert time.monotonic() - before < 1
+    assert not slow.finished
+
+class Exec(Shell):
+    cache_executable = True
+    def __init__(self, *argv: str):
+        super().__init__(' '.join(argv))
+        self._argv = argv
+    @property
+    def argv(self) -> Sequence[str]:
+        return self._argv
+
+def test_exec_without_shell() -> None:
+    result = Exec('echo', 'no $shell; expansion')()
+    assert bool(result) is True
+    assert str(result).startswith('no $shell; expansion')
+
+def test_exec_not_found() -> None:
+    result = Exec('nonexistent-command', '-x')()
+    assert bool(result) is False
+    assert 'nonexistent-command: command not found' in str(result)
+
+def test_output_limit() -> None:
+    command = Shell('seq 100000; exit 3')
+    command.output_limit = 1000
+    result = command()
+    assert bool(result) is False
+    msg = str(result)
+    assert msg.startswith('1\n2\n3\n')
+    assert msg.rstrip().endswith('99999\n100000')
+    assert 'bytes dropped ...]' in msg
+    assert len(msg) < 1100
+
+def test_stream_lines_while_running() -> None:
+    async def stream() -> tuple[list[tuple[bytes, float]], CommandResult]:
+        execution = await Shell('echo first; sleep 0.3; echo second; echo third >&2').start(stream=True)
+        lines = [(line, time.monotonic()) async for line in execution]
+        return lines, await execution.result()
+
+    before = time.monotonic()
+    lines, result = asyncio.run(stream())
+    assert sorted(line for line, _ in lines) == [b'first', b'second', b'third']
+    assert lines[0][0] == b'first' and lines[0][1] - before < 0.25, "First line arrives before the command ends"
+    assert bool(result) is True
+    assert str(result) == 'first\nsecond\n\nthird\n'
+
+def test_result_without_iterating_stream() -> None:
+    async def run() -> CommandResult:
+        execution = await Shell('seq 10000').start(stream=True)
+        return await execution.result()
+
+    result = asyncio.run(run())
+    assert bool(result) is True
+    assert str(result).endswith('10000\n\n')
+
+def test_sync_calls_from_threads_overlap() -> None:
+    commands = [Sleep(0.3) for _ in range(10)]
+    before = time.monotonic()
+    with ThreadPoolExecutor(len(commands)) as executor:
+        results = list(executor.map(lambda command: command(), commands))
+    assert all(results)
+    assert time.monotonic() - before < 1.0, "Commands called from different threads run at the same time"
+
+def test_sync_call_within_running_loop() -> None:
+    async def call() -> CommandResult:
+        return Sleep(0.01)()
+
+    assert bool(asyncio.run(call())) is True
+
+def test_sync_call_within_command_raises() -> None:
+    class CallsSync(AsyncCommand):
+        async def run(self) -> CommandResult:
+            return Sleep(0.01)()
+        def __str__(self) -> str:
+            return 'CallsSync'
+        def __hash__(self) -> int:
+            return id(self)
+
+    with pytest.raises(RuntimeError):
+        CallsSync()()
+
+def test_results_kept_after_stopping_early() -> None:
+    ok, fail, ok2 = Sleep(0.01), Sleep(0.02, ok=False), Sleep(0.03)
+    result = CommandSet(ok, fail, ok2, succeeds_if=ANY_SUCCEEDS)()
+    assert bool(result) is True, "Stops walking at the first success"
+    assert str(result).splitlines() == [str(ok), str(fail), str(ok2)]
+    assert [r.command for r in result] == [ok, fail, ok2]
+
+def test_sync_walk_takes_the_results_that_are_there_at_once(monkeypatch: pytest.MonkeyPatch) -> None:
+    from bast1aan.monitor import base
+    calls = []
+    run_async = base.run_async
+
+    def counted(coro: Coroutine) -> object:
+        calls.append(coro)
+        return run_async(coro)
+
+    monkeypatch.setattr(base, 'run_async', counted)
+    result = CommandSet(*(Sleep(0) for _ in range(100)), CommandSet(*(Sleep(0) for _ in range(100))))()
+    calls.clear()
+    assert len(list(result)) == 200
+    assert len(calls) < 10, "No round trip to the loop thread for every result"
+
+class FailsTimes(AsyncCommand):
+    times: int
+    starts: list[float]
+    def __init__(self, times: int):
+        self.times = times
+        self.starts = []
+    async def run(self) -> CommandResult:
+        self.starts.append(time.monotonic())
+        return _CommandResult(len(self.starts) > self.times, f'attempt {len(self.starts)}', self)
+    def __str__(self) -> str:
+        return f"FailsTimes {self.times=}"
+    def __hash__(self) -> int:
+        return id(self)
+
+def test_retry_backs_off_exponentially() -> None:
+    command = FailsTimes(3)
+    result = Retry(command, attempts=5, backoff=0.05, jitter=0)()
+    assert bool(result) is True
+    assert [str(r) for r in result] == ['attempt 4']
+    gaps = [b - a for a, b in zip(command.starts, command.starts[1:])]
+    for gap, delay in zip(gaps, (0.05, 0.1, 0.2)):
+        assert delay <= gap < delay + 0.05
+
+def test_retry_keeps_last_round_only() -> None:
+    commands = (FailsTimes(10000), FailsTimes(10000))
+    result = Retry(*commands, attempts=1000)()
+    assert bool(result) is False
+    assert [str(r) for r in result] == ['attempt 1000', 'attempt 1000']
+
+def test_retry_stops_at_deadline() -> None:
+    command = FailsTimes(100)
+    before = time.monotonic()
+    result = Retry(command, attempts=100, backoff=0.1, factor=1, jitter=0, timeout=0.35)()
+    assert bool(result) is False
+    assert time.monotonic() - before < 0.35
+    assert len(command.starts) == 4, "No attempt is started that would begin after the deadline"
+
+def test_retry_race() -> None:
+    slow, fast = Sleep(5), Sleep(0.05)
+    before = time.monotonic()
+    result = Retry(slow, fast, race=True)()
+    assert bool(result) is True
+    assert time.monotonic() - before < 1
+    assert {r.cancelled for r in result} == {True, False}
+    assert fast.finished and not slow.finished
+
+def test_retry_race_retries_round() -> None:
+    commands = (FailsTimes(2), FailsTimes(5))
+    result = Retry(*commands, attempts=3, race=True)()
+    assert bool(result) is True
+    assert len(commands[0].starts) == 3
+    assert len(commands[1].starts) >= 2
+
+class Blocking(Command):
+    """ Synchronous command occupying its thread for duration seconds """
+    duration: float
+    ok: bool
+    def __init__(self, duration: float, ok: bool = True):
+        self.duration = duration
+        self.ok = ok
+    def __call__(self) -> CommandResult:
+        time.sleep(self.duration)
+        return _CommandResult(self.ok, str(self), self)
+    def __str__(self) -> str:
+        return f"Blocking {self.duration=} {self.ok=}"
+    def __hash__(self) -> int:
+        return hash((self.duration, self.ok))
+
+def test_sync_commands_run_concurrently() -> None:
+    command_set = CommandSet(*(Blocking(0.2) for _ in range(5)), Sleep(0.2))
+    before = time.monotonic()
+    result = command_set()
+    assert bool(result) is True
+    assert len(list(result)) == 6
+    assert time.monotonic() - before < 0.6, "Synchronous commands run in threads, next to asynchronous ones"
+
+def test_sync_results_in_order_of_completion() -> None:
+    result = CommandSet(Blocking(0.2), Sleep(0.1), Blocking(0.01))()
+    assert [str(r) for r in result] == [
+        str(Blocking(0.01)), str(Sleep(0.1)), str(Blocking(0.2))
+    ]
+
+def test_sync_commands_in_process_pool() -> None:
+    with ProcessPoolExecutor(4, mp_context=multiprocessing.get_context('fork')) as executor:
+        result = CommandSet(*(Blocking(0.2, ok=i != 2) for i in range(4)), executor=executor)()
+        assert sorted(bool(r) for r in result) == [False, True, True, True]
+        assert bool(result) is False
+
+def test_sync_commands_short_circuit_and_timeout() -> None:
+    before = time.monotonic()
+    result = CommandSet(Blocking(0.5), Blocking(0.01, ok=False), short_circuit=True)()
+    assert bool(result) is False
+    assert time.monotonic() - before < 0.4, "The outstanding call is abandoned"
+    assert [r.cancelled for r in result] == [False, True]
+
+    result = CommandSet(Blocking(0.5), Blocking(0.01), timeout=0.1)()
+    assert [r.timed_out for r in result] == [False, True]
+    assert bool(result) is False
@@ -0,0 +1,117 @@
+import asyncio
+import tracemalloc
+from typing import Iterable
+
+import pytest
+
+from bast1aan.monitor import CommandSet
+from bast1aan.monitor.base import AsyncCommand, CommandResult, _CommandResult, _CancelledResult
+from bast1aan.monitor.changes import StateTracker, ChangeStream, Change
+
+
+class Outcomes(AsyncCommand):
+    """ Succeeds or fails on every run as the next of outcomes says """
+    name: str
+    outcomes: list[bool]
+    def __init__(self, name: str, outcomes: Iterable[bool]):
+        self.name = name
+        self.outcomes = list(outcomes)
+    async def run(self) -> CommandResult:
+        return _CommandResult(self.outcomes.pop(0), self.name, self)
+    def __str__(self) -> str:
+        return self.name
+    def __hash__(self) -> int:
+        return hash(self.name)
+
+
+def _changes(tracker: StateTracker, command: Outcomes, runs: int) -> list[tuple[int, bool, bool]]:
+    changes = []
+    for run in range(runs):
+        if (change := tracker.update(command())) is not None:
+            changes.append((run, change.ok, change.flapping))
+    return changes
+
+
+def test_only_changes_are_reported() -> None:
+    stable = Outcomes('stable', [True] * 5)
+    toggles = Outcomes('toggles', [True, True, False, False, True])
+    stream = ChangeStream()
+
+    async def run() -> list[Change]:
+        command_set = CommandSet(stable, toggles)
+        counts = [await stream.feed(await command_set.run()) for _ in range(5)]
+        assert counts == [2, 0, 1, 0, 1]
+        await stream.close()
+        return [change async for change in stream]
+
+    changes = asyncio.run(run())
+    described = [(str(c.command), c.previous, c.ok) for c in changes]
+    assert sorted(described[:2]) == [('stable', None, True), ('toggles', None, True)]
+    assert described[2:] == [('toggles', True, False), ('toggles', False, True)]
+
+
+def test_hysteresis() -> None:
+    tracker = StateTracker(rise=2, fall=3, report_initial=False)
+    command = Outcomes('check', [True, False, False, True, False, False, False, True, True])
+    assert _changes(tracker, command, 9) == [(6, False, False), (8, True, False)]
+    assert tracker.state(command) is True
+
+
+def test_flapping_is_reported_once() -> None:
+    tracker = StateTracker(report_initial=False)
+    command = Outcomes('flaps', [True, False] * 10 + [False] * 20)
+    changes = _changes(tracker, command, 40)
+    assert changes[:10] == [(run, run % 2 == 0, False) for run in range(1, 11)]
+    assert changes[10:] == [(11, True, True), (35, False, False)], \
+        "Flapping is reported once, then nothing until the command settles on a state"
+    assert tracker.state(command) is False
+
+
+def test_ignores_cancelled_results() -> None:
+    tracker = StateTracker()
+    command = Outcomes('check', [True])
+    tracker.update(command())
+    assert tracker.update(_CancelledResult(command)) is None
+    assert tracker.state(command) is True
+
+
+def test_backpressure() -> None:
+    stream = ChangeStream(StateTracker(), maxsize=2)
+    commands = [Outcomes(f'check{i}', [True]) for i in range(5)]
+
+    async def run() -> None:
+        feeding = asyncio.ensure_future(stream.feed([command() for command in commands]))
+        await asyncio.sleep(0.01)
+        assert not feeding.done() and stream.queue.qsize() == 2, "Feeding waits for the consumer"
+        received = []
+        async for change in stream:
+            received.append(change)
+            if len(received) == 5:
+                break
+        assert await feeding == 5
+
+    asyncio.run(run())
+
+
+def test_steady_state_does_not_allocate() -> None:
+    tracker = StateTracker()
+    commands = [Outcomes(f'check{i}', []) for i in range(1000)]
+    results = [_CommandResult(True, 'ok', command) for command in commands]
+    tracemalloc.start()
+    try:
+        # until the outcomes of the last runs are all known
+        for _ in range(25):
+            for result in results:
+                tracker.update(result)
+        before = tracemalloc.get_traced_memory()[0]
+        for _ in range(10):
+            for result in results:
+                assert tracker.update(result) is None
+        assert tracemalloc.get_traced_memory()[0] - before < 1024
+    finally:
+        tracemalloc.stop()
+
+
+def test_rise_and_fall_at_least_one() -> None:
+    with pytest.raises(ValueError):
+        StateTracker(rise=0)
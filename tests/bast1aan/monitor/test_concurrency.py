@@ -0,0 +1,97 @@
+import asyncio
+from dataclasses import dataclass
+
+from bast1aan.monitor import CommandSet, DependingCommandSet
+from bast1aan.monitor.base import AsyncCommand, CommandResult, _CommandResult
+from bast1aan.monitor.concurrency import ConcurrencyLimit
+
+
+class Tracker:
+    running: int = 0
+    max_running: int = 0
+    per_target: dict[str, int]
+    max_per_target: dict[str, int]
+
+    def __init__(self):
+        self.per_target = {}
+        self.max_per_target = {}
+
+
+@dataclass(eq=False)
+class Sleep(AsyncCommand):
+    tracker: Tracker
+    target: str = 'somewhere'
+    duration: float = 0.01
+
+    async def run(self) -> CommandResult:
+        self.tracker.running += 1
+        self.tracker.max_running = max(self.tracker.max_running, self.tracker.running)
+        self.tracker.per_target[self.target] = self.tracker.per_target.get(self.target, 0) + 1
+        self.tracker.max_per_target[self.target] = max(
+            self.tracker.max_per_target.get(self.target, 0), self.tracker.per_target[self.target])
+        await asyncio.sleep(self.duration)
+        self.tracker.per_target[self.target] -= 1
+        self.tracker.running -= 1
+        return _CommandResult.Ok(str(self), self)
+
+    def __str__(self) -> str:
+        return f'sleep {self.target} {self.duration}'
+
+    def __hash__(self) -> int:
+        return id(self)
+
+
+class Sleep2(Sleep):
+    pass
+
+
+def test_unlimited() -> None:
+    tracker = Tracker()
+    result = CommandSet(*(Sleep(tracker) for _ in range(20)))()
+    assert len(list(result)) == 20
+    assert tracker.max_running == 20
+
+
+def test_total_limit_is_shared_with_nested_sets() -> None:
+    tracker = Tracker()
+    command_set = CommandSet(
+        *(Sleep(tracker) for _ in range(10)),
+        CommandSet(*(Sleep(tracker) for _ in range(10))),
+        DependingCommandSet(Sleep(tracker), if_succeeds=CommandSet(*(Sleep(tracker) for _ in range(10)))),
+        concurrency=ConcurrencyLimit(3),
+    )
+    result = command_set()
+    assert len(list(result)) == 31
+    assert bool(result) is True
+    assert tracker.max_running == 3
+
+
+def test_per_target_limit() -> None:
+    tracker = Tracker()
+    limit = ConcurrencyLimit(per_target=2)
+    command_set = CommandSet(*(Sleep(tracker, target=f'host{i % 3}') for i in range(30)), concurrency=limit)
+    assert len(list(command_set())) == 30
+    assert tracker.max_per_target == {'host0': 2, 'host1': 2, 'host2': 2}
+    assert tracker.max_running == 6
+    assert limit._targets is not None and len(limit._targets) == 0, "Idle target semaphores are dropped"
+
+
+def test_per_class_limit() -> None:
+    tracker = Tracker()
+    tracker2 = Tracker()
+    command_set = CommandSet(
+        *(Sleep(tracker) for _ in range(10)),
+        *(Sleep2(tracker2) for _ in range(10)),
+        concurrency=ConcurrencyLimit(per_class={Sleep: 2}),
+    )
+    assert len(list(command_set())) == 20
+    assert tracker.max_running == 2
+    assert tracker2.max_running == 10
+
+
+def test_results_in_completion_order() -> None:
+    tracker = Tracker()
+    slow = Sleep(tracker, duration=0.2)
+    fast = Sleep(tracker, duration=0.01)
+    result = CommandSet(slow, fast, concurrency=ConcurrencyLimit(2))()
+    assert [r.command for r in result] == [fast, slow]
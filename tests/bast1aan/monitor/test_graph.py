@@ -0,0 +1,127 @@
+import asyncio
+import time
+from typing import Optional
+
+import pytest
+
+from bast1aan.monitor import CommandSet, DependingCommandSet, Graph, ANY_SUCCEEDS
+from bast1aan.monitor.base import AsyncCommand, CommandResult, _CommandResult
+
+
+class Check(AsyncCommand):
+    name: str
+    ok: bool
+    duration: float
+    log: list[tuple[str, str]]
+
+    def __init__(self, name: str, ok: bool = True, duration: float = 0.0, log: Optional[list[tuple[str, str]]] = None):
+        self.name = name
+        self.ok = ok
+        self.duration = duration
+        self.log = [] if log is None else log
+
+    async def run(self) -> CommandResult:
+        self.log.append(('start', self.name))
+        await asyncio.sleep(self.duration)
+        self.log.append(('end', self.name))
+        return _CommandResult(self.ok, self.name, self)
+
+    def __str__(self) -> str:
+        return self.name
+
+    def __hash__(self) -> int:
+        return id(self)
+
+
+def test_shared_prerequisite_runs_once_and_dependents_in_parallel() -> None:
+    log: list[tuple[str, str]] = []
+    graph = Graph()
+    graph.add('router', Check('router', duration=0.05, log=log))
+    for i in range(100):
+        graph.add(i, Check(f'host{i}', duration=0.1, log=log), after=['router'])
+    before = time.monotonic()
+    result = graph()
+    assert bool(result) is True
+    assert len(list(result)) == 101
+    assert time.monotonic() - before < 0.5
+    assert log[:2] == [('start', 'router'), ('end', 'router')]
+
+
+def test_failure_skips_downstream_subtree() -> None:
+    graph = Graph()
+    graph.add('router', Check('router', ok=False))
+    graph.add('switch', Check('switch'), after=['router'])
+    graph.add('host', Check('host'), after=['switch'])
+    graph.add('other', Check('other'))
+    results = {str(result.command): result for result in graph()}
+    assert results['router'].error
+    assert results['switch'].skipped and results['host'].skipped
+    assert not results['host'].error, "Skipped nodes are no errors"
+    assert str(results['host']) == 'Skipped: host'
+    assert bool(results['other']) is True
+
+
+def test_topological_order() -> None:
+    log: list[tuple[str, str]] = []
+    graph = Graph()
+    graph.add('d', Check('d', log=log), after=['b', 'c'])
+    graph.add('b', Check('b', duration=0.05, log=log), after=['a'])
+    graph.add('c', Check('c', duration=0.01, log=log), after=['a'])
+    graph.add('a', Check('a', log=log))
+    assert [node.name for node in graph.order()] == ['a', 'b', 'c', 'd']
+    assert [str(result) for result in graph()] == ['a', 'c', 'b', 'd']
+    assert log.index(('start', 'd')) > log.index(('end', 'b'))
+
+
+def test_runs_if() -> None:
+    graph = Graph(succeeds_if=ANY_SUCCEEDS)
+    graph.add('primary', Check('primary', ok=False))
+    graph.add('fallback', Check('fallback'), after=['primary'], runs_if=lambda results: not any(results))
+    assert bool(graph()) is True
+
+
+def test_invalid_graphs() -> None:
+    graph = Graph()
+    graph.add('a', Check('a'), after=['b'])
+    graph.add('b', Check('b'), after=['a'])
+    with pytest.raises(ValueError, match='cycle'):
+        graph()
+    graph = Graph()
+    graph.add('a', Check('a'), after=['nonexistent'])
+    with pytest.raises(ValueError, match='Unknown upstream'):
+        graph()
+    with pytest.raises(ValueError, match='already exists'):
+        graph.add('a', Check('a'))
+
+
+@pytest.mark.parametrize('first_ok', [True, False])
+def test_compile_depending_command_sets(first_ok: bool) -> None:
+    def tree() -> DependingCommandSet:
+        return DependingCommandSet(
+            CommandSet(Check('first1'), Check('first2', ok=first_ok)),
+            if_succeeds=CommandSet(
+                Check('succeeded'),
+                DependingCommandSet(Check('nested', ok=False), if_fails=Check('nested fallback')),
+            ),
+            if_fails=Check('failed'),
+        )
+
+    expected = tree()()
+    compiled = Graph.compile(tree())()
+    ran = [str(result) for result in compiled if not result.skipped]
+    assert sorted(ran) == sorted(str(result) for result in expected)
+    assert bool(compiled) is bool(expected)
+    skipped = sorted(str(result.command) for result in compiled if result.skipped)
+    assert skipped == (['failed'] if first_ok else ['nested', 'nested fallback', 'succeeded'])
+
+
+def test_compile_shares_equal_commands() -> None:
+    log: list[tuple[str, str]] = []
+    router = Check('router', log=log)
+    compiled = Graph.compile(CommandSet(
+        DependingCommandSet(router, if_succeeds=Check('host1', log=log)),
+        DependingCommandSet(router, if_succeeds=Check('host2', log=log), if_fails=Check('fallback', log=log)),
+    ))
+    assert len(compiled.nodes) == 4
+    assert sorted(str(result) for result in compiled() if not result.skipped) == ['host1', 'host2', 'router']
+    assert log.count(('start', 'router')) == 1
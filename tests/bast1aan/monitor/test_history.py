@@ -0,0 +1,101 @@
+import math
+import os
+
+import pytest
+
+from bast1aan.monitor import metrics
+from bast1aan.monitor.base import AsyncCommand, CommandResult, _CommandResult
+from bast1aan.monitor.history import History, HistoryStore, RTT
+from bast1aan.monitor.metrics import Metrics
+from bast1aan.monitor.ping import PingResult, PingCommand
+
+
+def test_availability_over_window() -> None:
+    history = History(100)
+    for i in range(10):
+        history.append(i % 4 != 0, 0.01, at=1000.0 + i)
+    assert len(history) == 10
+    assert history.availability() == 0.7
+    assert history.availability(since=1001.0, until=1004.0) == 1.0
+    assert history.availability(since=1004.0, until=1005.0) == 0.0
+    assert history.availability(since=2000.0) is None
+    assert history.count(since=1002.5) == 7
+
+
+def test_ring_buffer_keeps_last_samples() -> None:
+    history = History(5)
+    for i in range(12):
+        history.append(i >= 10, at=float(i))
+    assert len(history) == 5
+    assert history.appended == 12
+    assert history.count() == 5
+    assert history.availability() == 0.4
+    assert history.count(since=6.0) == 5
+    assert history.count(until=9.0) == 2
+    assert history.state_changes() == [10.0]
+
+
+def test_quantile() -> None:
+    history = History(1000)
+    for i in range(1, 1001):
+        history.append(True, i / 1000, at=float(i))
+    for q, exact in ((0.5, 0.5), (0.99, 0.99), (1.0, 1.0)):
+        assert math.isclose(history.quantile(q), exact, rel_tol=0.05)  # type: ignore[arg-type]
+    assert math.isclose(history.quantile(0.5, since=901.0), 0.95, rel_tol=0.05)  # type: ignore[arg-type]
+    assert history.quantile(0.5, RTT) is None, "Samples without round trip time are left out"
+
+
+def test_state_changes() -> None:
+    history = History(100)
+    for i, ok in enumerate([True, True, False, False, True, False, False, False, True]):
+        history.append(ok, at=float(i))
+    assert history.state_changes() == [2.0, 4.0, 5.0, 8.0]
+    assert history.state_changes(since=3.0, until=6.0) == [4.0, 5.0]
+
+
+def test_persistent(tmp_path) -> None:  # type: ignore[no-untyped-def]
+    path = str(tmp_path / 'ping.history')
+    history = History(10, path)
+    for i in range(15):
+        history.append(i % 2 == 0, 0.001 * i, at=float(i))
+    history.close()
+    assert os.path.getsize(path) == 64 + 10 * 27
+
+    history = History(10, path)
+    assert (len(history), history.appended) == (10, 15)
+    assert history.availability() == 0.5
+    assert history.state_changes(since=13.0) == [13.0, 14.0]
+    history.close()
+    with pytest.raises(ValueError):
+        History(20, path)
+
+
+def test_store_records_spans(tmp_path) -> None:  # type: ignore[no-untyped-def]
+    class Up(AsyncCommand):
+        async def run(self) -> CommandResult:
+            return _CommandResult.Ok('up', self)
+        def __str__(self) -> str:
+            return 'up'
+        def __hash__(self) -> int:
+            return hash('up')
+
+    store = HistoryStore(100, str(tmp_path))
+    metrics.install(Metrics(on_span=store.record_span))
+    try:
+        command = Up()
+        for _ in range(3):
+            command()
+    finally:
+        metrics.install(None)
+    history = store[command]
+    assert history.count() == 3
+    assert history.availability() == 1.0
+    assert history.quantile(0.5) is not None
+    assert len(os.listdir(tmp_path)) == 1
+    store.close()
+
+
+def test_records_round_trip_time() -> None:
+    history = History(10)
+    history.record(PingResult(True, PingCommand('127.0.0.1'), b'rtt min/avg/max/mdev = 1.0/2.0/3.0/0.5 ms\n'))
+    assert math.isclose(history.quantile(0.5, RTT), 0.002, rel_tol=0.05)  # type: ignore[arg-type]
@@ -0,0 +1,188 @@
+import asyncio
+import shutil
+import ssl
+import subprocess
+from typing import Optional
+
+import pytest
+
+from bast1aan.monitor import CommandSet, DependingCommandSet
+from bast1aan.monitor.base import CommandResult
+from bast1aan.monitor.http import HttpCommand, HttpResult
+
+_RESPONSES = {
+    '/ok': b'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello',
+    '/chunked': b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n3\r\nhel\r\n2\r\nlo\r\n0\r\n\r\n',
+    '/error': b'HTTP/1.1 500 Internal Server Error\r\nContent-Length: 4\r\n\r\noops',
+    '/close': b'HTTP/1.1 200 OK\r\nConnection: close\r\n\r\nuntil the end',
+    '/drop': b'HTTP/1.1 200 OK\r\nContent-Length: 7\r\n\r\ndropped',
+    '/garbage': b'HTTP/1.1 abc Garbage\r\n\r\n',
+}
+
+
+class Server:
+    """ HTTP/1.1 server answering the paths of _RESPONSES, counting connections """
+    connections: int
+    requests: list[bytes]
+
+    def __init__(self) -> None:
+        self.connections = 0
+        self.requests = []
+
+    async def start(self, ssl_context: Optional[ssl.SSLContext] = None) -> int:
+        self._server = await asyncio.start_server(self._handle, '127.0.0.1', 0, ssl=ssl_context)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        try:
+            while request := await reader.readuntil(b'\r\n\r\n'):
+                self.requests.append(request)
+                path = request.split(b' ')[1].decode().partition('?')[0]
+                if path == '/slow':
+                    await asyncio.sleep(5)
+                writer.write(_RESPONSES[path])
+                await writer.drain()
+                if path in ('/close', '/drop'):
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+
+    def close(self) -> None:
+        self._server.close()
+
+
+def _serve(check):  # type: ignore[no-untyped-def]
+    """ Run check(server, port) against a server on the same loop """
+    async def run():  # type: ignore[no-untyped-def]
+        HttpCommand.pool.clear()
+        server = Server()
+        port = await server.start()
+        try:
+            return await check(server, port)
+        finally:
+            server.close()
+    return asyncio.run(run())
+
+
+def test_keeps_connections_alive() -> None:
+    async def check(server: Server, port: int) -> list[HttpResult]:
+        command = HttpCommand(f'http://localhost:{port}/ok')
+        return [await command.run() for _ in range(3)]  # type: ignore[misc]
+
+    results = _serve(check)
+    assert all(results) and [r.body for r in results] == [b'hello'] * 3
+    assert [r.reused for r in results] == [False, True, True]
+    assert results[0].connect is not None and results[1].connect is None
+    for result in results:
+        assert result.first_byte is not None and result.total is not None
+        assert 0 < result.first_byte <= result.total
+    assert str(results[0]).startswith(f'GET {results[0].command.url}: 200 OK in ')  # type: ignore[attr-defined]
+
+
+def test_connections_are_not_shared_across_ip_versions() -> None:
+    async def check(server: Server, port: int) -> list[HttpResult]:
+        url = f'http://localhost:{port}/ok'
+        return [await command.run() for command in (HttpCommand(url), HttpCommand(url, only=4),  # type: ignore[misc]
+                                                   HttpCommand(url, only=4))]
+
+    results = _serve(check)
+    assert all(results)
+    assert [r.reused for r in results] == [False, False, True]
+
+
+def test_bodies_and_statuses() -> None:
+    async def check(server: Server, port: int) -> dict[str, CommandResult]:
+        results = {}
+        for path in ('/chunked', '/error', '/close', '/ok'):
+            results[path] = await HttpCommand(f'http://localhost:{port}{path}').run()
+        results['expect'] = await HttpCommand(f'http://localhost:{port}/error', expect=500).run()
+        results['max_body'] = await HttpCommand(f'http://localhost:{port}/ok', max_body=2).run()
+        assert server.connections == 2, "Only the connection closed by the server is not reused"
+        assert b'GET /ok HTTP/1.1\r\nHost: localhost:' in server.requests[-1]
+        return results
+
+    results = _serve(check)
+    assert results['/chunked'].body == b'hello'  # type: ignore[attr-defined]
+    assert bool(results['/error']) is False and results['/error'].status == 500  # type: ignore[attr-defined]
+    assert results['/close'].body == b'until the end'  # type: ignore[attr-defined]
+    assert bool(results['expect']) is True
+    assert results['max_body'].body == b'he'  # type: ignore[attr-defined]
+
+
+def test_connection_closed_while_idle_is_replaced() -> None:
+    async def check(server: Server, port: int) -> list[CommandResult]:
+        dropped = await HttpCommand(f'http://localhost:{port}/drop').run()
+        await asyncio.sleep(0.05)
+        return [dropped, await HttpCommand(f'http://localhost:{port}/ok').run()]
+
+    dropped, result = _serve(check)
+    assert bool(dropped) is True and bool(result) is True
+    assert result.reused is False  # type: ignore[attr-defined]
+
+
+def test_unparsable_response_fails() -> None:
+    async def check(server: Server, port: int) -> list[HttpResult]:
+        garbage = HttpCommand(f'http://localhost:{port}/garbage')
+        return [await garbage.run(), await HttpCommand(f'http://localhost:{port}/ok').run(),  # type: ignore[list-item]
+                await garbage.run()]  # type: ignore[list-item]
+
+    fresh, _, reused = _serve(check)
+    assert not fresh and not fresh.reused and 'invalid literal' in str(fresh)
+    assert not reused and reused.reused and 'invalid literal' in str(reused)
+
+
+def test_refused_and_timeout() -> None:
+    async def check(server: Server, port: int) -> list[CommandResult]:
+        server.close()
+        await asyncio.sleep(0.01)
+        refused = await HttpCommand(f'http://localhost:{port}/ok').run()
+        return [refused]
+
+    refused, = _serve(check)
+    assert bool(refused) is False and 'refused' in str(refused).lower()
+
+    async def slow(server: Server, port: int) -> CommandResult:
+        return await HttpCommand(f'http://localhost:{port}/slow', timeout=0.2).run()
+
+    assert _serve(slow).timed_out
+    assert len(HttpCommand.pool) == 0
+
+
+def test_in_command_sets() -> None:
+    async def check(server: Server, port: int) -> list[CommandResult]:
+        command = DependingCommandSet(
+            CommandSet(*(HttpCommand(f'http://localhost:{port}/ok?{i}') for i in range(10))),
+            if_succeeds=HttpCommand(f'http://localhost:{port}/chunked'),
+        )
+        result = await command.run()
+        return [r async for r in result]
+
+    results = _serve(check)
+    assert len(results) == 11 and all(results)
+    assert str(results[-1].command).endswith('/chunked')
+
+
+def test_resumes_tls_sessions(tmp_path) -> None:  # type: ignore[no-untyped-def]
+    if shutil.which('openssl') is None:
+        pytest.skip('openssl is needed to create a certificate')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                    '-keyout', str(tmp_path / 'key.pem'), '-out', str(tmp_path / 'cert.pem')],
+                   check=True, capture_output=True)
+    server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    server_context.load_cert_chain(str(tmp_path / 'cert.pem'), str(tmp_path / 'key.pem'))
+
+    async def run() -> list[CommandResult]:
+        server = Server()
+        port = await server.start(server_context)
+        try:
+            command = HttpCommand(f'https://localhost:{port}/close', verify=False)
+            return [await command.run() for _ in range(2)]
+        finally:
+            server.close()
+
+    first, second = asyncio.run(run())
+    assert bool(first) is True and bool(second) is True
+    assert first.body == b'until the end'  # type: ignore[attr-defined]
+    assert first.tls_resumed is False and second.tls_resumed is True  # type: ignore[attr-defined]
@@ -0,0 +1,56 @@
+import asyncio
+
+from bast1aan.monitor import PingCommand, IPV4, IPV6, NATIVE, CommandSet
+from bast1aan.monitor.icmp import IcmpEngine, checksum
+
+
+def test_checksum() -> None:
+    assert checksum(b'\x08\x00\x00\x00\x00\x01\x00\x01') == 0xf7fd
+    assert checksum(b'\x08\x00\xf7\xfd\x00\x01\x00\x01') == 0
+
+
+def test_native_ping_ipv4_success() -> None:
+    result = PingCommand('127.0.0.1', only=IPV4, engine=NATIVE)()
+    assert bool(result) is True
+    msg = str(result)
+    assert '64 bytes from 127.0.0.1: icmp_seq=1' in msg
+    assert '1 packets transmitted, 1 received, 0% packet loss' in msg
+
+
+def test_native_ping_ipv6_success() -> None:
+    result = PingCommand('::1', only=IPV6, engine=NATIVE)()
+    assert bool(result) is True
+    assert '64 bytes from ::1: icmp_seq=1' in str(result)
+
+
+def test_native_ping_failure() -> None:
+    result = PingCommand('fliepsflops', engine=NATIVE)()
+    assert bool(result) is False
+    assert 'fliepsflops: Name or service not known' in str(result)
+    assert str(result.command) == 'ping -c 1 fliepsflops'
+
+
+def test_native_ping_address_family_not_supported() -> None:
+    result = PingCommand('127.0.0.1', only=IPV6, engine=NATIVE)()
+    assert bool(result) is False
+    assert '127.0.0.1: Address family for hostname not supported' in str(result)
+
+
+def test_native_commandset_shares_socket() -> None:
+    commands = [PingCommand(f'127.0.0.{i}', only=IPV4, engine=NATIVE) for i in range(1, 51)]
+    result_set = CommandSet(*commands)()
+    assert {result.command for result in result_set if result} == set(commands)
+    assert bool(result_set) is True
+
+
+def test_engine_multiplexes_over_one_socket() -> None:
+    async def ping_all() -> list:
+        engine = IcmpEngine.get()
+        statistics = await asyncio.gather(*(engine.ping(f'127.0.0.{i}', count=2, interval=0.01) for i in range(1, 21)))
+        assert len(engine._sockets) == 1
+        engine.close()
+        return statistics
+
+    for statistics in asyncio.run(ping_all()):
+        assert statistics.transmitted == 2
+        assert statistics.received == 2
@@ -0,0 +1,117 @@
+import asyncio
+from typing import Iterator
+
+import pytest
+
+from bast1aan.monitor import CommandSet, metrics
+from bast1aan.monitor.base import AsyncCommand, ExecutorCommand, CommandResult, _CommandResult
+from bast1aan.monitor.concurrency import ConcurrencyLimit
+from bast1aan.monitor.metrics import Metrics, Span, Histogram
+
+
+class Sleep(AsyncCommand):
+    duration: float
+
+    def __init__(self, duration: float):
+        self.duration = duration
+
+    async def run(self) -> CommandResult:
+        await asyncio.sleep(self.duration)
+        return _CommandResult.Ok(str(self), self)
+
+    def __str__(self) -> str:
+        return f'Sleep {self.duration}'
+
+    def __hash__(self) -> int:
+        return id(self)
+
+
+class Exit3(ExecutorCommand):
+    @property
+    def command(self) -> str:
+        return 'echo 12345; exit 3'
+
+    def __hash__(self) -> int:
+        return hash(self.command)
+
+
+@pytest.fixture
+def spans() -> Iterator[list[Span]]:
+    spans: list[Span] = []
+    metrics.install(Metrics(on_span=spans.append))
+    try:
+        yield spans
+    finally:
+        metrics.install(None)
+
+
+def test_not_installed() -> None:
+    assert metrics.installed() is None
+    assert bool(Sleep(0)()) is True
+    assert metrics.span() is None
+
+
+def test_executor_span(spans: list[Span]) -> None:
+    assert bool(Exit3()()) is False
+    span, = spans
+    assert span.outcome == metrics.ERROR
+    assert span.exit_code == 3
+    assert span.output_bytes == 6
+    assert span.spawn is not None and span.duration is not None and 0 < span.spawn <= span.duration
+    exposition = metrics.installed().exposition()  # type: ignore[union-attr]
+    assert 'monitor_command_runs_total{command="Exit3",outcome="error"} 1' in exposition
+    assert 'monitor_command_exit_codes_total{command="Exit3",code="3"} 1' in exposition
+    assert 'monitor_command_output_bytes_total{command="Exit3"} 6' in exposition
+    assert 'monitor_command_spawn_seconds_count{command="Exit3"} 1' in exposition
+
+
+def test_queue_wait(spans: list[Span]) -> None:
+    list(CommandSet(Sleep(0.1), Sleep(0.1), concurrency=ConcurrencyLimit(1))())
+    assert len(spans) == 2, "Command sets have no spans of their own"
+    waits = sorted(span.queue_wait for span in spans)
+    assert waits[0] < 0.05
+    assert waits[1] >= 0.09
+    assert all(span.outcome == metrics.OK for span in spans)
+
+
+def test_histogram() -> None:
+    histogram = Histogram((0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 5):
+        histogram.observe(value)
+    assert histogram.counts == [2, 1, 1]
+    assert histogram.count == 4
+    assert histogram.sum == 5.65
+
+
+def test_endpoint(spans: list[Span]) -> None:
+    async def scrape() -> tuple[bytes, bytes]:
+        server = await metrics.installed().serve(port=0)  # type: ignore[union-attr]
+        port = server.sockets[0].getsockname()[1]
+        responses = []
+        for path in ('/metrics', '/other'):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode())
+            responses.append(await reader.read())
+            writer.close()
+        server.close()
+        await server.wait_closed()
+        return responses[0], responses[1]
+
+    Sleep(0)()
+    found, not_found = asyncio.run(scrape())
+    assert found.startswith(b'HTTP/1.1 200 OK\r\n')
+    assert b'monitor_command_run_seconds_bucket{command="Sleep",le="+Inf"} 1\n' in found
+    assert b'monitor_event_loop_lag_seconds_count 0\n' in found
+    assert not_found.startswith(b'HTTP/1.1 404 Not Found\r\n')
+
+
+def test_loop_lag() -> None:
+    collected = Metrics()
+
+    async def lag() -> None:
+        watch = asyncio.ensure_future(collected.watch_loop(0.01))
+        await asyncio.sleep(0.05)
+        watch.cancel()
+
+    asyncio.run(lag())
+    assert collected.loop_lag_seconds.count >= 3
@@ -0,0 +1,34 @@
+from bast1aan.monitor.output import CappedOutput
+
+
+def test_unlimited() -> None:
+    output = CappedOutput()
+    for _ in range(1000):
+        output.write(b'0123456789')
+    assert len(output) == 10000
+    assert bytes(output) == b'0123456789' * 1000
+    assert output.dropped == 0
+
+
+def test_within_limit() -> None:
+    output = CappedOutput(100)
+    output.write(b'a' * 30)
+    output.write(b'b' * 30)
+    assert bytes(output) == b'a' * 30 + b'b' * 30
+    assert output.dropped == 0
+
+
+def test_keeps_head_and_tail() -> None:
+    output = CappedOutput(10)
+    for i in range(10):
+        output.write(b'%d' % i * 3)
+    assert output.dropped == 20
+    assert len(output) == 30
+    assert bytes(output) == b'00011\n[... 20 bytes dropped ...]\n88999'
+
+
+def test_large_write() -> None:
+    output = CappedOutput(10)
+    output.write(bytes(range(100)))
+    assert output.dropped == 90
+    assert bytes(output) == bytes(range(5)) + b'\n[... 90 bytes dropped ...]\n' + bytes(range(95, 100))
@@ -1,6 +1,7 @@
 import time
 
-from bast1aan.monitor import PingCommand
+from bast1aan.monitor import PingCommand, PingResult, NATIVE, IPV4
+from bast1aan.monitor.ping import PingStatistics
 
 
 def test_ping_cmd_waits_for_interval() -> None:
@@ -34,3 +35,63 @@ def test_eq() -> None:
     cmd4 = PingCommand('127.0.0.1')
 
     assert hash(cmd1) == hash(cmd2) == hash(cmd3) == hash(cmd4)
+
+IPUTILS_OUTPUT = b'''PING 127.0.0.1 (127.0.0.1) 56(84) bytes of data.
+64 bytes from 127.0.0.1: icmp_seq=1 ttl=64 time=0.045 ms
+64 bytes from 127.0.0.1: icmp_seq=2 ttl=64 time=0.061 ms
+64 bytes from 127.0.0.1: icmp_seq=4 ttl=64 time=0.052 ms
+
+--- 127.0.0.1 ping statistics ---
+4 packets transmitted, 3 received, 25% packet loss, time 3060ms
+rtt min/avg/max/mdev = 0.045/0.052/0.061/0.006 ms
+'''
+
+BUSYBOX_OUTPUT = b'''PING 127.0.0.1 (127.0.0.1): 56 data bytes
+64 bytes from 127.0.0.1: seq=0 ttl=64 time=0.071 ms
+
+--- 127.0.0.1 ping statistics ---
+1 packets transmitted, 1 packets received, 0% packet loss
+round-trip min/avg/max = 0.071/0.071/0.071 ms
+'''
+
+def test_parse_iputils_output() -> None:
+    statistics = PingStatistics.parse(IPUTILS_OUTPUT)
+    assert statistics == PingStatistics(4, 3, 25.0, 0.045, 0.052, 0.061, 0.006, (0.045, 0.061, 0.052))
+
+def test_parse_busybox_output() -> None:
+    statistics = PingStatistics.parse(BUSYBOX_OUTPUT)
+    assert (statistics.transmitted, statistics.received, statistics.loss) == (1, 1, 0.0)
+    assert (statistics.rtt_min, statistics.rtt_avg, statistics.rtt_max, statistics.rtt_mdev) == (0.071, 0.071, 0.071, None)
+    assert statistics.rtts == (0.071,)
+
+def test_parse_failure_output() -> None:
+    statistics = PingStatistics.parse(b'ping: fliepsflops: Name or service not known\n')
+    assert statistics == PingStatistics()
+
+def test_ping_result_keeps_raw_output() -> None:
+    cmd = PingCommand('127.0.0.1')
+    result = PingResult(True, cmd, IPUTILS_OUTPUT)
+    assert result.received == 3
+    assert result.loss == 25.0
+    assert result.rtts == (0.045, 0.061, 0.052)
+    assert result.output is IPUTILS_OUTPUT
+    assert str(result) == IPUTILS_OUTPUT.decode()
+
+def test_native_ping_result_statistics() -> None:
+    result = PingCommand('127.0.0.1', count=2, engine=NATIVE)()
+    assert isinstance(result, PingResult)
+    assert (result.transmitted, result.received, result.loss) == (2, 2, 0.0)
+    assert len(result.rtts) == 2
+    assert result.rtt_min is not None and result.rtt_max is not None
+    assert 0 < result.rtt_min <= result.rtt_max
+    assert '2 packets transmitted, 2 received, 0% packet loss' in str(result)
+
+def test_ping_waits_for_interval_for_same_target() -> None:
+    cmd1 = PingCommand('127.0.0.3', only=IPV4, engine=NATIVE)
+    cmd2 = PingCommand('127.0.0.3', engine=NATIVE)
+    before = time.time()
+    cmd1()
+    cmd2()
+    cmd1()
+    after = time.time()
+    assert after - before > 0.4
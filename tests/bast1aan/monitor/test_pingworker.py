@@ -0,0 +1,106 @@
+import asyncio
+import os
+import signal
+from typing import Sequence
+
+import pytest
+
+from bast1aan.monitor import PingCommand, PERSISTENT
+from bast1aan.monitor import pingworker
+from bast1aan.monitor.pingworker import PingWorker, PingWorkers
+
+
+async def _spawn(argv: Sequence[str]) -> asyncio.subprocess.Process:
+    return await asyncio.create_subprocess_exec(
+        *argv, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, start_new_session=True,
+    )
+
+
+def _script(*lines: str) -> tuple[str, ...]:
+    """ Command line of a shell acting like ping """
+    return 'sh', '-c', '; '.join(lines)
+
+
+_REPLY = 'echo "64 bytes from 127.0.0.1: icmp_seq=1 ttl=64 time=1.5 ms"'
+
+
+def test_checks_share_one_process() -> None:
+    async def check() -> None:
+        command = PingCommand('127.0.0.1', count=2, engine=PERSISTENT)
+        results = []
+        pids = set()
+        for _ in range(3):
+            results.append(await command.run())
+            pids.add(PingWorkers.get()[command._persistent_argv('127.0.0.1')]._process.pid)  # type: ignore[union-attr]
+        await PingWorkers.get().stop()
+        assert all(results)
+        assert [result.received for result in results] == [2, 2, 2]  # type: ignore[attr-defined]
+        assert len(pids) == 1, "Every check takes the replies of the same ping process"
+        assert str(results[0]).startswith('PING 127.0.0.1 56 data bytes')
+
+    asyncio.run(check())
+
+
+def test_window_counts_missing_replies() -> None:
+    async def check() -> None:
+        worker = PingWorker(_script('echo PING', 'sleep 0.05', _REPLY, 'sleep 0.05', _REPLY, 'sleep 10'), 0.1, _spawn)
+        rtts = await worker.window(3, asyncio.get_running_loop().time() + 0.5)
+        await worker.stop()
+        assert rtts == [0.0015, 0.0015, None]
+
+    asyncio.run(check())
+
+
+def test_output_of_failing_process() -> None:
+    async def check() -> None:
+        argv = _script('echo "ping: nohost: Name or service not known" >&2', 'exit 2')
+        rtts, output = await PingWorkers.get().window(argv, 0.2, 2, None, _spawn)
+        await PingWorkers.get().stop()
+        assert rtts == [None, None]
+        assert output == b'ping: nohost: Name or service not known'
+
+    asyncio.run(check())
+
+
+def test_restarts_dead_process(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(pingworker, 'RESTART_DELAY', 0.05)
+
+    async def check() -> None:
+        worker = PingWorker(_script('echo PING', _REPLY, 'sleep 10'), 0.1, _spawn)
+        assert await worker.window(1, None) == [0.0015]
+        pid = worker._process.pid  # type: ignore[union-attr]
+        os.killpg(pid, signal.SIGKILL)
+        await asyncio.sleep(0.2)
+        assert worker.running and worker._process.pid != pid  # type: ignore[union-attr]
+        await worker.stop()
+
+    asyncio.run(check())
+
+
+def test_idle_worker_is_stopped() -> None:
+    async def check() -> None:
+        command = PingCommand('127.0.0.1', engine=PERSISTENT, idle_timeout=0.1)
+        assert bool(await command.run()) is True
+        worker = PingWorkers.get()[command._persistent_argv('127.0.0.1')]
+        await asyncio.sleep(0.3)
+        assert len(PingWorkers.get()) == 0
+        assert not worker.running
+
+    asyncio.run(check())
+
+
+def test_one_idle_timer_per_worker() -> None:
+    async def check() -> None:
+        workers = PingWorkers()
+        argv = _script('echo PING', 'sleep 10')
+        timers = set()
+        for _ in range(3):
+            await workers.window(argv, 0.1, 1, asyncio.get_running_loop().time() + 0.05, _spawn, idle_timeout=0.2)
+            timers.add(workers[argv].idle_timer)
+        assert len(timers) == 1
+        worker = workers[argv]
+        await asyncio.sleep(0.5)
+        assert len(workers) == 0
+        assert not worker.running
+
+    asyncio.run(check())
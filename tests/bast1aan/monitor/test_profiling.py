@@ -0,0 +1,137 @@
+import asyncio
+import json
+import pathlib
+import time
+
+from bast1aan.monitor import CommandSet, DependingCommandSet, Retry, profiling
+from bast1aan.monitor.base import AsyncCommand, Command, ExecutorCommand, CommandResult, _CommandResult
+from bast1aan.monitor.concurrency import ConcurrencyLimit
+from bast1aan.monitor.profiling import Profile
+from bast1aan.monitor.ratelimit import RateLimiter
+
+
+class Sleep(AsyncCommand):
+    duration: float
+    ok: bool
+
+    def __init__(self, duration: float, ok: bool = True):
+        self.duration = duration
+        self.ok = ok
+
+    async def run(self) -> CommandResult:
+        await asyncio.sleep(self.duration)
+        return _CommandResult(self.ok, str(self), self)
+
+    def __str__(self) -> str:
+        return f'Sleep {self.duration}'
+
+    def __hash__(self) -> int:
+        return id(self)
+
+
+class BlockingSleep(Command):
+    def __call__(self) -> CommandResult:
+        time.sleep(0.05)
+        return _CommandResult.Ok(str(self), self)
+
+    def __str__(self) -> str:
+        return 'BlockingSleep'
+
+    def __hash__(self) -> int:
+        return id(self)
+
+
+class ShellSleep(ExecutorCommand):
+    @property
+    def command(self) -> str:
+        return 'sleep 0.1'
+
+    def __hash__(self) -> int:
+        return id(self)
+
+
+def _profile(command: AsyncCommand) -> Profile:
+    with Profile() as profile:
+        list(command())
+    return profile
+
+
+def test_critical_path() -> None:
+    profile = _profile(CommandSet(
+        Sleep(0.1),
+        DependingCommandSet(Sleep(0.05), if_succeeds=CommandSet(Sleep(0.1), Sleep(0.15))),
+        Retry(Sleep(0.02, ok=False), attempts=2, backoff=0.05),
+    ))
+    assert len(profile.nodes) == 10
+    assert [node.name for node in profile.critical_path()] == \
+        ['CommandSet', 'DependingCommandSet', 'Sleep 0.05', 'CommandSet', 'Sleep 0.15']
+    *_, first, second = profile.summary(top=2).splitlines()
+    assert 'Sleep 0.15  (run ' in first
+    assert 'Sleep 0.05  (run ' in second
+
+
+def test_kinds_of_time() -> None:
+    profile = _profile(CommandSet(
+        ShellSleep(), Sleep(0.05), BlockingSleep(),
+        concurrency=ConcurrencyLimit(1), rate_limiter=RateLimiter(interval=0.05),
+    ))
+    kinds = {node.name: node.breakdown() for node in profile.nodes if node.span is not None}
+    assert kinds['sleep 0.1'][profiling.PROCESS] >= 0.09
+    assert kinds['sleep 0.1'][profiling.SPAWN] > 0
+    assert kinds['BlockingSleep'][profiling.RUN] >= 0.04
+    assert max(kind[profiling.RATE_WAIT] for kind in kinds.values()) >= 0.04
+    assert max(kind[profiling.SLOT_WAIT] for kind in kinds.values()) >= 0.04
+
+
+def test_waiting_for_the_walk() -> None:
+    with Profile() as profile:
+        result = CommandSet(Sleep(0.01), DependingCommandSet(Sleep(0.01), if_succeeds=Sleep(0.01)))()
+        time.sleep(0.1)
+        list(result)
+    root, = profile.roots
+    assert root.walked is not None and root.wait >= 0.1
+    kinds = dict(profile.contributions())[root]
+    assert kinds[profiling.WALK_WAIT] >= 0.1
+    assert kinds[profiling.SET] < 0.05
+
+
+def test_trace_events(tmp_path: pathlib.Path) -> None:
+    profile = _profile(CommandSet(Sleep(0.02), CommandSet(Sleep(0.01), Sleep(0.03)), Retry(Sleep(0.01), Sleep(0.01))))
+    profile.write_trace(str(tmp_path / 'trace.json'))
+    with open(tmp_path / 'trace.json') as file:
+        events = json.load(file)['traceEvents']
+    assert len(events) == len(profile.nodes)
+    lanes: dict[int, list[dict]] = {}
+    for event in events:
+        lanes.setdefault(event['tid'], []).append(event)
+    for lane in lanes.values():
+        for a in lane:
+            for b in lane:
+                a_end, b_end = a['ts'] + a['dur'], b['ts'] + b['dur']
+                assert a is b or a_end <= b['ts'] or b_end <= a['ts'] or \
+                    a['ts'] <= b['ts'] and b_end <= a_end or b['ts'] <= a['ts'] and a_end <= b_end, \
+                    "Events of a thread nest"
+
+
+def test_root_node_when_run_is_awaited() -> None:
+    def command_set() -> CommandSet:
+        return CommandSet(Sleep(0.01), DependingCommandSet(Sleep(0.01), if_succeeds=Sleep(0.01)))
+
+    async def run() -> None:
+        async for _ in await command_set().run():
+            pass
+
+    with Profile() as awaited:
+        asyncio.run(run())
+    called = _profile(command_set())
+    for profile in (awaited, called):
+        assert [node.name for node in profile.roots] == ['CommandSet']
+        assert len(profile.nodes) == 5
+        assert all(node.end is not None and node.end < profile.end for node in profile.nodes)  # type: ignore[operator]
+
+
+def test_not_profiled_outside() -> None:
+    profile = _profile(CommandSet(Sleep(0)))
+    list(CommandSet(Sleep(0))())
+    assert len(profile.nodes) == 2
+    assert profiling.active.get() is None
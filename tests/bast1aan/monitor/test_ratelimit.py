@@ -0,0 +1,100 @@
+import asyncio
+import time
+
+from bast1aan.monitor import CommandSet
+from bast1aan.monitor.base import AsyncCommand, CommandResult, _CommandResult
+from bast1aan.monitor.ratelimit import RateLimiter
+
+
+class Start(AsyncCommand):
+    starts: list[float]
+    target: str
+
+    def __init__(self, starts: list[float], target: str):
+        self.starts = starts
+        self.target = target
+
+    async def run(self) -> CommandResult:
+        self.starts.append(time.monotonic())
+        return _CommandResult.Ok(self.target, self)
+
+    def __str__(self) -> str:
+        return self.target
+
+    def __hash__(self) -> int:
+        return id(self)
+
+
+def test_per_key_interval() -> None:
+    limiter = RateLimiter(per_key_interval=0.1)
+    starts = [limiter.reserve('a') for _ in range(3)] + [limiter.reserve('b')]
+    assert abs(starts[1] - starts[0] - 0.1) < 0.01
+    assert abs(starts[2] - starts[0] - 0.2) < 0.01
+    assert starts[3] - starts[0] < 0.01, "Other keys are not affected"
+
+
+def test_caller_interval_overrides_per_key_interval() -> None:
+    limiter = RateLimiter(per_key_interval=10)
+    first, second = limiter.reserve('a', 0.05), limiter.reserve('a', 0.05)
+    assert abs(second - first - 0.05) < 0.01
+
+
+def test_global_interval_and_burst() -> None:
+    limiter = RateLimiter(0.1, burst=3)
+    starts = [limiter.reserve(key) for key in 'abcde']
+    assert starts[2] - starts[0] < 0.01, "First 3 in a burst"
+    assert abs(starts[3] - starts[0] - 0.1) < 0.01
+    assert abs(starts[4] - starts[0] - 0.2) < 0.01
+
+
+def test_key_does_not_hold_back_other_keys() -> None:
+    limiter = RateLimiter(0.01, per_key_interval=10)
+    first, *starts = (limiter.reserve(key) for key in 'aabc')
+    assert [round(start - first, 2) for start in starts] == [10.0, 0.01, 0.02]
+    limiter = RateLimiter(0.01, per_key_interval=0.02)
+    first, *starts = (limiter.reserve(key) for key in 'aabcd')
+    assert [round(start - first, 2) for start in starts] == [0.02, 0.01, 0.03, 0.04], "Booked starts are kept apart"
+
+
+def test_waiters_are_served_in_order_of_arrival() -> None:
+    limiter = RateLimiter(per_key_interval=0.02)
+    order: list[int] = []
+
+    async def waiter(i: int) -> None:
+        await limiter.wait('host')
+        order.append(i)
+
+    async def main() -> None:
+        await asyncio.gather(*(waiter(i) for i in range(10)))
+
+    before = time.monotonic()
+    asyncio.run(main())
+    assert order == list(range(10))
+    assert time.monotonic() - before >= 0.18
+
+
+def test_keys_are_bounded_and_expire() -> None:
+    limiter = RateLimiter(per_key_interval=60, max_keys=100)
+    for i in range(1000):
+        limiter.reserve(i)
+    assert len(limiter) == 100
+    limiter = RateLimiter(per_key_interval=0.01)
+    for i in range(100):
+        limiter.reserve(i)
+    time.sleep(0.02)
+    limiter.reserve('new')
+    assert len(limiter) == 1, "Full buckets are evicted"
+
+
+def test_command_set_rate_limiter() -> None:
+    starts: list[float] = []
+    command_set = CommandSet(
+        *(Start(starts, 'host1') for _ in range(3)),
+        CommandSet(*(Start(starts, 'host2') for _ in range(3))),
+        rate_limiter=RateLimiter(0.02, per_key_interval=0.05),
+    )
+    before = time.monotonic()
+    assert len(list(command_set())) == 6
+    assert time.monotonic() - before >= 0.1
+    starts.sort()
+    assert all(b - a >= 0.015 for a, b in zip(starts, starts[1:]))
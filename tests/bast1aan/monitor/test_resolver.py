@@ -0,0 +1,110 @@
+import asyncio
+import socket
+import time
+
+import pytest
+
+from bast1aan.monitor import PingCommand, IPV4, NATIVE
+from bast1aan.monitor.resolver import Resolver, Address, host
+
+
+async def _counting(lookups: list[str], delay: float = 0.0) -> None:
+    """ Have getaddrinfo of the running loop record its lookups, and take delay seconds """
+    loop = asyncio.get_running_loop()
+    getaddrinfo = loop.getaddrinfo
+
+    async def counting(host: str, *args, **kwargs):  # type: ignore[no-untyped-def]
+        lookups.append(host)
+        await asyncio.sleep(delay)
+        return await getaddrinfo(host, *args, **kwargs)
+    loop.getaddrinfo = counting  # type: ignore[method-assign, assignment]
+
+
+def test_caches_addresses() -> None:
+    lookups: list[str] = []
+
+    async def resolve() -> list[list[Address]]:
+        await _counting(lookups)
+        resolver = Resolver()
+        return [await resolver.resolve('127.0.0.1', socket.AF_INET) for _ in range(3)]
+
+    results = asyncio.run(resolve())
+    assert results[0] == [(socket.AF_INET, ('127.0.0.1', 0))]
+    assert results[0] == results[1] == results[2]
+    assert lookups == ['127.0.0.1']
+
+
+def test_negative_caching() -> None:
+    lookups: list[str] = []
+
+    async def resolve() -> None:
+        await _counting(lookups)
+        resolver = Resolver(negative_ttl=60)
+        for _ in range(3):
+            with pytest.raises(socket.gaierror):
+                await resolver.resolve('fliepsflops')
+        assert resolver.cached('fliepsflops')
+
+    asyncio.run(resolve())
+    assert lookups == ['fliepsflops']
+
+
+def test_expires() -> None:
+    lookups: list[str] = []
+
+    async def resolve() -> None:
+        await _counting(lookups)
+        resolver = Resolver(ttl=0.05)
+        await resolver.resolve('127.0.0.1')
+        await resolver.resolve('127.0.0.1')
+        await asyncio.sleep(0.06)
+        assert not resolver.cached('127.0.0.1')
+        await resolver.resolve('127.0.0.1')
+
+    asyncio.run(resolve())
+    assert lookups == ['127.0.0.1', '127.0.0.1']
+
+
+def test_coalesces_lookups() -> None:
+    lookups: list[str] = []
+
+    async def resolve() -> list[list[Address]]:
+        await _counting(lookups, delay=0.05)
+        resolver = Resolver()
+        return await asyncio.gather(*(resolver.resolve('127.0.0.1') for _ in range(10)))
+
+    results = asyncio.run(resolve())
+    assert len(results) == 10
+    assert lookups == ['127.0.0.1'], "Lookups of a name being resolved wait for that resolution"
+
+
+def test_bounded() -> None:
+    async def resolve() -> Resolver:
+        resolver = Resolver(max_entries=10)
+        for i in range(1, 31):
+            await resolver.resolve(f'127.0.0.{i}')
+        return resolver
+
+    resolver = asyncio.run(resolve())
+    assert len(resolver) == 10
+    assert resolver.cached('127.0.0.30') and not resolver.cached('127.0.0.20')
+
+
+def test_host() -> None:
+    assert host((socket.AF_INET, ('127.0.0.1', 0))) == '127.0.0.1'
+    assert host((socket.AF_INET6, ('fe80::1', 0, 0, 2))) == 'fe80::1%2'
+
+
+class ResolvingPing(PingCommand):
+    resolver = Resolver()
+
+
+def test_ping_reports_resolution_separately() -> None:
+    before = time.monotonic()
+    result = ResolvingPing('localhost', only=IPV4, engine=NATIVE)()
+    assert bool(result) is True
+    assert result.target == 'localhost'
+    assert result.address == '127.0.0.1'
+    assert 0 <= result.resolution < time.monotonic() - before
+    assert ResolvingPing.resolver.cached('localhost', socket.AF_INET)
+    assert 'PING localhost (127.0.0.1)' in str(result), "The native engine reports the target it was given"
@@ -0,0 +1,128 @@
+import asyncio
+import pickle
+
+from bast1aan.monitor import CommandSet, PingResult, HttpResult, TcpResult, ON_FAILURE, Retention
+from bast1aan.monitor.base import AsyncCommand, Command, CommandResult, _CommandResult, _TimedOutResult, \
+    _CancelledResult, _Scope, _run
+from bast1aan.monitor.icmp import EchoStatistics
+from bast1aan.monitor.retention import NONE
+from bast1aan.monitor.singleflight import SingleFlight
+
+
+PING_OUTPUT = b'''PING 127.0.0.1 (127.0.0.1) 56(84) bytes of data.
+64 bytes from 127.0.0.1: icmp_seq=1 ttl=64 time=0.045 ms
+
+--- 127.0.0.1 ping statistics ---
+2 packets transmitted, 1 received, 50% packet loss, time 1001ms
+rtt min/avg/max/mdev = 0.045/0.045/0.045/0.000 ms
+'''
+
+
+class Says(AsyncCommand):
+    """ Succeeds or fails with msg as output """
+    def __init__(self, msg: str, ok: bool = True):
+        self.msg = msg
+        self.ok = ok
+    async def run(self) -> CommandResult:
+        return _CommandResult(self.ok, self.msg, self)
+    def __str__(self) -> str:
+        return self.msg
+    def __hash__(self) -> int:
+        return hash((self.msg, self.ok))
+
+
+class SaysBlocking(Command):
+    """ Synchronous version of Says """
+    def __init__(self, msg: str, ok: bool = True):
+        self.msg = msg
+        self.ok = ok
+    def __call__(self) -> CommandResult:
+        return _CommandResult(self.ok, self.msg, self)
+    def __str__(self) -> str:
+        return self.msg
+    def __hash__(self) -> int:
+        return hash((self.msg, self.ok))
+
+
+def _outputs(command_set: CommandSet) -> dict[str, str]:
+    async def run() -> dict[str, str]:
+        return {result.command.msg: str(result) async for result in await command_set.run()}  # type: ignore[attr-defined]
+    return asyncio.run(run())
+
+
+def test_results_have_no_dict() -> None:
+    command = Says('x')
+    for result in (_CommandResult(True, 'x', command), _TimedOutResult('x', command), _CancelledResult(command),
+                   PingResult(True, command, PING_OUTPUT), HttpResult(True, command, 200, 'OK'),
+                   TcpResult(True, command, 'connected')):
+        assert not hasattr(result, '__dict__')
+
+
+def test_slotted_results_pickle() -> None:
+    result = pickle.loads(pickle.dumps(_CommandResult(False, 'down', Says('down'))))
+    assert (result.ok, result.msg) == (False, 'down')
+
+
+def test_apply() -> None:
+    retention = Retention(success=0, failure=4)
+    assert retention.apply(True, 'all is well') == ''
+    assert retention.apply(False, 'it broke') == 'it b...'
+    assert retention.apply(False, b'bad') == b'bad'
+    assert Retention().apply(True, 'all is well') == 'all is well'
+
+
+def test_full_by_default() -> None:
+    assert _outputs(CommandSet(Says('up'), Says('down', ok=False))) == {'up': 'up', 'down': 'down'}
+
+
+def test_on_failure() -> None:
+    command_set = CommandSet(Says('up'), Says('down', ok=False), SaysBlocking('sync up'), retention=ON_FAILURE)
+    assert _outputs(command_set) == {'up': '', 'down': 'down', 'sync up': ''}
+
+
+def test_nested_sets_inherit() -> None:
+    inner = CommandSet(Says('up'), Says('down', ok=False))
+    assert _outputs(CommandSet(inner, retention=NONE)) == {'up': '', 'down': ''}
+    assert _outputs(CommandSet(CommandSet(Says('up'), retention=ON_FAILURE), retention=NONE)) == {'up': ''}
+    inner = CommandSet(Says('down', ok=False), retention=Retention(failure=2))
+    assert _outputs(CommandSet(inner, retention=NONE)) == {'down': 'do...'}
+
+
+def test_shared_result_is_trimmed_as_a_copy() -> None:
+    class Slow(Says):
+        runs = 0
+        async def run(self) -> CommandResult:
+            Slow.runs += 1
+            await asyncio.sleep(0.05)
+            return await super().run()
+        def __hash__(self) -> int:
+            return id(self)
+
+    async def run() -> tuple[CommandResult, CommandResult]:
+        command, single_flight = Slow('output'), SingleFlight()
+        return await asyncio.gather(_run(command, _Scope(single_flight=single_flight, retention=NONE)),
+                                    _run(command, _Scope(single_flight=single_flight)))
+
+    trimmed, kept = asyncio.run(run())
+    assert Slow.runs == 1
+    assert (str(trimmed), str(kept)) == ('', 'output')
+
+
+def test_ping_statistics_survive() -> None:
+    result = PingResult(True, Says('ping'), PING_OUTPUT)
+    result.retain(NONE)
+    assert result.output == b''
+    assert (result.transmitted, result.received, result.rtt_avg) == (2, 1, 0.045)
+
+
+def test_echo_statistics_are_retained() -> None:
+    def result() -> PingResult:
+        return PingResult(True, Says('ping'), echo=EchoStatistics('localhost', '127.0.0.1', 2, [0.001, None]))
+
+    full, none, kept = result(), result(), result()
+    full.retain(Retention())
+    none.retain(NONE)
+    kept.retain(Retention(success=4))
+    assert full.echo is not None and str(full).startswith('PING localhost (127.0.0.1)')
+    assert (str(none), str(kept)) == ('', 'PING...')
+    assert (none.transmitted, none.received, none.rtt_avg) == (2, 1, 1.0)
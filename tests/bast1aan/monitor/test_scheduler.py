@@ -0,0 +1,125 @@
+import asyncio
+
+import pytest
+
+from bast1aan.monitor import CommandSet
+from bast1aan.monitor.base import AsyncCommand, CommandResult, _CommandResult
+from bast1aan.monitor.scheduler import Scheduler, Check
+
+
+class Counter(AsyncCommand):
+    name: str
+    duration: float
+    runs: int
+    running: int
+    max_running: int
+
+    def __init__(self, name: str, duration: float = 0.0):
+        self.name = name
+        self.duration = duration
+        self.runs = 0
+        self.running = 0
+        self.max_running = 0
+
+    async def run(self) -> CommandResult:
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(self.duration)
+        self.running -= 1
+        self.runs += 1
+        return _CommandResult.Ok(str(self), self)
+
+    def __str__(self) -> str:
+        return self.name
+
+    def __hash__(self) -> int:
+        return hash(self.name)
+
+
+def run_for(scheduler: Scheduler, seconds: float) -> None:
+    async def main() -> None:
+        asyncio.get_running_loop().call_later(seconds, scheduler.stop)
+        await scheduler.run()
+    asyncio.run(main())
+
+
+def test_runs_commands_on_their_interval() -> None:
+    fast, slow = Counter('fast'), Counter('slow')
+    results: list[tuple[Check, CommandResult]] = []
+    scheduler = Scheduler(on_result=lambda check, result: results.append((check, result)), jitter=0, stagger=0)
+    scheduler.add(fast, 0.05)
+    scheduler.add(slow, 0.2)
+    run_for(scheduler, 0.5)
+    assert 8 <= fast.runs <= 11
+    assert 2 <= slow.runs <= 3
+    assert len(results) == fast.runs + slow.runs
+    assert scheduler.lag.count >= len(results)
+    assert 0 <= scheduler.lag.max < 0.05
+
+
+def test_no_overlapping_runs() -> None:
+    command = Counter('slow', duration=0.12)
+    scheduler = Scheduler(jitter=0, stagger=0)
+    check = scheduler.add(command, 0.05)
+    run_for(scheduler, 0.5)
+    assert command.max_running == 1
+    assert check.skipped > 0
+    assert 3 <= check.runs <= 5
+
+
+def test_add_and_remove_at_runtime() -> None:
+    first, second = Counter('first'), Counter('second')
+    scheduler = Scheduler(jitter=0, stagger=0)
+    scheduler.add(first, 0.05)
+
+    async def main() -> None:
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.2, scheduler.add, second, 0.05)
+        loop.call_later(0.2, scheduler.remove, first)
+        loop.call_later(0.4, scheduler.stop)
+        await scheduler.run()
+
+    asyncio.run(main())
+    assert 3 <= first.runs <= 5
+    assert 3 <= second.runs <= 5
+    assert first not in scheduler and second in scheduler
+
+
+def test_duplicate_command() -> None:
+    scheduler = Scheduler()
+    scheduler.add(command := Counter('a'), 1)
+    with pytest.raises(ValueError):
+        scheduler.add(command, 2)
+
+
+def test_stagger_and_jitter_spread_checks() -> None:
+    scheduler = Scheduler(seed=1)
+    checks = [scheduler.add(Counter(str(i)), 10) for i in range(100)]
+    dues = sorted(check.due for check in checks)
+    assert dues[-1] - dues[0] > 5
+
+
+def test_command_set_results_are_walked() -> None:
+    results: list[CommandResult] = []
+    nested = Counter('nested')
+    scheduler = Scheduler(on_result=lambda check, result: results.append(result), jitter=0, stagger=0)
+    scheduler.add(CommandSet(nested), 0.1)
+    run_for(scheduler, 0.25)
+    assert nested.runs == len(results) >= 2
+    assert all(bool(result) for result in results)
+
+
+def test_stop_cancels_runs_of_removed_checks() -> None:
+    command = Counter('slow', duration=5)
+    scheduler = Scheduler(jitter=0, stagger=0)
+    check = scheduler.add(command, 10)
+
+    async def main() -> None:
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.1, scheduler.remove, command)
+        loop.call_later(0.2, scheduler.stop)
+        await asyncio.wait_for(scheduler.run(), 1)
+        assert check._task is not None and check._task.cancelled()
+
+    asyncio.run(main())
+    assert command.runs == 0
@@ -0,0 +1,135 @@
+import asyncio
+import os
+import time
+
+from bast1aan.monitor import CommandSet, ANY_SUCCEEDS
+from bast1aan.monitor.base import Command, AsyncCommand, CommandResult, _CommandResult
+from bast1aan.monitor.sharding import ShardedCommandSet
+
+
+class Pid(AsyncCommand):
+    """ Reports the process it ran in after duration seconds """
+    name: str
+    duration: float
+    ok: bool
+    def __init__(self, name: str, duration: float = 0.0, ok: bool = True):
+        self.name = name
+        self.duration = duration
+        self.ok = ok
+    async def run(self) -> CommandResult:
+        await asyncio.sleep(self.duration)
+        return _CommandResult(self.ok, str(os.getpid()), self)
+    def __str__(self) -> str:
+        return self.name
+    def __hash__(self) -> int:
+        return hash(self.name)
+
+
+class Crashes(AsyncCommand):
+    """ Exits its process, unless marker exists; creates marker when once is set """
+    marker: str
+    once: bool
+    def __init__(self, marker: str, once: bool = True):
+        self.marker = marker
+        self.once = once
+    async def run(self) -> CommandResult:
+        await asyncio.sleep(0.05)
+        if not os.path.exists(self.marker):
+            if self.once:
+                open(self.marker, 'w').close()
+            os._exit(3)
+        return _CommandResult.Ok('survived', self)
+    def __str__(self) -> str:
+        return f'Crashes {self.marker}'
+    def __hash__(self) -> int:
+        return 0
+
+
+class Raises(AsyncCommand):
+    async def run(self) -> CommandResult:
+        raise ValueError('raised in worker')
+    def __str__(self) -> str:
+        return 'Raises'
+    def __hash__(self) -> int:
+        return 0
+
+
+class CallsSync(Command):
+    """ Calls a command through the synchronous API, from the executor of its worker """
+    def __call__(self) -> CommandResult:
+        return Pid('inner')()
+    def __str__(self) -> str:
+        return 'CallsSync'
+    def __hash__(self) -> int:
+        return 0
+
+
+class Blocks(Command):
+    def __call__(self) -> CommandResult:
+        time.sleep(0.01)
+        return _CommandResult.Ok('blocked', self)
+    def __str__(self) -> str:
+        return 'Blocks'
+    def __hash__(self) -> int:
+        return 1
+
+
+def test_runs_in_worker_processes() -> None:
+    commands = [Pid(f'check{i}') for i in range(100)]
+    result = ShardedCommandSet(*commands, shards=4)()
+    results = list(result)
+    assert bool(result) is True
+    assert sorted(id(r.command) for r in results) == sorted(id(c) for c in commands), \
+        "Every command has one result, referring to the command given"
+    pids = {str(r) for r in results}
+    assert len(pids) == 4 and str(os.getpid()) not in pids
+
+
+def test_succeeds_if_and_order_of_completion() -> None:
+    commands = (Pid('slow', 0.2), Pid('fails', ok=False), Pid('fast', 0.05))
+    result = ShardedCommandSet(*commands, shards=3)()
+    assert [str(r.command) for r in result] == ['fails', 'fast', 'slow']
+    assert bool(result) is False
+    assert bool(ShardedCommandSet.of(CommandSet(*commands, succeeds_if=ANY_SUCCEEDS), 2)()) is True
+
+
+def test_crashed_worker_restarts_with_commands_without_result(tmp_path) -> None:  # type: ignore[no-untyped-def]
+    commands = (Pid('before', 0.0), Crashes(os.path.join(tmp_path, 'marker')), Pid('after', 0.2), Blocks())
+    result = ShardedCommandSet(*commands, shards=1)()
+    results = {str(r.command): r for r in result}
+    assert len(list(result)) == 4
+    assert bool(result) is True
+    assert str(results[str(commands[1])]) == 'survived' and str(results['Blocks']) == 'blocked'
+    assert str(results['before']) != str(results['after']), \
+        "The result from before the crash is kept, the command still running is run again by a new worker"
+
+
+def test_worker_crashing_too_often(tmp_path) -> None:  # type: ignore[no-untyped-def]
+    result = ShardedCommandSet(Crashes(os.path.join(tmp_path, 'marker'), once=False), Pid('other'), shards=2,
+                               restarts=2)()
+    results = {str(r.command): r for r in result}
+    assert bool(results['other']) is True
+    assert str(results[f'Crashes {tmp_path}/marker']) == 'Worker of shard 0 exited with code 3'
+    assert bool(result) is False
+
+
+def test_timeout() -> None:
+    before = time.monotonic()
+    result = ShardedCommandSet(Pid('fast'), Pid('slow', 5), shards=2, timeout=0.5)()
+    assert [r.timed_out for r in result] == [False, True]
+    assert time.monotonic() - before < 2
+
+
+def test_exception_in_worker_fails_its_command() -> None:
+    result = ShardedCommandSet(Raises(), Pid('other', 0.1), shards=2)()
+    results = {str(r.command): r for r in result}
+    assert str(results['Raises']) == "Worker of shard 0 raised ValueError('raised in worker')"
+    assert results['Raises'].error and bool(results['other']) is True
+    assert bool(result) is False
+
+
+def test_workers_are_not_forked_from_threads() -> None:
+    Pid('before')()  # starts the loop thread of the synchronous API, which a forked worker would not have
+    result = ShardedCommandSet(CallsSync(), Pid('other'), shards=2, timeout=5)()
+    assert [r.timed_out for r in result] == [False, False]
+    assert bool(result) is True
@@ -0,0 +1,90 @@
+import asyncio
+import time
+
+from bast1aan.monitor import CommandSet, DependingCommandSet
+from bast1aan.monitor.base import AsyncCommand, CommandResult, _CommandResult
+from bast1aan.monitor.singleflight import SingleFlight
+
+
+class Gateway(AsyncCommand):
+    runs: dict[str, int] = {}
+    name: str
+    duration: float
+
+    def __init__(self, name: str, duration: float = 0.05):
+        self.name = name
+        self.duration = duration
+
+    async def run(self) -> CommandResult:
+        Gateway.runs[self.name] = Gateway.runs.get(self.name, 0) + 1
+        await asyncio.sleep(self.duration)
+        return _CommandResult.Ok(f'{self.name} run {Gateway.runs[self.name]}', self)
+
+    def __str__(self) -> str:
+        return self.name
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, Gateway) and other.name == self.name
+
+    def __hash__(self) -> int:
+        return hash(self.name)
+
+
+def test_without_single_flight_every_command_runs() -> None:
+    result = CommandSet(Gateway('gw1'), Gateway('gw1'), Gateway('gw1'))()
+    assert len(list(result)) == 3
+    assert Gateway.runs['gw1'] == 3
+
+
+def test_equal_commands_share_one_run() -> None:
+    command_set = CommandSet(
+        *(DependingCommandSet(Gateway('gw2'), if_succeeds=Gateway(f'service{i}', 0.01)) for i in range(10)),
+        CommandSet(Gateway('gw2'), Gateway('gw2')),
+        single_flight=(single_flight := SingleFlight()),
+    )
+    results = list(command_set())
+    assert len(results) == 22
+    assert Gateway.runs['gw2'] == 1
+    gateway_results = [result for result in results if result.command == Gateway('gw2')]
+    assert len({id(result) for result in gateway_results}) == 1
+    assert len(single_flight) == 0, "Nothing is in flight after the evaluation"
+
+
+def test_sequential_runs_are_not_shared_without_ttl() -> None:
+    single_flight = SingleFlight()
+    for _ in range(3):
+        list(CommandSet(Gateway('gw3'), Gateway('gw3'), single_flight=single_flight)())
+    assert Gateway.runs['gw3'] == 3
+
+
+def test_ttl_cache_across_evaluations() -> None:
+    single_flight = SingleFlight(ttl=0.2)
+    first = list(CommandSet(Gateway('gw4'), single_flight=single_flight)())
+    second = list(CommandSet(Gateway('gw4'), single_flight=single_flight)())
+    assert Gateway.runs['gw4'] == 1
+    assert first[0] is second[0]
+    time.sleep(0.25)
+    list(CommandSet(Gateway('gw4'), single_flight=single_flight)())
+    assert Gateway.runs['gw4'] == 2
+
+
+def test_cancelled_waiter_does_not_cancel_shared_run() -> None:
+    single_flight = SingleFlight()
+
+    async def main() -> tuple[CommandResult, bool]:
+        first = asyncio.ensure_future(single_flight.run('gw', Gateway('gw5', 0.1).run))
+        second = asyncio.ensure_future(single_flight.run('gw', Gateway('gw5', 0.1).run))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second, first.cancelled()
+
+    result, first_cancelled = asyncio.run(main())
+    assert first_cancelled
+    assert str(result) == 'gw5 run 1'
+    assert Gateway.runs['gw5'] == 1
+
+
+def test_ttl_cache_is_bounded() -> None:
+    single_flight = SingleFlight(ttl=10, max_cached=5)
+    list(CommandSet(*(Gateway(f'many{i}', 0) for i in range(20)), single_flight=single_flight)())
+    assert len(single_flight._cache) == 5
@@ -0,0 +1,36 @@
+import asyncio
+import socket
+
+from bast1aan.monitor import CommandSet
+from bast1aan.monitor.tcp import TcpCommand, TcpResult
+
+
+def test_connects() -> None:
+    async def check() -> TcpResult:
+        server = await asyncio.start_server(lambda reader, writer: writer.close(), '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            return await TcpCommand('localhost', port).run()  # type: ignore[return-value]
+        finally:
+            server.close()
+
+    result = asyncio.run(check())
+    assert bool(result) is True
+    assert result.address == '127.0.0.1'
+    assert result.connect is not None and result.resolution is not None
+    assert str(result).startswith(f'Connected to {result.command} (127.0.0.1) in ')
+
+
+def test_refused() -> None:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    result = CommandSet(TcpCommand('127.0.0.1', port))()
+    assert 'refused' in str(result).lower()
+    assert bool(result) is False
+
+
+def test_does_not_resolve() -> None:
+    result = TcpCommand('fliepsflops', 80)()
+    assert bool(result) is False
+    assert str(result).startswith('fliepsflops:80: ')
@@ -1,6 +1,9 @@
 import asyncio
+import os
 from typing import AsyncIterator
 
+import pytest
+
 from bast1aan.monitor import _util
 
 def test_util() -> None:
@@ -12,3 +15,39 @@ def test_util() -> None:
 
     result = [i for i in _util.sync_iterator(async_iterator())]
     assert result == ['bla', 'bloep']
+
+def test_which_caches_executable() -> None:
+    _util.forget_executable('sh')
+    path = _util.which('sh')
+    assert path.endswith('/sh')
+    assert ('sh', os.environ.get('PATH')) in _util._executables
+    assert _util.which('sh') is path
+    _util.forget_executable('sh')
+    assert ('sh', os.environ.get('PATH')) not in _util._executables
+
+def test_which_not_found_or_path() -> None:
+    assert _util.which('nonexistent-command') == 'nonexistent-command'
+    assert _util.which('/bin/sh') == '/bin/sh'
+
+def test_sync_iterator_resumes_on_demand() -> None:
+    pulled: list[int] = []
+
+    async def async_iterator() -> AsyncIterator[int]:
+        for i in range(1000):
+            pulled.append(i)
+            yield i
+
+    shared = async_iterator()
+    assert next(_util.sync_iterator(shared)) == 0
+    assert pulled == [0], "Only the items asked for are pulled"
+    assert list(_util.sync_iterator(shared))[:2] == [1, 2], "Stopping early leaves the rest to a next iteration"
+
+def test_sync_iterator_raises() -> None:
+    async def async_iterator() -> AsyncIterator[int]:
+        yield 1
+        raise ValueError('bla')
+
+    iterator = _util.sync_iterator(async_iterator())
+    assert next(iterator) == 1
+    with pytest.raises(ValueError, match='bla'):
+        next(iterator)